@@ -1,17 +1,33 @@
+from dataclasses import dataclass
 from pathlib import Path
+import contextlib
+import threading
 
 import modal
 from modal import Image
 
 import common
+import models
+import vad
 from common import app
 
 
+@dataclass
+class AlignmentProgress:
+    percent_done: int
+
+
+# aligner release
+ALIGNER = "timething@1.0.4"
+
+# length of the windows that tracks are aligned in
+SECONDS_PER_WINDOW = 10
+
 alignment_image = (
     Image.debian_slim(python_version="3.10.8")
     .apt_install("sox", "libsox-dev")
     .pip_install_private_repos(
-        "github.com/voicelayerai/timething@1.0.4",
+        f"github.com/voicelayerai/{ALIGNER}",
         git_user="purzelrakete",
         secrets=[modal.Secret.from_name("github-read-private")],
     )
@@ -31,8 +47,14 @@ def align(
     language: str,
     batch_size=1,
     n_workers=10,
-    seconds_per_window=10,
+    seconds_per_window=SECONDS_PER_WINDOW,
+    speech=False,
 ):
+    """
+    Align the transcript to the transcoded file. With speech, only the speech
+    file written by vad is aligned, and the words are mapped back.
+    """
+
     from timething import dataset, job, utils
 
     if not language:
@@ -40,17 +62,26 @@ def align(
         language = "en"
 
     t = common.db.select(transcription_id)
+    audio_file, speech_map = vad.speech_input(t, speech)
+    if speech_map and not speech_map.regions:
+        return common.Alignment(words=[])
+
     ds = dataset.WindowedTrackDataset(
-        str(t.transcoded_file),
-        t.transcoded_file.suffix[1:],
+        str(audio_file),
+        audio_file.suffix[1:],
         t.transcript["text"],
         seconds_per_window * 1000,
         seconds_per_window * 1000,
         16000,
     )
 
-    cfg = utils.load_config(language)
-    j = job.LongTrackJob(cfg, ds, batch_size=batch_size, n_workers=n_workers)
+    cfg = models.registry.get(
+        f"timething:{language}", "config", lambda: utils.load_config(language)
+    )
+    with cached_aligner():
+        j = job.LongTrackJob(
+            cfg, ds, batch_size=batch_size, n_workers=n_workers
+        )
     tt_alignment = j.run()
 
     # convert to studio alignment
@@ -63,9 +94,41 @@ def align(
             score=s.score
         ))
 
+    if speech_map:
+        alignment = speech_map.alignment(alignment)
+
     return alignment
 
 
+# guards swapping out the timething aligner builder
+aligner_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def cached_aligner():
+    """
+    timething builds its wav2vec2 aligner inside the job constructor. Route
+    that build through the model registry while a job is being set up, so
+    that warm containers reuse the aligner.
+    """
+
+    from timething import align as tt_align
+
+    build = tt_align.Aligner.build
+
+    def cached_build(device, cfg):
+        return models.registry.get(
+            cfg.hugging_model, device, lambda: build(device, cfg)
+        )
+
+    with aligner_lock:
+        tt_align.Aligner.build = staticmethod(cached_build)
+        try:
+            yield
+        finally:
+            tt_align.Aligner.build = staticmethod(build)
+
+
 def align_piecewise_linear(transcription: common.Transcription):
     alignment = common.Alignment()
     for s in transcription.transcript["segments"]:
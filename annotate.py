@@ -8,6 +8,8 @@ import sys
 from modal import Image, Secret
 
 import common
+import models
+import vad
 from common import app
 
 logger = logging.getLogger(__name__)
@@ -24,6 +26,9 @@ class AnnotationError(Exception):
     pass
 
 
+# pyannote diarization pipeline
+DIARIZATION_MODEL = "pyannote/speaker-diarization-3.1"
+
 annotation_image = Image.debian_slim(python_version="3.10.8").pip_install(
     "pyannote.audio===3.1.1", "num2words"
 )
@@ -52,7 +57,12 @@ class Progress:
         Secret.from_name("huggingface-secret"),
     ],
 )
-def annotate(transcription_id):
+def annotate(transcription_id, speech=False):
+    """
+    Diarize the transcoded file. With speech, only the speech file written by
+    vad is diarized, and the turns are mapped back.
+    """
+
     from num2words import num2words
     from pyannote.audio.pipelines.utils.hook import ProgressHook
     from pyannote.audio import Pipeline
@@ -63,17 +73,25 @@ def annotate(transcription_id):
     if not t:
         raise AnnotationError(f"invalid id : {transcription_id}")
 
+    audio_file, speech_map = vad.speech_input(t, speech)
+    if speech_map and not speech_map.regions:
+        return common.Diarization(turns=[])
+
     hf_token = os.getenv("HF_TOKEN")
     device = torch.device(common.get_device())
-    pipeline = Pipeline.from_pretrained(
-        "pyannote/speaker-diarization-3.1",
-        use_auth_token=hf_token,
-    ).to(device)
+    pipeline = models.registry.get(
+        DIARIZATION_MODEL,
+        device,
+        lambda: Pipeline.from_pretrained(
+            DIARIZATION_MODEL,
+            use_auth_token=hf_token,
+        ).to(device),
+    )
     logger.info(f"pipeline loaded onto {device}")
 
     with ProgressHook() as hook:
         # load audio. https://github.com/m-bain/whisperX/issues/399
-        waveform, sample_rate = torchaudio.load(str(t.transcoded_file))
+        waveform, sample_rate = torchaudio.load(str(audio_file))
         logger.info(f"loaded waveform {waveform.size()}")
         diarization = pipeline(
             {"waveform": waveform, "sample_rate": sample_rate, "hook": hook}
@@ -97,4 +115,8 @@ def annotate(transcription_id):
                 number = int(t.speaker.split("_")[1]) + 1
                 t.speaker = f"Speaker {number}"
 
-        return common.Diarization(turns=turns)
+        diarization = common.Diarization(turns=turns)
+        if speech_map:
+            diarization = speech_map.diarization(diarization)
+
+        return diarization
@@ -3,29 +3,37 @@ Main web application service. Serves the static frontend as well as
 API routes for transcription and alignment.
 """
 
+import asyncio
 import json
 import logging
+import os
 import re
+import typing
 import uuid
 from dataclasses import asdict, dataclass, replace
+from dataclasses import fields as dataclass_fields
 from pathlib import Path
 
 from modal import Image, Mount, NetworkFileSystem, Secret, asgi_app
 from pydantic import BaseModel
 
+import asr
 import common
 import formats
+import jobs
+import models
+import peaks
+import ranges
+import scheduler
 import transcode
 import transcribe
+import uploads
 from common import Transcription, app
-from pipeline import PipelineProgress, pipeline
+from pipeline import PipelineProgress
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-# size of a chunk of media returned
-MEDIA_CHUNK_SIZE = 1024 * 1024
-
 # paths
 static_path = Path("./frontend/dist").resolve()
 remote_path = Path("/assets")
@@ -48,6 +56,27 @@ class MediaForm(BaseModel):
     filename: str
     content_type: str
     size_bytes: int
+    # opt in to parallel, out of order chunks
+    chunk_size: int = None
+
+
+class BatchForm(BaseModel):
+    """
+    Pydantic class for FastAPI validations
+    """
+
+    transcription_ids: typing.List[str]
+    language: str = None
+
+
+class FinalizeForm(BaseModel):
+    """
+    Pydantic class for FastAPI validations
+    """
+
+    size_bytes: int
+    # e.g. sha256:9f86d08
+    checksum: str = None
 
 
 @app.function(
@@ -68,6 +97,7 @@ def web():
         File,
         Header,
         HTTPException,
+        Query,
         Request,
         UploadFile,
     )
@@ -80,21 +110,42 @@ def web():
         logger.error(msg)
         raise HTTPException(status_code=status_code, detail=msg)
 
+    async def add_media_hash(t: Transcription):
+        """
+        Identifies uploads of the same media, so that results can be reused.
+        The upload is read back to hash it, so that runs in a thread.
+        """
+
+        if not t.upload.media_hash:
+            media_hash = await asyncio.to_thread(uploads.media_hash, t)
+            upload = replace(t.upload, media_hash=media_hash)
+            await asyncio.to_thread(
+                common.db.update, t.transcription_id, upload=upload
+            )
+
     @web_app.post("/upload")
     async def upload(media: MediaForm):
+        if media.chunk_size is not None:
+            if media.chunk_size < uploads.MIN_CHUNK_SIZE:
+                error(400, f"chunk size under {uploads.MIN_CHUNK_SIZE}")
+
         transcription_id = str(uuid.uuid4())
-        common.db.create(
-            Transcription(
-                transcription_id=transcription_id,
-                path=str(common.MEDIA_PATH / transcription_id),
-                upload=common.UploadInfo(
-                    filename=media.filename,
-                    content_type=media.content_type,
-                    size_bytes=media.size_bytes,
-                ),
-            )
+        t = Transcription(
+            transcription_id=transcription_id,
+            path=str(common.MEDIA_PATH / transcription_id),
+            upload=common.UploadInfo(
+                filename=media.filename,
+                content_type=media.content_type,
+                size_bytes=media.size_bytes,
+                chunk_size=media.chunk_size,
+            ),
         )
 
+        chunked = uploads.chunked_upload(t)
+        if chunked:
+            chunked.start()
+
+        common.db.create(t)
         return transcription_id
 
     @web_app.put("/upload/{transcription_id}")
@@ -140,18 +191,41 @@ def web():
         if t.upload.content_type != content_type:
             error(400, f"invalid content_type: {content_type}")
 
-        chunk = await request.body()
-        if len(chunk) != content_length:
-            error(400, f"want chunk size {content_length} but got {len(chunk)}")
+        # parallel uploads take chunks in any order
+        chunked = uploads.chunked_upload(t)
+        if chunked:
+            try:
+                await chunked.write(chunked.index(start, end), request.stream())
+            except uploads.UploadError as e:
+                error(400, str(e))
+
+            return Response(
+                status_code=308,
+                headers={"Content-Range": f"bytes={start}-{end}"},
+            )
 
         if file_size != start:
             error(400, f"content-range is not contiguous: {content_range}")
 
-        with open(path, "r+b" if start else "wb") as f:
-            f.seek(start)
-            f.write(chunk)
+        digests = uploads.BlockDigests(path, total)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            try:
+                written = await uploads.write_stream(
+                    request.stream(), fd, start, digests, limit=content_length
+                )
+            except uploads.UploadError as e:
+                os.ftruncate(fd, start)
+                error(400, str(e))
+            if written != content_length:
+                os.ftruncate(fd, start)
+                msg = f"want chunk size {content_length} but got {written}"
+                error(400, msg)
+        finally:
+            os.close(fd)
 
         if end + 1 == total:
+            await add_media_hash(t)
             return Response(status_code=200)
         else:
             return Response(
@@ -159,38 +233,179 @@ def web():
                 headers={"Content-Range": f"bytes={start}-{end}"},
             )
 
+    @web_app.get("/upload/{transcription_id}/chunks")
+    async def upload_chunks(transcription_id: str):
+        t = common.db.select(transcription_id)
+        if not t:
+            error(404, f"invalid id {transcription_id}")
+
+        chunked = uploads.chunked_upload(t)
+        if not chunked:
+            error(400, f"not a parallel upload: {transcription_id}")
+
+        return {"chunk_size": chunked.chunk_size, "missing": chunked.missing()}
+
+    @web_app.post("/upload/{transcription_id}/finalize")
+    async def finalize_upload(transcription_id: str, form: FinalizeForm):
+        t = common.db.select(transcription_id)
+        if not t:
+            error(404, f"invalid id {transcription_id}")
+
+        chunked = uploads.chunked_upload(t)
+        if not chunked:
+            error(400, f"not a parallel upload: {transcription_id}")
+        if form.size_bytes != t.upload.size_bytes:
+            error(400, f"want {t.upload.size_bytes} bytes: {form.size_bytes}")
+
+        # hashing a large upload takes a while, and would stall every other
+        # request of this container
+        try:
+            await asyncio.to_thread(chunked.finalize, form.checksum)
+        except uploads.UploadError as e:
+            error(409, str(e))
+
+        await add_media_hash(t)
+        return Response(status_code=200)
+
+    @web_app.post("/batch")
+    async def bulk_import(form: BatchForm):
+        """
+        Transcode and transcribe many short uploads at low priority, e.g. a
+        bulk import of voice notes. Returns at once. Each transcription is
+        saved as its result arrives.
+        """
+
+        ids = list(dict.fromkeys(form.transcription_ids))
+        if not ids or len(ids) > jobs.MAX_BATCH_FILES:
+            error(400, f"want 1 to {jobs.MAX_BATCH_FILES} transcriptions")
+
+        for transcription_id in ids:
+            t = await asyncio.to_thread(common.db.select, transcription_id)
+            if not t:
+                error(404, f"invalid id {transcription_id}")
+            chunked = uploads.chunked_upload(t)
+            if chunked and not chunked.finalized:
+                error(409, f"upload is not finalized: {transcription_id}")
+
+        await jobs.run_batch.spawn.aio(ids, language=form.language)
+        return Response(status_code=202)
+
     @web_app.get("/transcribe/{transcription_id}")
-    async def transcribe(transcription_id: str, language: str = None):
+    async def transcribe(
+        transcription_id: str,
+        language: str = None,
+        streaming: bool = False,
+        progressive: bool = False,
+        backend: str = None,
+        model: str = None,
+        compute_type: str = None,
+        device: str = None,
+        last_event_id: str = Header(None),
+    ):
         t = common.db.select(transcription_id)
         if not t:
             error(404, f"invalid id {transcription_id}")
 
-        prompt = None
-        if t.track and t.track.description:
-            gpt = common.whisper_gpt()
-            logger.info("calling llm for whisper prompt")
-            prompt = gpt.complete(t.track.description)
-            logger.info(f"prompt generated: {prompt}")
+        # the recognition backend, e.g. int8 faster-whisper on cpu
+        try:
+            options = asr.AsrOptions.from_dict(
+                {
+                    "backend": backend,
+                    "model": model,
+                    "compute_type": compute_type,
+                    "device": device,
+                }
+            )
+        except asr.AsrError as e:
+            error(400, str(e))
+
+        # progressive transcoding reads the upload as it arrives
+        chunked = uploads.chunked_upload(t)
+        if chunked and not chunked.finalized and not progressive:
+            error(409, f"upload is not finalized: {transcription_id}")
+
+        # reconnecting clients pick up where they left off
+        job, after = None, 0
+        if last_event_id:
+            job, after = jobs.resume(t, last_event_id)
+
+        if not job:
+            prompt = None
+            if t.track and t.track.description:
+                gpt = common.whisper_gpt()
+                logger.info("calling llm for whisper prompt")
+                description = t.track.description
+                prompt = await asyncio.to_thread(gpt.complete, description)
+                logger.info(f"prompt generated: {prompt}")
+
+            # re-runs are interactive, so they skip ahead of first runs
+            priority = scheduler.NORMAL
+            if t.transcribed:
+                priority = scheduler.INTERACTIVE
 
-        def generate():
             try:
-                for update in pipeline(transcription_id, language):
-                    yield common.dataclass_to_event(update)
+                job = await jobs.submit(
+                    t,
+                    language=language,
+                    prompt=prompt,
+                    streaming=streaming,
+                    progressive=progressive,
+                    priority=priority,
+                    asr_options=asdict(options),
+                )
+            except jobs.JobError as e:
+                error(409, str(e))
+
+        async def generate():
+            try:
+                async for event_id, event in job.follow(after):
+                    yield f"id: {event_id}\n{event}"
             except Exception as e:
                 logger.error(e)
-                yield PipelineProgress(state="error")
+                yield common.dataclass_to_event(PipelineProgress(state="error"))
 
-        return StreamingResponse(generate(), media_type="text/event-stream")
+        return StreamingResponse(
+            common.with_heartbeats(generate()), media_type="text/event-stream"
+        )
 
     @web_app.get("/transcription/{transcription_id}")
-    async def transcription(transcription_id: str):
+    async def transcription(
+        transcription_id: str,
+        fields: str = None,
+        start: float = Query(None, alias="from"),
+        end: float = Query(None, alias="to"),
+    ):
+        t = common.db.select(transcription_id)
+        if not t:
+            error(404, f"invalid id {transcription_id}")
+
+        names = [f.name for f in dataclass_fields(common.Transcription)]
+        if fields:
+            selected = fields.split(",")
+            unknown = set(selected) - set(names)
+            if unknown:
+                error(400, f"unknown fields {', '.join(sorted(unknown))}")
+            names = [n for n in names if n in selected]
+
+        if start is not None or end is not None:
+            t = t.window(start, end)
+
+        content = formats.iter_json({n: getattr(t, n) for n in names})
+        return StreamingResponse(
+            formats.buffered(content), media_type="application/json"
+        )
+
+    @web_app.get("/transcription/{transcription_id}/alignment")
+    async def alignment(transcription_id: str):
         t = common.db.select(transcription_id)
         if not t:
             error(404, f"invalid id {transcription_id}")
+        if not t.alignment:
+            error(404, f"no alignment for {transcription_id}")
 
-        content = json.dumps(asdict(t), cls=common.JSONEncoder)
         return Response(
-            media_type="application/json", content=content.encode("utf-8")
+            media_type="application/octet-stream",
+            content=t.alignment.to_bytes(),
         )
 
     @web_app.put("/transcription/{transcription_id}/track")
@@ -203,8 +418,8 @@ def web():
         if isinstance(track_dict, str):
             track_dict = json.loads(track_dict)
 
-        t.track = replace(t.track or common.Track(), **track_dict)
-        common.db.create(t)
+        track = replace(t.track or common.Track(), **track_dict)
+        common.db.update(transcription_id, track=track)
 
         return 200
 
@@ -220,45 +435,79 @@ def web():
         except Exception as e:
             error(404, f"id is still processing: {e}")
 
-    @web_app.get("/media/{transcription_id}")
-    def media(transcription_id: str, range: str = Header(None)):
+    @web_app.api_route("/media/{transcription_id}", methods=["GET", "HEAD"])
+    def media(request: Request, transcription_id: str):
         t = common.db.select(transcription_id)
         if not t:
             error(404, f"invalid id {transcription_id}")
 
-        path = t.uploaded_file
         content_type = t.content_type or "video/mp4"
-        total = path.stat().st_size
+        return ranges.file_response(
+            t.uploaded_file, content_type, request.headers
+        )
 
-        try:
-            start, end = range.replace("bytes=", "").split("-")
-            start = int(start or 0)
-            end = int(end or total - 1)
-            assert start >= 0
-            assert end < total
-        except Exception as e:
-            error(416, "invalid content-range")
+    @web_app.api_route(
+        "/media/{transcription_id}/proxy", methods=["GET", "HEAD"]
+    )
+    def media_proxy(request: Request, transcription_id: str):
+        t = common.db.select(transcription_id)
+        if not t:
+            error(404, f"invalid id {transcription_id}")
 
-        def read():
-            with open(path, "rb") as f:
-                f.seek(start)
-                while (pos := f.tell()) <= end:
-                    size = min(MEDIA_CHUNK_SIZE, end - pos + 1)
-                    yield f.read(size)
+        # proxies are complete once transcoding is
+        if t.transcoded:
+            proxies = [
+                (t.video_proxy_file, "video/mp4"),
+                (t.audio_proxy_file, "audio/mp4"),
+            ]
+            for path, content_type in proxies:
+                if path.exists():
+                    return ranges.file_response(
+                        path, content_type, request.headers
+                    )
+
+        # fall back to the original
+        content_type = t.content_type or "video/mp4"
+        return ranges.file_response(
+            t.uploaded_file, content_type, request.headers
+        )
 
-        content_range = f"bytes {start}-{end}/{total}"
-        logger.info(f"reading range {content_range}")
-        return StreamingResponse(
-            read(),
-            status_code=206,
-            media_type=content_type,
+    @web_app.get("/peaks/{transcription_id}")
+    def waveform_peaks(
+        transcription_id: str,
+        zoom: int = 0,
+        start: float = Query(None, alias="from"),
+        end: float = Query(None, alias="to"),
+    ):
+        t = common.db.select(transcription_id)
+        if not t:
+            error(404, f"invalid id {transcription_id}")
+        if not t.peaks_file.exists():
+            error(404, f"no peaks for {transcription_id}")
+
+        try:
+            s = peaks.read_peaks(t.peaks_file, zoom, start, end)
+        except peaks.PeaksError as e:
+            error(400, str(e))
+
+        return Response(
+            content=s.data,
+            media_type="application/octet-stream",
             headers={
-                "Accept-Ranges": "bytes",
-                "Content-Length": str(total),
-                "Content-Range": content_range,
+                "Peaks-Sample-Rate": str(s.sample_rate),
+                "Peaks-Samples-Per-Peak": str(s.samples_per_peak),
+                "Peaks-Offset": str(s.offset),
             },
         )
 
+    @web_app.get("/metrics")
+    async def metrics():
+        return {
+            "store_cache": common.db.cache.stats(),
+            "scheduler": scheduler.read_metrics(),
+            "models": models.read_metrics(),
+        }
+
     web_app.mount(
         "/assets", StaticFiles(directory=remote_path / "assets", html=True)
     )
@@ -0,0 +1,230 @@
+"""
+Speech recognition backends. Every backend transcribes an audio file into a
+whisper shaped transcript: text, language, and segments with id, seek,
+start, end and text, which is what align and the subtitle formats read.
+
+    whisper         openai-whisper, fp16 on gpu and fp32 on cpu
+    faster-whisper  ctranslate2 models, quantized to int8 on cpu by default
+
+Backends are selected per job with AsrOptions, and loaded once per process.
+"""
+
+from dataclasses import dataclass, fields
+import logging
+import typing
+
+import common
+import models
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+WHISPER = "whisper"
+FASTER_WHISPER = "faster-whisper"
+
+# models and compute types that clients may ask for, per backend. anything
+# else would be downloaded and held in memory for the life of a container
+MODELS = {
+    WHISPER: {"tiny", "base", "small", "medium", "large-v2"},
+    FASTER_WHISPER: {"tiny", "base", "small", "medium", "large-v2", "large-v3"},
+}
+COMPUTE_TYPES = {
+    WHISPER: {"float16", "float32"},
+    FASTER_WHISPER: {"int8", "int8_float16", "float16", "float32"},
+}
+
+# None picks the gpu where there is one
+DEVICES = {None, "cpu"}
+
+
+class AsrError(Exception):
+    pass
+
+
+@dataclass
+class AsrOptions:
+    """
+    Choice of speech recognition for a job
+    """
+
+    backend: str = WHISPER
+    model: str = common.MODEL_NAME
+    # e.g. int8, float16. None is the default of the backend and device
+    compute_type: str = None
+    # cpu only transcription, e.g. for low priority jobs. None picks the gpu
+    # where there is one
+    device: str = None
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        d = d or {}
+        unknown = set(d) - {f.name for f in fields(cls)}
+        if unknown:
+            raise AsrError(f"unknown asr options: {sorted(unknown)}")
+        options = cls(**{k: v for k, v in d.items() if v is not None})
+        if options.backend not in BACKENDS:
+            raise AsrError(f"unknown asr backend: {options.backend}")
+        if options.model not in MODELS[options.backend]:
+            raise AsrError(f"unknown {options.backend} model: {options.model}")
+        compute_types = COMPUTE_TYPES[options.backend]
+        if options.compute_type not in compute_types | {None}:
+            raise AsrError(
+                f"{options.backend} can't compute in {options.compute_type}"
+            )
+        if options.device not in DEVICES:
+            raise AsrError(f"unknown device: {options.device}")
+        return options
+
+    @property
+    def cpu(self):
+        return self.device == "cpu"
+
+    @property
+    def resolved_compute_type(self) -> str:
+        "The compute type, or the default of the backend on the device"
+        return self.compute_type or default_compute_type(
+            self.backend, not self.cpu
+        )
+
+    def fingerprint_inputs(self) -> dict:
+        "Inputs of the transcribe fingerprint. The default leaves it as it was"
+        inputs = {"model": self.model}
+        if self.backend != WHISPER or self.compute_type:
+            inputs |= {
+                "backend": self.backend,
+                "compute": self.resolved_compute_type,
+            }
+        return inputs
+
+
+def default_compute_type(backend: str, on_gpu: bool) -> str:
+    "What a backend computes in, unless it is told otherwise"
+    if backend == FASTER_WHISPER and not on_gpu:
+        return "int8"
+    return "float16" if on_gpu else "float32"
+
+
+class WhisperBackend:
+    "openai-whisper. Progress comes from a hook on the decoder"
+
+    def __init__(self, model: str, device: str, compute_type: str = None):
+        import whisper
+
+        import transcribe
+
+        if compute_type not in (None, "float16", "float32"):
+            raise AsrError(f"whisper can't compute in {compute_type}")
+
+        # shares the model with map and batch transcription
+        self.model = transcribe.load_model(model, device)
+        self.fp16 = device.startswith("cuda") and compute_type != "float32"
+        self.tokenizer = whisper.tokenizer.get_tokenizer(
+            self.model.is_multilingual
+        )
+
+    def transcribe(
+        self,
+        audio_file: str,
+        duration: float,
+        language: str = None,
+        prompt: str = None,
+        progress: typing.Callable[[int], None] = None,
+    ) -> dict:
+        import transcribe
+
+        hook = transcribe.DecodeProgress(
+            self.model,
+            duration,
+            progress or (lambda _: None),
+            self.tokenizer.timestamp_begin,
+        )
+        with hook:
+            return self.model.transcribe(
+                audio_file,
+                language=language,
+                initial_prompt=prompt,
+                fp16=self.fp16,
+                verbose=None,
+            )
+
+
+class FasterWhisperBackend:
+    "ctranslate2 whisper models, which run at usable speed on cpu in int8"
+
+    def __init__(self, model: str, device: str, compute_type: str = None):
+        from faster_whisper import WhisperModel
+
+        on_gpu = device.startswith("cuda")
+        self.compute_type = compute_type or default_compute_type(
+            FASTER_WHISPER, on_gpu
+        )
+        self.model = WhisperModel(
+            model,
+            device="cuda" if on_gpu else "cpu",
+            compute_type=self.compute_type,
+        )
+
+    def transcribe(
+        self,
+        audio_file: str,
+        duration: float,
+        language: str = None,
+        prompt: str = None,
+        progress: typing.Callable[[int], None] = None,
+    ) -> dict:
+        segments, info = self.model.transcribe(
+            audio_file, language=language, initial_prompt=prompt
+        )
+
+        # segments are decoded lazily, as they are iterated
+        results = []
+        percent_done = 0
+        for segment in segments:
+            results.append(segment_dict(segment, len(results)))
+            percent = min(99, int(100 * segment.end / max(info.duration, 1)))
+            if progress and percent > percent_done:
+                percent_done = percent
+                progress(percent)
+
+        return {
+            "text": "".join(s["text"] for s in results),
+            "segments": results,
+            "language": info.language,
+        }
+
+
+def segment_dict(segment, index: int) -> dict:
+    "A faster-whisper segment as a whisper segment"
+    return {
+        "id": index,
+        "seek": segment.seek,
+        "start": segment.start,
+        "end": segment.end,
+        "text": segment.text,
+        "tokens": list(segment.tokens),
+        "temperature": segment.temperature,
+        "avg_logprob": segment.avg_logprob,
+        "compression_ratio": segment.compression_ratio,
+        "no_speech_prob": segment.no_speech_prob,
+    }
+
+
+BACKENDS = {WHISPER: WhisperBackend, FASTER_WHISPER: FasterWhisperBackend}
+
+
+def load_backend(options: AsrOptions, device: str):
+    "The backend for options on device, loaded once per process"
+    if options.cpu:
+        device = "cpu"
+
+    load = BACKENDS[options.backend]
+    if load is WhisperBackend:
+        # whisper models are cached by name alone
+        return load(options.model, device, options.compute_type)
+
+    name = f"{options.backend}:{options.model}:{options.compute_type}"
+    return models.registry.get(
+        name,
+        device,
+        lambda: load(options.model, device, options.compute_type),
+    )
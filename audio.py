@@ -0,0 +1,224 @@
+"""
+Vectorised helpers over transcoded wav files. Samples are memory mapped, so
+only the parts of a file that are looked at are read.
+"""
+
+from pathlib import Path
+import os
+import struct
+import typing
+
+import numpy as np
+
+
+class WavError(Exception):
+    pass
+
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# sample type by format and bits per sample
+WAV_DTYPES = {
+    (WAVE_FORMAT_PCM, 16): np.int16,
+    (WAVE_FORMAT_IEEE_FLOAT, 32): np.float32,
+}
+
+
+def read_wav(path: Path) -> typing.Tuple[np.ndarray, int]:
+    """
+    Memory map the samples of a pcm wav file. Returns the samples and the
+    sample rate. Samples are one dimensional for mono files, and have a
+    trailing channel dimension otherwise.
+    """
+
+    with open(path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise WavError(f"not a wav file: {path}")
+
+        dtype = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise WavError(f"no data chunk: {path}")
+
+            chunk_id, size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                fmt = f.read(size)
+                audio_format, channels, sample_rate = struct.unpack(
+                    "<HHI", fmt[:8]
+                )
+                bits = struct.unpack("<H", fmt[14:16])[0]
+                if audio_format == WAVE_FORMAT_EXTENSIBLE:
+                    audio_format = struct.unpack("<H", fmt[24:26])[0]
+                dtype = WAV_DTYPES.get((audio_format, bits))
+                if dtype is None:
+                    raise WavError(f"unsupported format {audio_format}: {path}")
+            elif chunk_id == b"data":
+                offset = f.tell()
+                break
+            else:
+                f.seek(size + (size & 1), os.SEEK_CUR)
+
+    if dtype is None:
+        raise WavError(f"no fmt chunk: {path}")
+
+    # the data size is not final while ffmpeg is still writing the file
+    frame_size = np.dtype(dtype).itemsize * channels
+    n_frames = (os.path.getsize(path) - offset) // frame_size
+    if size not in (0, 0xFFFFFFFF):
+        n_frames = min(n_frames, size // frame_size)
+
+    shape = (n_frames,) if channels == 1 else (n_frames, channels)
+    if n_frames == 0:
+        return np.zeros(shape, dtype=dtype), sample_rate
+
+    return np.memmap(path, dtype, "r", offset, shape=shape), sample_rate
+
+
+def to_float(samples: np.ndarray) -> np.ndarray:
+    "Convert samples to mono float32 in [-1, 1], as whisper expects"
+    scale = 32768.0 if samples.dtype == np.int16 else 1.0
+    if samples.ndim > 1:
+        return samples.mean(axis=1, dtype=np.float32) / scale
+    return samples.astype(np.float32) / scale
+
+
+def frame_energy(samples: np.ndarray, frame_size: int) -> np.ndarray:
+    "Mean energy of consecutive frames. A trailing partial frame is dropped"
+    n_frames = len(samples) // frame_size
+    frames = to_float(samples[: n_frames * frame_size])
+    return np.square(frames.reshape(n_frames, frame_size)).mean(axis=1)
+
+
+def split_at_silence(
+    samples: np.ndarray,
+    sample_rate: int,
+    chunk_seconds: float = 300,
+    search_seconds: float = 10,
+    frame_seconds: float = 0.02,
+) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Split audio into spans of at most chunk_seconds. Each span ends on the
+    quietest frame of its last search_seconds, so that cuts fall between
+    words rather than inside them. Returns (start, end) sample indices.
+    """
+
+    chunk_size = int(chunk_seconds * sample_rate)
+    search_size = min(int(search_seconds * sample_rate), chunk_size)
+    frame_size = max(1, int(frame_seconds * sample_rate))
+
+    spans = []
+    start = 0
+    while len(samples) - start > chunk_size:
+        lo = start + chunk_size - search_size
+        energy = frame_energy(samples[lo : start + chunk_size], frame_size)
+        end = lo + int(np.argmin(energy)) * frame_size + frame_size // 2
+        spans.append((start, end))
+        start = end
+
+    spans.append((start, len(samples)))
+    return spans
+
+
+def speech_regions(
+    samples: np.ndarray,
+    sample_rate: int,
+    threshold_db: float = -45.0,
+    margin_db: float = 10.0,
+    frame_seconds: float = 0.03,
+    min_silence_seconds: float = 1.0,
+    pad_seconds: float = 0.2,
+) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Regions of audio that are loud enough to hold speech. A frame is loud if
+    its energy is over threshold_db relative to full scale, and margin_db
+    over the noise floor of the file. Regions are padded by pad_seconds, and
+    pauses shorter than min_silence_seconds are bridged. Music is as loud as
+    speech, so it is kept. Returns (start, end) sample indices.
+    """
+
+    frame_size = max(1, int(frame_seconds * sample_rate))
+    energy = frame_energy(samples, frame_size)
+    if not len(energy):
+        return []
+
+    db = 10 * np.log10(energy + 1e-10)
+    floor = np.percentile(db, 10)
+    loud = db > max(threshold_db, floor + margin_db)
+
+    # runs of loud frames, from the edges of the mask
+    edges = np.diff(np.concatenate([[0], loud.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1) * frame_size
+    ends = np.flatnonzero(edges == -1) * frame_size
+    if not len(starts):
+        return []
+
+    pad = int(pad_seconds * sample_rate)
+    starts = np.maximum(starts - pad, 0)
+    ends = np.minimum(ends + pad, len(samples))
+    apart = starts[1:] - ends[:-1] >= int(min_silence_seconds * sample_rate)
+    starts = starts[np.concatenate([[True], apart])]
+    ends = ends[np.concatenate([apart, [True]])]
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def write_wav(
+    path: Path, spans: typing.Iterable[np.ndarray], sample_rate: int
+):
+    "Write spans of samples one after the other, as a mono 16 bit pcm wav"
+    import wave
+
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for samples in spans:
+            pcm = np.clip(np.round(to_float(samples) * 32767), -32768, 32767)
+            f.writeframes(pcm.astype("<i2").tobytes())
+
+
+def peak_pyramid(
+    samples: np.ndarray, samples_per_peak: int = 256
+) -> typing.List[np.ndarray]:
+    """
+    Min and max peaks of the audio at halving resolutions, as int16 arrays
+    of shape (n, 2). The first level has a peak per samples_per_peak
+    samples, and each following level has half the peaks of the one before,
+    down to a single peak for the whole file.
+    """
+
+    if samples.ndim > 1:
+        samples = samples.reshape(len(samples), -1)
+    else:
+        samples = samples.reshape(-1, 1)
+
+    n_peaks = -(-len(samples) // samples_per_peak)
+    if n_peaks == 0:
+        return [np.zeros((0, 2), dtype=np.int16)]
+
+    # whole frames in one reduction over the map, then the partial one
+    n_whole = len(samples) // samples_per_peak
+    whole = samples[: n_whole * samples_per_peak].reshape(n_whole, -1)
+    level = np.empty((n_peaks, 2), dtype=np.float32)
+    level[:n_whole, 0] = whole.min(axis=1)
+    level[:n_whole, 1] = whole.max(axis=1)
+    if n_whole < n_peaks:
+        rest = samples[n_whole * samples_per_peak :]
+        level[-1] = rest.min(), rest.max()
+
+    if samples.dtype != np.int16:
+        level = np.clip(np.round(level * 32767), -32768, 32767)
+
+    levels = [level.astype(np.int16)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level = np.concatenate([level, level[-1:]])
+        pairs = level.reshape(-1, 2, 2)
+        mins, maxs = pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)
+        levels.append(np.stack([mins, maxs], axis=1))
+
+    return levels
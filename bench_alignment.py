@@ -0,0 +1,90 @@
+"""
+Benchmark the binary columnar alignment against json, on size and on encode
+and decode time.
+
+    python bench_alignment.py
+    python bench_alignment.py --words 40000
+"""
+
+from dataclasses import asdict
+import argparse
+import gzip
+import json
+import random
+import statistics
+import time
+
+import common
+
+
+def alignment(n_words: int) -> common.Alignment:
+    "Word lengths and timings like those of an interview"
+    rng = random.Random(0)
+    vocabulary = [f"word{i}" for i in range(3000)]
+    words, t = [], 0.0
+    for _ in range(n_words):
+        start = t + rng.uniform(0, 0.2)
+        end = start + rng.uniform(0.1, 0.6)
+        score = rng.uniform(0.3, 1.0)
+        label = vocabulary[int(rng.paretovariate(1.2)) % len(vocabulary)]
+        words.append(common.Segment(label, start, end, score))
+        t = end
+    return common.Alignment(words=words)
+
+
+def timed(fn, n_runs):
+    timings = []
+    for _ in range(n_runs):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--words", type=int, default=20_000)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    a = alignment(args.words)
+    as_json = json.dumps(asdict(a)).encode("utf-8")
+    as_bytes = a.to_bytes()
+
+    results = {
+        "json": (
+            as_json,
+            timed(lambda: json.dumps(asdict(a)).encode("utf-8"), args.runs),
+            timed(
+                lambda: common.Alignment.from_dict(json.loads(as_json)),
+                args.runs,
+            ),
+        ),
+        "binary": (
+            as_bytes,
+            timed(a.to_bytes, args.runs),
+            timed(lambda: common.Alignment.from_bytes(as_bytes), args.runs),
+        ),
+        "columns only": (
+            as_bytes,
+            timed(a.to_bytes, args.runs),
+            timed(
+                lambda: common.AlignmentColumns.from_bytes(as_bytes), args.runs
+            ),
+        ),
+    }
+
+    print(f"{args.words} words")
+    print(
+        f"{'format':>13} {'bytes':>9} {'gzipped':>9} "
+        f"{'encode ms':>10} {'decode ms':>10}"
+    )
+    for name, (data, encode_ms, decode_ms) in results.items():
+        print(
+            f"{name:>13} {len(data):>9} {len(gzip.compress(data)):>9} "
+            f"{encode_ms:>10.2f} {decode_ms:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
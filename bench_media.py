@@ -0,0 +1,130 @@
+"""
+Benchmark media range serving: throughput and cpu seconds per GB served, for
+concurrent players that each seek around a file.
+
+    python bench_media.py
+    python bench_media.py --players 32 --megabytes 512
+
+Responses are driven as asgi apps, with a server that writes bodies to
+/dev/null. For the zerocopy run it serves file ranges with os.sendfile, as a
+server that implements the zerocopysend extension would.
+"""
+
+from pathlib import Path
+import argparse
+import asyncio
+import os
+import random
+import time
+
+from starlette.responses import StreamingResponse
+
+import common
+import ranges
+
+
+def legacy_response(path: Path, start: int, end: int):
+    "app.media as it was, reading 1MB chunks in a generator"
+
+    def read():
+        with open(path, "rb") as f:
+            f.seek(start)
+            while (pos := f.tell()) <= end:
+                size = min(ranges.MEDIA_CHUNK_SIZE, end - pos + 1)
+                yield f.read(size)
+
+    return StreamingResponse(read(), status_code=206)
+
+
+def range_response(path: Path, start: int, end: int):
+    headers = {"range": f"bytes={start}-{end}"}
+    return ranges.file_response(path, "audio/mp3", headers)
+
+
+async def serve(response, zerocopy: bool, sink: int) -> int:
+    "Run a response against a server that writes to sink. Returns bytes sent"
+    sent = 0
+
+    async def send(message):
+        nonlocal sent
+        if message["type"] == ranges.ZEROCOPY:
+            offset, count = message["offset"], message["count"]
+            while count:
+                n = os.sendfile(sink, message["file"].fileno(), offset, count)
+                offset, count, sent = offset + n, count - n, sent + n
+        elif message["type"] == "http.response.body":
+            sent += os.write(sink, message.get("body", b""))
+
+    async def receive():
+        # the client never disconnects
+        await asyncio.Event().wait()
+
+    extensions = {ranges.ZEROCOPY: {}} if zerocopy else {}
+    scope = {"type": "http", "method": "GET", "extensions": extensions}
+    await response(scope, receive, send)
+    return sent
+
+
+async def player(path, total, make_response, zerocopy, sink, args, rng):
+    "Seeks to random places and reads a range from each"
+    sent = 0
+    for _ in range(args.seeks):
+        size = args.range_megabytes * 1024 * 1024
+        start = rng.randrange(0, total - size)
+        response = make_response(path, start, start + size - 1)
+        sent += await serve(response, zerocopy, sink)
+    return sent
+
+
+async def run(path, total, make_response, zerocopy, args):
+    rng = random.Random(0)
+    with open(os.devnull, "wb") as f:
+        sink = f.fileno()
+        started, cpu = time.perf_counter(), time.process_time()
+        sent = await asyncio.gather(
+            *[
+                player(path, total, make_response, zerocopy, sink, args, rng)
+                for _ in range(args.players)
+            ]
+        )
+        seconds = time.perf_counter() - started
+        cpu_seconds = time.process_time() - cpu
+    gigabytes = sum(sent) / 1e9
+    return gigabytes / seconds, cpu_seconds / gigabytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--megabytes", type=int, default=256)
+    parser.add_argument("--players", type=int, default=16)
+    parser.add_argument("--seeks", type=int, default=16)
+    parser.add_argument("--range-megabytes", type=int, default=4)
+    args = parser.parse_args()
+
+    with common.tmpdir_scope() as tmp:
+        path = Path(tmp) / "media"
+        with open(path, "wb") as f:
+            for _ in range(args.megabytes):
+                f.write(os.urandom(1024 * 1024))
+        total = path.stat().st_size
+
+        runs = {
+            "before": (legacy_response, False),
+            "pread": (range_response, False),
+            "zerocopy": (range_response, True),
+        }
+
+        print(
+            f"{args.players} players, {args.seeks} seeks of "
+            f"{args.range_megabytes}MB into {args.megabytes}MB"
+        )
+        print(f"{'serving':>9} {'GB/s':>7} {'cpu s/GB':>9}")
+        for name, (make_response, zerocopy) in runs.items():
+            throughput, cpu = asyncio.run(
+                run(path, total, make_response, zerocopy, args)
+            )
+            print(f"{name:>9} {throughput:>7.2f} {cpu:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
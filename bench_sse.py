@@ -0,0 +1,105 @@
+"""
+Benchmark pipeline event streams: wall time and threads used for many
+concurrent clients that each follow a slow pipeline.
+
+    python bench_sse.py
+    python bench_sse.py --clients 500 --events 10 --seconds 0.5
+
+Responses are driven as asgi apps, with a server that discards bodies. The
+before run streams a blocking generator, as app.transcribe did, which
+starlette iterates in its thread pool. The async run streams an async
+generator with heartbeats, as app.transcribe does now.
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+
+from starlette.responses import StreamingResponse
+
+import common
+from pipeline import PipelineProgress
+
+
+def legacy_response(args):
+    "app.transcribe as it was, waiting on stages in a blocking generator"
+
+    def generate():
+        for _ in range(args.events):
+            time.sleep(args.seconds)
+            yield common.dataclass_to_event(PipelineProgress("transcoding"))
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+
+def async_response(args):
+    async def generate():
+        for _ in range(args.events):
+            await asyncio.sleep(args.seconds)
+            yield common.dataclass_to_event(PipelineProgress("transcoding"))
+
+    return StreamingResponse(
+        common.with_heartbeats(generate()), media_type="text/event-stream"
+    )
+
+
+async def serve(response) -> int:
+    "Run a response against a server that discards it. Returns events sent"
+    sent = 0
+
+    async def send(message):
+        nonlocal sent
+        if message["type"] == "http.response.body":
+            sent += message.get("body", b"").count(b"\n\n")
+
+    async def receive():
+        # the client never disconnects
+        await asyncio.Event().wait()
+
+    scope = {"type": "http", "method": "GET", "asgi": {"spec_version": "2.4"}}
+    await response(scope, receive, send)
+    return sent
+
+
+async def run(make_response, args):
+    threads = threading.active_count()
+    peak = threads
+
+    async def sample():
+        nonlocal peak
+        while True:
+            peak = max(peak, threading.active_count())
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample())
+    started = time.perf_counter()
+    sent = await asyncio.gather(
+        *[serve(make_response(args)) for _ in range(args.clients)]
+    )
+    seconds = time.perf_counter() - started
+    sampler.cancel()
+    return seconds, sum(sent), peak - threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--events", type=int, default=5)
+    parser.add_argument("--seconds", type=float, default=0.2)
+    args = parser.parse_args()
+
+    runs = {"before": legacy_response, "async": async_response}
+
+    print(
+        f"{args.clients} clients, {args.events} events "
+        f"{args.seconds}s apart"
+    )
+    print(f"{'stream':>7} {'seconds':>8} {'events':>7} {'threads':>8}")
+    for name, make_response in runs.items():
+        seconds, sent, threads = asyncio.run(run(make_response, args))
+        print(f"{name:>7} {seconds:>8.2f} {sent:>7} {threads:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark Store.select latency and the bytes it sends to the modal Dict, on a
+transcription with 10k aligned words. Also compares the bytes written to disk
+by a title edit through Store.create and Store.update.
+
+    python bench_store.py
+
+The modal Dict is simulated by a dict that pickles values on write, like
+the remote Dict does, and adds a fixed round trip per call.
+"""
+
+from dataclasses import asdict, replace
+from pathlib import Path
+from unittest.mock import patch
+import argparse
+import json
+import pickle
+import statistics
+import time
+
+import common
+
+
+class RemoteDict(dict):
+    "A dict that pickles values and pays a round trip per call"
+
+    def __init__(self, rtt: float):
+        super().__init__()
+        self.rtt = rtt
+        self.bytes_written = 0
+
+    def __setitem__(self, key, value):
+        time.sleep(self.rtt)
+        self.bytes_written += len(pickle.dumps(value))
+        super().__setitem__(key, value)
+
+    def __contains__(self, key):
+        time.sleep(self.rtt)
+        return super().__contains__(key)
+
+
+def legacy_select(store: common.Store, transcription_id: str):
+    "Store.select as it was, writing the whole document back on every read"
+    if transcription_id not in common.transcriptions:
+        return None
+
+    doc = store.backend.read(transcription_id)
+    t = common.Transcription.from_dict(doc)
+    common.transcriptions[transcription_id] = t
+    return t
+
+
+def transcription(media_path: Path, n_words: int):
+    words = [
+        common.Segment(f"word{i % 500}", i * 0.3, i * 0.3 + 0.25, 0.9)
+        for i in range(n_words)
+    ]
+    text = " ".join(w.label for w in words)
+    return common.Transcription(
+        transcription_id="bench",
+        path=str(media_path / "bench"),
+        upload=common.UploadInfo("bench.mp3", "audio/mp3", 1),
+        track=common.Track(title="bench", duration=n_words * 0.3),
+        transcript={
+            "text": text,
+            "language": "en",
+            "segments": [{"id": 0, "start": 0.0, "end": 1.0, "text": text}],
+        },
+        alignment=common.Alignment(words=words),
+        diarization=common.Diarization(turns=[]),
+    )
+
+
+def measure(select, n_runs):
+    writes = common.transcriptions.bytes_written
+    timings = []
+    for _ in range(n_runs):
+        started = time.perf_counter()
+        select("bench")
+        timings.append(time.perf_counter() - started)
+    written = (common.transcriptions.bytes_written - writes) / n_runs
+    return statistics.median(timings) * 1000, written
+
+
+def disk_bytes(write):
+    "Bytes written to the media path by write()"
+    written = []
+
+    def write_atomic(path, content):
+        # alignments are written as binary blobs, everything else as json
+        if isinstance(content, bytes):
+            written.append(len(content))
+        else:
+            written.append(len(content.encode("utf-8")))
+        return common_write_atomic(path, content)
+
+    common_write_atomic = common.write_atomic
+    with patch("common.write_atomic", new=write_atomic):
+        write()
+    return sum(written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--words", type=int, default=10_000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--rtt-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    remote = RemoteDict(args.rtt_ms / 1000)
+    with patch("common.transcriptions", new=remote):
+        with common.tmpdir_scope() as tmp:
+            media_path = Path(tmp)
+            t = transcription(media_path, args.words)
+            common.Store(media_path).create(t)
+            size = len(json.dumps(asdict(t), cls=common.JSONEncoder))
+
+            cold = common.Store(media_path, cache_size=0)
+            warm = common.Store(media_path)
+            warm.select("bench")
+            results = {
+                "before": measure(lambda i: legacy_select(cold, i), args.runs),
+                "after (cold)": measure(cold.select, args.runs),
+                "after (warm)": measure(warm.select, args.runs),
+            }
+
+            track = common.Track(title="renamed")
+            edits = {
+                "create": disk_bytes(lambda: warm.create(replace(t, track=track))),
+                "update": disk_bytes(lambda: warm.update("bench", track=track)),
+            }
+
+    print(f"{args.words} words, {size / 1e6:.2f} MB json, {args.rtt_ms}ms rtt")
+    print(f"{'select':>14} {'median ms':>10} {'dict bytes':>11}")
+    for name, (ms, written) in results.items():
+        print(f"{name:>14} {ms:>10.2f} {written:>11.0f}")
+
+    print(f"{'title edit':>14} {'disk bytes':>10}")
+    for name, written in edits.items():
+        print(f"{name:>14} {written:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark map-reduce transcription against the number of workers.
+
+    python bench_transcribe.py                      # stub model, no gpu needed
+    python bench_transcribe.py --model tiny --audio long.wav
+
+The stub model sleeps for a fixed fraction of the audio duration, standing in
+for a gpu bound whisper model.
+"""
+
+from pathlib import Path
+import argparse
+import functools
+import multiprocessing
+import time
+import wave
+
+import numpy as np
+
+import audio
+import common
+import transcribe
+
+
+def stub_span(args, realtime_factor):
+    audio_file, start, end, language, prompt = args
+    seconds = (end - start) / 16000
+    time.sleep(seconds * realtime_factor)
+    return {
+        "text": " stub.",
+        "language": language or "en",
+        "segments": [{"id": 0, "seek": 0, "start": 0.0, "end": seconds}],
+    }
+
+
+def whisper_span(args, model_name):
+    audio_file, start, end, language, prompt = args
+    return transcribe.transcribe_samples(
+        audio_file, start, end, language, prompt, model_name=model_name
+    )
+
+
+def synthesize(path: Path, seconds: int, sample_rate=16000):
+    "Noise bursts with short gaps, so that there are silences to split at"
+    rng = np.random.default_rng(0)
+    samples = rng.normal(0, 3000, seconds * sample_rate).astype(np.int16)
+    for gap in range(0, seconds, 7):
+        samples[gap * sample_rate : gap * sample_rate + sample_rate // 2] = 0
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+
+def warm(_):
+    return None
+
+
+def run(audio_file, n_workers, chunk_seconds, span_fn):
+    samples, sample_rate = audio.read_wav(audio_file)
+    spans = audio.split_at_silence(samples, sample_rate, chunk_seconds)
+    with multiprocessing.get_context("spawn").Pool(n_workers) as pool:
+        # process start up is a one off per container, so keep it out
+        pool.map(warm, range(n_workers))
+        started = time.monotonic()
+        *_, transcript = transcribe.map_spans(
+            str(audio_file),
+            spans,
+            sample_rate,
+            "en",
+            None,
+            functools.partial(pool.imap, span_fn),
+        )
+        return time.monotonic() - started, len(spans)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--audio", type=Path, help="16khz mono wav")
+    parser.add_argument("--model", help="whisper model, e.g. tiny")
+    parser.add_argument("--seconds", type=int, default=1200)
+    parser.add_argument("--chunk-seconds", type=int, default=60)
+    parser.add_argument("--realtime-factor", type=float, default=0.005)
+    parser.add_argument("--workers", default="1,2,4,8")
+    args = parser.parse_args()
+
+    if args.model:
+        span_fn = functools.partial(whisper_span, model_name=args.model)
+    else:
+        span_fn = functools.partial(
+            stub_span, realtime_factor=args.realtime_factor
+        )
+
+    with common.tmpdir_scope() as tmp:
+        audio_file = args.audio
+        if not audio_file:
+            audio_file = Path(tmp) / "bench.wav"
+            synthesize(audio_file, args.seconds)
+
+        baseline = None
+        print(f"{'workers':>8} {'spans':>6} {'seconds':>9} {'speedup':>8}")
+        for n_workers in map(int, args.workers.split(",")):
+            seconds, n_spans = run(
+                audio_file, n_workers, args.chunk_seconds, span_fn
+            )
+            baseline = baseline or seconds
+            print(
+                f"{n_workers:>8} {n_spans:>6} {seconds:>9.2f} "
+                f"{baseline / seconds:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
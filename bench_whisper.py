@@ -0,0 +1,89 @@
+"""
+Benchmark the latency of single transcriptions, in a spawned process per
+request as before, against the in process runner with a resident model.
+
+    python bench_whisper.py
+    python bench_whisper.py --model large-v2 --audio fixtures/one.wav -n 10
+
+The first in process request loads the model, which later requests find
+already loaded, as they would in a warm container.
+"""
+
+from pathlib import Path
+import argparse
+import multiprocessing
+import statistics
+import time
+
+import asr
+import common
+import transcribe
+
+
+def spawned_worker(q, audio_file, device, language, model_name):
+    "transcribe.transcribe as it was: a fresh process, torch and model"
+    import whisper
+
+    model = whisper.load_model(model_name, device=device)
+    q.put(
+        model.transcribe(
+            audio_file,
+            language=language,
+            fp16=device.startswith("cuda"),
+            verbose=None,
+        )
+    )
+
+
+def spawned(audio_file, device, language, model_name):
+    ctx = multiprocessing.get_context("spawn")
+    q = ctx.Queue()
+    process = ctx.Process(
+        target=spawned_worker,
+        args=(q, audio_file, device, language, model_name),
+    )
+    process.start()
+    transcript = q.get()
+    process.join()
+    return transcript
+
+
+def in_process(audio_file, device, language, model_name):
+    transcript = None
+    options = asr.AsrOptions(model=model_name)
+    for update in transcribe.whisper_runner.run(
+        transcribe.worker, audio_file, device, language, None, options
+    ):
+        if isinstance(update, Exception):
+            raise update
+        if isinstance(update, dict):
+            transcript = update
+    return transcript
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--audio", type=Path, default="fixtures/one.wav")
+    parser.add_argument("--model", default="tiny")
+    parser.add_argument("--language", default="en")
+    parser.add_argument("-n", type=int, default=5, help="requests per run")
+    args = parser.parse_args()
+
+    device = common.get_device()
+    runs = {"spawned": spawned, "inprocess": in_process}
+
+    print(f"{args.n} requests of {args.audio} on {args.model} ({device})")
+    print(f"{'runner':>10} {'first s':>8} {'median s':>9} {'text':>6}")
+    for name, run in runs.items():
+        seconds = []
+        for _ in range(args.n):
+            started = time.perf_counter()
+            transcript = run(str(args.audio), device, args.language, args.model)
+            seconds.append(time.perf_counter() - started)
+        median = statistics.median(seconds[1:] or seconds)
+        text = transcript["text"].strip()
+        print(f"{name:>10} {seconds[0]:>8.2f} {median:>9.2f} {text:>6}")
+
+
+if __name__ == "__main__":
+    main()
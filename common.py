@@ -1,12 +1,25 @@
-from dataclasses import dataclass, asdict, field
+from array import array
+import asyncio
+from dataclasses import dataclass, asdict, field, fields, is_dataclass, replace
 import inspect
 from pathlib import Path
+import collections
 import contextlib
+import csv
+import itertools
 import json
 import logging
+import math
+import os
 import shutil
+import sqlite3
+import struct
+import sys
 import tempfile
+import threading
+import time
 import typing
+import uuid
 
 from modal import App, Dict, NetworkFileSystem
 
@@ -21,6 +34,19 @@ LANGUAGE = "en"
 # fixed english whisper model for now
 MODEL_NAME = "large-v2"
 
+# length of streamed audio chunks. whisper's native window
+CHUNK_SECONDS = 30
+
+# number of parsed transcriptions kept in memory per container
+CACHE_SIZE = 64
+
+# seconds of silence on an event stream before a heartbeat is sent
+HEARTBEAT_SECONDS = 15
+
+# sqlite database of the sqlite backend, unless SQLITE_PATH is set. on local
+# disk, since sqlite locking does not work over nfs
+SQLITE_PATH = Path("/tmp/transcriptions.sqlite")
+
 # main storage volume
 volume = NetworkFileSystem.from_name("media")
 
@@ -49,6 +75,10 @@ class UploadInfo:
     filename: str = None
     content_type: str = None
     size_bytes: int = None
+    # set for parallel uploads, which may send chunks in any order
+    chunk_size: int = None
+    # content hash, once the upload is complete
+    media_hash: str = None
 
     def from_dict(d):
         return UploadInfo(
@@ -119,6 +149,7 @@ class Diarization:
     turns: typing.List[Turn]
 
     def from_dict(d):
+        d = d | {"turns": [Turn(**x) for x in d.get("turns") or []]}
         return Diarization(
             **{
                 k: v
@@ -162,6 +193,142 @@ class Alignment:
             }
         )
 
+    def from_bytes(data: bytes):
+        return Alignment(words=AlignmentColumns.from_bytes(data).words())
+
+    def to_bytes(self) -> bytes:
+        return AlignmentColumns.from_words(self.words).to_bytes()
+
+
+class AlignmentError(Exception):
+    pass
+
+
+# binary alignment: magic, version, reserved, words, labels, label bytes
+ALIGNMENT_HEADER = struct.Struct("<4sHHIII")
+ALIGNMENT_MAGIC = b"TTAL"
+ALIGNMENT_VERSION = 1
+
+
+@dataclass
+class AlignmentColumns:
+    """
+    A word alignment stored column wise, with each distinct label stored
+    once. Times and scores are float32, which is accurate to about half a
+    millisecond two hours in.
+
+    The binary encoding is little endian: the header, then label offsets,
+    label ids, starts, ends and scores as 4 byte arrays, then the utf-8
+    label table. Every array is 4 byte aligned, so that clients can view it
+    in place.
+    """
+
+    # distinct labels, in order of first use
+    labels: typing.List[str] = field(default_factory=list)
+    # index into labels, per word
+    label_ids: array = field(default_factory=lambda: array("I"))
+    # time in seconds, per word
+    starts: array = field(default_factory=lambda: array("f"))
+    # time in seconds, per word
+    ends: array = field(default_factory=lambda: array("f"))
+    # likelihood of the alignment, per word. nan if unknown
+    scores: array = field(default_factory=lambda: array("f"))
+
+    def from_words(words: typing.List[typing.Union[Segment, dict]]):
+        rows = [
+            (w["label"], w["start"], w["end"], w["score"])
+            if isinstance(w, dict)
+            else (w.label, w.start, w.end, w.score)
+            for w in words
+        ]
+
+        interned = {}
+        label_ids = [interned.setdefault(r[0], len(interned)) for r in rows]
+        return AlignmentColumns(
+            labels=list(interned),
+            label_ids=array("I", label_ids),
+            starts=array("f", [r[1] for r in rows]),
+            ends=array("f", [r[2] for r in rows]),
+            scores=array(
+                "f", [r[3] if r[3] is not None else math.nan for r in rows]
+            ),
+        )
+
+    def words(self) -> typing.List[Segment]:
+        # round off float32 noise in times, as the frontend does for seeking
+        labels = self.labels
+        return [
+            Segment(
+                labels[i],
+                round(start, 6),
+                round(end, 6),
+                score if score == score else None,
+            )
+            for i, start, end, score in zip(
+                self.label_ids, self.starts, self.ends, self.scores
+            )
+        ]
+
+    def to_bytes(self) -> bytes:
+        encoded = [label.encode("utf-8") for label in self.labels]
+        offsets = array("I", itertools.accumulate(map(len, encoded), initial=0))
+        columns = [offsets, self.label_ids, self.starts, self.ends, self.scores]
+        if sys.byteorder == "big":
+            columns = [array(c.typecode, c) for c in columns]
+            for c in columns:
+                c.byteswap()
+
+        text = b"".join(encoded)
+        header = ALIGNMENT_HEADER.pack(
+            ALIGNMENT_MAGIC,
+            ALIGNMENT_VERSION,
+            0,
+            len(self.label_ids),
+            len(self.labels),
+            len(text),
+        )
+        return b"".join([header] + [c.tobytes() for c in columns] + [text])
+
+    def from_bytes(data: bytes):
+        if len(data) < ALIGNMENT_HEADER.size:
+            raise AlignmentError("truncated header")
+
+        magic, version, _, n_words, n_labels, n_text = (
+            ALIGNMENT_HEADER.unpack_from(data)
+        )
+        if magic != ALIGNMENT_MAGIC:
+            raise AlignmentError("not a binary alignment")
+        if version != ALIGNMENT_VERSION:
+            raise AlignmentError(f"unsupported version {version}")
+
+        size = ALIGNMENT_HEADER.size + 4 * (n_labels + 1 + 4 * n_words) + n_text
+        if len(data) != size:
+            raise AlignmentError(f"expected {size} bytes, got {len(data)}")
+
+        view = memoryview(data)[ALIGNMENT_HEADER.size :]
+        columns = []
+        for typecode, n in [("I", n_labels + 1), ("I", n_words)] + [
+            ("f", n_words)
+        ] * 3:
+            column = array(typecode)
+            column.frombytes(view[: 4 * n])
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns.append(column)
+            view = view[4 * n :]
+
+        offsets, label_ids, starts, ends, scores = columns
+        text = bytes(view)
+        return AlignmentColumns(
+            labels=[
+                text[a:b].decode("utf-8") for a, b in zip(offsets, offsets[1:])
+            ],
+            label_ids=label_ids,
+            starts=starts,
+            ends=ends,
+            scores=scores,
+        )
+
 
 @dataclass
 class Transcription:
@@ -196,6 +363,9 @@ class Transcription:
     # source language
     language: str = None
 
+    # fingerprint of the inputs that each pipeline stage last completed with
+    stages: dict = None
+
     @property
     def transcribed(self):
         return self.transcript is not None
@@ -212,11 +382,67 @@ class Transcription:
     def transcribed_file(self):
         return self.uploaded_file.with_suffix(".json")
 
+    @property
+    def transcoded_chunks_path(self):
+        return self.uploaded_file.with_suffix(".chunks")
+
+    @property
+    def peaks_file(self):
+        return self.uploaded_file.with_suffix(".peaks")
+
+    @property
+    def speech_file(self):
+        return self.uploaded_file.with_suffix(".speech.wav")
+
+    @property
+    def speech_map_file(self):
+        return self.uploaded_file.with_suffix(".speech.json")
+
+    @property
+    def jobs_path(self):
+        return self.uploaded_file.with_suffix(".jobs")
+
+    @property
+    def audio_proxy_file(self):
+        return self.uploaded_file.with_suffix(".proxy.m4a")
+
+    @property
+    def video_proxy_file(self):
+        return self.uploaded_file.with_suffix(".proxy.mp4")
+
     @property
     def content_type(self):
         if self.upload:
             return self.upload.content_type
 
+    def window(self, start: float = None, end: float = None):
+        """
+        A copy with only the transcript segments, words and speaker turns
+        that overlap start to end, in seconds. Either bound may be left open.
+        """
+
+        def clip(items):
+            return [x for x in items if overlaps(x, start, end)]
+
+        transcript = self.transcript
+        if isinstance(transcript, dict) and "segments" in transcript:
+            transcript = transcript | {"segments": clip(transcript["segments"])}
+
+        alignment = self.alignment
+        if alignment:
+            alignment = replace(alignment, words=clip(alignment.words))
+
+        diarization = self.diarization
+        if diarization:
+            diarization = replace(diarization, turns=clip(diarization.turns))
+
+        return replace(
+            self,
+            transcript=transcript,
+            alignment=alignment,
+            diarization=diarization,
+        )
+
     def from_dict(d: dict):
         track = Track()
         if "track" in d and d["track"]:
@@ -244,51 +470,737 @@ class Transcription:
             transcript=d.get("transcript", {}),
             path=d.get("path"),
             language=d.get("language"),
+            stages=d.get("stages"),
         )
 
 
+def overlaps(item, start: float = None, end: float = None) -> bool:
+    "Whether a segment, word or turn overlaps start to end"
+    if isinstance(item, dict):
+        item_start, item_end = float(item["start"]), float(item["end"])
+    else:
+        item_start, item_end = item.start, item.end
+    if start is not None and item_end <= start:
+        return False
+    if end is not None and item_start >= end:
+        return False
+    return True
+
+
+@dataclass
+class Chunk:
+    """
+    A fixed length piece of transcoded audio
+    """
+
+    # wav file of this chunk
+    path: Path
+    # time in seconds
+    start: float
+    # time in seconds
+    end: float
+
+
+class ChunkError(Exception):
+    pass
+
+
+class ChunkedAudio:
+    """
+    Fixed length pcm chunks of a transcoded file. The transcoder writes these
+    next to the full wav and appends each chunk to an index as soon as it is
+    complete, so that consumers can start before transcoding has finished.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    @property
+    def index_file(self):
+        return self.path / "chunks.csv"
+
+    @property
+    def manifest_file(self):
+        return self.path / "manifest.json"
+
+    @property
+    def chunk_pattern(self):
+        return self.path / "%05d.wav"
+
+    def start(self, duration: float, chunk_seconds: int):
+        self.clear()
+        self.path.mkdir(parents=True)
+        self.write_manifest(
+            duration=duration, chunk_seconds=chunk_seconds, state="running"
+        )
+
+    def clear(self):
+        """
+        Remove the chunks of an earlier run, so that a follower started
+        before the transcoder waits for the new run rather than reading the
+        completed old one.
+        """
+
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def finish(self, error: str = None):
+        manifest = self.manifest()
+        if error:
+            self.write_manifest(**manifest | {"state": "error", "error": error})
+        else:
+            self.write_manifest(**manifest | {"state": "completed"})
+
+    def write_manifest(self, **manifest):
+        write_atomic(self.manifest_file, json.dumps(manifest))
+
+    def manifest(self) -> typing.Optional[dict]:
+        if not self.manifest_file.exists():
+            return None
+        with open(self.manifest_file, "r") as f:
+            return json.load(f)
+
+    def chunks(self) -> typing.List[Chunk]:
+        if not self.index_file.exists():
+            return []
+
+        chunks = []
+        with open(self.index_file, "r", newline="") as f:
+            for row in csv.reader(f):
+                # the last line may still be being written
+                if len(row) != 3:
+                    break
+                filename, start, end = row
+                chunks.append(
+                    Chunk(self.path / filename, float(start), float(end))
+                )
+
+        return chunks
+
+    def follow(self, poll_seconds: float = 0.5, idle_timeout: float = 300):
+        """
+        Yield chunks as they are completed, until the transcoder is done.
+        """
+
+        n_seen = 0
+        last_seen = time.monotonic()
+        while True:
+            # read the manifest before the index, so that no chunks are lost
+            # when the transcoder completes in between the two reads
+            manifest = self.manifest() or {}
+            chunks = self.chunks()
+            yield from chunks[n_seen:]
+            if len(chunks) > n_seen:
+                n_seen = len(chunks)
+                last_seen = time.monotonic()
+
+            match manifest.get("state"):
+                case "completed":
+                    return
+                case "error":
+                    raise ChunkError(f"transcoding failed: {manifest['error']}")
+
+            if time.monotonic() - last_seen > idle_timeout:
+                raise ChunkError(f"no chunks after {idle_timeout}s")
+
+            time.sleep(poll_seconds)
+
+
 # Modal abstractions
 #
 #
 
 
+class LRUCache:
+    """
+    Size bounded cache. Each entry carries a stamp, and a lookup only hits if
+    the current stamp still matches the stored one. Stamps are computed
+    lazily, only for keys that are in the cache.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get(self, key, stamp: typing.Callable):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            cached_stamp, value = self.entries[key]
+            if cached_stamp != stamp():
+                del self.entries[key]
+                self.misses += 1
+                self.stale += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, stamp, value):
+        with self.lock:
+            self.entries[key] = (stamp, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def modify(self, key, stamp, new_stamp, fn: typing.Callable):
+        "Apply fn to the entry for key, if its stamp is still stamp"
+        with self.lock:
+            if key in self.entries and self.entries[key][0] == stamp:
+                self.entries[key] = (new_stamp, fn(self.entries[key][1]))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+            }
+
+
+class StoreError(Exception):
+    pass
+
+
+# fields that can grow to megabytes, and are stored apart from the rest. by
+# file extension
+BLOB_FIELDS = {"transcript": "json", "alignment": "bin", "diarization": "json"}
+
+
+class FileBackend:
+    """
+    Stores each transcription as a json sidecar next to its media. Large
+    fields live in blobs of their own, so that updating a small field like
+    the track doesn't rewrite the transcript and alignment.
+    """
+
+    def __init__(self, media_path: Path):
+        self.media_path = Path(media_path)
+
+    def meta_file(self, transcription_id: str) -> Path:
+        return self.media_path / f"{transcription_id}.json"
+
+    def blob_file(self, transcription_id: str, field: str) -> Path:
+        extension = BLOB_FIELDS[field]
+        return self.media_path / f"{transcription_id}.{field}.{extension}"
+
+    def exists(self, transcription_id: str) -> bool:
+        # guard against path traversal attacks
+        if "/" in transcription_id or transcription_id.startswith("."):
+            return False
+        return self.meta_file(transcription_id).exists()
+
+    def stamp(self, transcription_id: str):
+        # the meta file is rewritten on every write, blobs or not
+        return file_stamp(self.meta_file(transcription_id))
+
+    def read(self, transcription_id: str) -> typing.Optional[dict]:
+        meta = self.meta_file(transcription_id)
+        if not meta.exists():
+            raise StoreError(f"id not found")
+
+        with open(meta, "r") as f:
+            doc = json.load(f)
+
+        # older documents keep large fields inline
+        for field in BLOB_FIELDS:
+            blob = self.blob_file(transcription_id, field)
+            if blob.exists():
+                doc[field] = decode_field(blob.read_bytes())
+            else:
+                doc.setdefault(field, None)
+
+        return doc
+
+    def write(self, transcription_id: str, doc: dict):
+        self.write_blobs(transcription_id, doc)
+        self.write_meta(transcription_id, doc)
+
+    def update(self, transcription_id: str, changes: dict):
+        with open(self.meta_file(transcription_id), "r") as f:
+            doc = json.load(f)
+
+        self.write_blobs(transcription_id, inline_blobs(doc) | changes)
+        self.write_meta(transcription_id, doc | changes)
+
+    def write_many(self, docs: typing.Dict[str, dict]):
+        for transcription_id, doc in docs.items():
+            self.write(transcription_id, doc)
+
+    def write_meta(self, transcription_id: str, doc: dict):
+        small = {k: v for k, v in doc.items() if k not in BLOB_FIELDS}
+        content = json.dumps(small, cls=JSONEncoder)
+        write_atomic(self.meta_file(transcription_id), content)
+
+    def write_blobs(self, transcription_id: str, doc: dict):
+        for field in BLOB_FIELDS:
+            if field not in doc:
+                continue
+
+            blob = self.blob_file(transcription_id, field)
+            if doc[field] is None:
+                blob.unlink(missing_ok=True)
+            else:
+                write_atomic(blob, encode_field(field, doc[field]))
+
+    def share(self, source_id: str, target_id: str, names: typing.List[str]):
+        "Blobs are hard linked, so that both documents refer to one file"
+        with open(self.meta_file(source_id), "r") as f:
+            source = json.load(f)
+        with open(self.meta_file(target_id), "r") as f:
+            doc = json.load(f)
+
+        for name in names:
+            if name not in BLOB_FIELDS:
+                doc[name] = source.get(name)
+            elif self.blob_file(source_id, name).exists():
+                blob = self.blob_file(source_id, name)
+                link_file(blob, self.blob_file(target_id, name))
+            else:
+                # older documents keep large fields inline
+                self.write_blobs(target_id, {name: source.get(name)})
+
+        # move the inline fields of the target out, before they are dropped
+        kept = {k: v for k, v in inline_blobs(doc).items() if k not in names}
+        self.write_blobs(target_id, kept)
+        self.write_meta(target_id, doc)
+
+    def artifact_file(self, key: str) -> Path:
+        return self.media_path / "artifacts" / key
+
+    def read_artifact(
+        self, key: str
+    ) -> typing.Optional[typing.Tuple[str, typing.Optional[str]]]:
+        path = self.artifact_file(key)
+        if not path.exists():
+            return None
+
+        # older entries hold just the id
+        content = path.read_text()
+        if not content.startswith("{"):
+            return content, None
+        entry = json.loads(content)
+        return entry["transcription_id"], entry["fingerprint"]
+
+    def write_artifact(
+        self, key: str, transcription_id: str, fingerprint: str = None
+    ):
+        path = self.artifact_file(key)
+        path.parent.mkdir(exist_ok=True)
+        entry = {"transcription_id": transcription_id}
+        write_atomic(path, json.dumps(entry | {"fingerprint": fingerprint}))
+
+
+def inline_blobs(doc: dict) -> dict:
+    "Large fields that older meta files keep inline, rather than in blobs"
+    return {k: doc[k] for k in BLOB_FIELDS if doc.get(k) is not None}
+
+
+class ModalBackend(FileBackend):
+    """
+    Json sidecars on the network file system, plus a small existence record
+    per id in a modal Dict.
+    """
+
+    def exists(self, transcription_id: str) -> bool:
+        return transcription_id in transcriptions
+
+    def write(self, transcription_id: str, doc: dict):
+        super().write(transcription_id, doc)
+
+        # the dict only records existence. the document lives on the volume
+        transcriptions[transcription_id] = {"version": time.time_ns()}
+
+
+class SQLiteBackend:
+    """
+    Stores transcriptions in a local sqlite database in WAL mode, with one
+    column per field, encoded like the file blobs. Updates only touch the
+    columns that changed. Needs a local disk, since sqlite locking does not
+    work over nfs.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.local = threading.local()
+        self.columns = [f.name for f in fields(Transcription)]
+        with self.connection() as conn:
+            columns = ", ".join(f"{c} TEXT" for c in self.columns[1:])
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS transcriptions ("
+                "transcription_id TEXT PRIMARY KEY, "
+                f"version INTEGER NOT NULL, {columns})"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS artifacts ("
+                "key TEXT PRIMARY KEY, transcription_id TEXT NOT NULL, "
+                "fingerprint TEXT)"
+            )
+
+            # databases from before a field was added
+            existing = {
+                row[1]
+                for row in conn.execute("PRAGMA table_info(transcriptions)")
+            }
+            for column in self.columns[1:]:
+                if column not in existing:
+                    conn.execute(
+                        f"ALTER TABLE transcriptions ADD COLUMN {column} TEXT"
+                    )
+
+            # and from before artifacts recorded their fingerprint
+            existing = {
+                row[1] for row in conn.execute("PRAGMA table_info(artifacts)")
+            }
+            if "fingerprint" not in existing:
+                conn.execute(
+                    "ALTER TABLE artifacts ADD COLUMN fingerprint TEXT"
+                )
+
+    def connection(self) -> sqlite3.Connection:
+        # connections can't be shared between threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def exists(self, transcription_id: str) -> bool:
+        return self.stamp(transcription_id) is not None
+
+    def stamp(self, transcription_id: str):
+        row = (
+            self.connection()
+            .execute(
+                "SELECT version FROM transcriptions WHERE transcription_id = ?",
+                (transcription_id,),
+            )
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def read(self, transcription_id: str) -> typing.Optional[dict]:
+        columns = ", ".join(self.columns)
+        row = (
+            self.connection()
+            .execute(
+                f"SELECT {columns} FROM transcriptions "
+                "WHERE transcription_id = ?",
+                (transcription_id,),
+            )
+            .fetchone()
+        )
+        if not row:
+            raise StoreError(f"id not found")
+
+        transcription_id, *values = row
+        return {"transcription_id": transcription_id} | {
+            c: decode_field(v) if v is not None else None
+            for c, v in zip(self.columns[1:], values)
+        }
+
+    def write(self, transcription_id: str, doc: dict):
+        self.write_many({transcription_id: doc})
+
+    def update(self, transcription_id: str, changes: dict):
+        self.check_columns(changes)
+        assignments = ", ".join(f"{c} = ?" for c in changes)
+        with self.connection() as conn:
+            cursor = conn.execute(
+                f"UPDATE transcriptions SET version = version + 1, "
+                f"{assignments} WHERE transcription_id = ?",
+                [self.encode(c, v) for c, v in changes.items()]
+                + [transcription_id],
+            )
+            if cursor.rowcount == 0:
+                raise StoreError(f"id not found")
+
+    def write_many(self, docs: typing.Dict[str, dict]):
+        columns = ["transcription_id", "version"] + self.columns[1:]
+        rows = []
+        for transcription_id, doc in docs.items():
+            self.check_columns(doc)
+            values = [self.encode(c, doc.get(c)) for c in self.columns[1:]]
+            rows.append([transcription_id, time.time_ns()] + values)
+
+        # one transaction for the whole batch
+        with self.connection() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO transcriptions ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' for _ in columns)})",
+                rows,
+            )
+
+    def share(self, source_id: str, target_id: str, names: typing.List[str]):
+        "Columns are copied within the database, without decoding them"
+        self.check_columns(dict.fromkeys(names))
+        assignments = ", ".join(
+            f"{c} = (SELECT {c} FROM transcriptions WHERE transcription_id = ?)"
+            for c in names
+        )
+        with self.connection() as conn:
+            cursor = conn.execute(
+                f"UPDATE transcriptions SET version = version + 1, "
+                f"{assignments} WHERE transcription_id = ?",
+                [source_id] * len(names) + [target_id],
+            )
+            if cursor.rowcount == 0:
+                raise StoreError(f"id not found")
+
+    def read_artifact(
+        self, key: str
+    ) -> typing.Optional[typing.Tuple[str, typing.Optional[str]]]:
+        row = (
+            self.connection()
+            .execute(
+                "SELECT transcription_id, fingerprint FROM artifacts "
+                "WHERE key = ?",
+                (key,),
+            )
+            .fetchone()
+        )
+        return tuple(row) if row else None
+
+    def write_artifact(
+        self, key: str, transcription_id: str, fingerprint: str = None
+    ):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO artifacts "
+                "(key, transcription_id, fingerprint) VALUES (?, ?, ?)",
+                (key, transcription_id, fingerprint),
+            )
+
+    def check_columns(self, doc: dict):
+        unknown = set(doc) - set(self.columns)
+        if unknown:
+            raise StoreError(f"unknown fields: {unknown}")
+
+    def encode(self, column: str, value):
+        return encode_field(column, value) if value is not None else None
+
+
+def backend_from_env(media_path: Path):
+    """
+    Select the storage backend with STORE_BACKEND. Defaults to modal, while
+    file and sqlite run on a single box without any modal services. The
+    sqlite database is at SQLITE_PATH.
+    """
+
+    match os.getenv("STORE_BACKEND", "modal"):
+        case "modal":
+            return ModalBackend(media_path)
+        case "file":
+            return FileBackend(media_path)
+        case "sqlite":
+            return SQLiteBackend(os.getenv("SQLITE_PATH", SQLITE_PATH))
+        case x:
+            raise StoreError(f"unknown store backend: {x}")
+
+
 class Store:
     """Keep a data layer here so we can move it out of modal later."""
 
-    def __init__(self, media_path: Path):
+    def __init__(
+        self, media_path: Path, cache_size: int = CACHE_SIZE, backend=None
+    ):
         self.media_path = media_path
+        self.backend = backend or ModalBackend(media_path)
+        self.cache = LRUCache(cache_size)
 
     def create(self, t: Transcription):
-        if not t.transcription_id:
-            raise Exception(f"id not specified")
+        self.create_many([t])
+
+    def create_many(self, ts: typing.List[Transcription]):
+        for t in ts:
+            if not t.transcription_id:
+                raise StoreError(f"id not specified")
+
+        self.backend.write_many({t.transcription_id: asdict(t) for t in ts})
+
+        # write through, as it reads back. that is also a copy, since callers
+        # keep modifying their instance
+        for t in ts:
+            stamp = self.backend.stamp(t.transcription_id)
+            self.cache.put(t.transcription_id, stamp, read_back(t))
+
+    def update(self, transcription_id: str, **changes):
+        """
+        Write only the given fields of a transcription, e.g. only its track.
+        """
 
-        transcriptions[t.transcription_id] = t
-        content = json.dumps(asdict(t), cls=JSONEncoder)
-        with open(t.transcribed_file, "w") as f:
-            f.write(content)
+        if not transcription_id:
+            raise StoreError(f"id not specified")
+
+        before = self.backend.stamp(transcription_id)
+        self.backend.update(
+            transcription_id,
+            {
+                k: asdict(v) if is_dataclass(v) else v
+                for k, v in changes.items()
+            },
+        )
+
+        # apply to the cached copy, if it was current before the update
+        after = self.backend.stamp(transcription_id)
+        self.cache.modify(
+            transcription_id, before, after, lambda t: replace(t, **changes)
+        )
+
+    def share(self, source: Transcription, target_id: str, *names: str):
+        """
+        Give a transcription the fields of another one, e.g. the transcript
+        of an earlier upload of the same media. Large fields are shared by
+        reference where the backend can.
+        """
+
+        before = self.backend.stamp(target_id)
+        self.backend.share(source.transcription_id, target_id, list(names))
+        after = self.backend.stamp(target_id)
+        changes = {name: getattr(source, name) for name in names}
+        self.cache.modify(
+            target_id, before, after, lambda t: replace(t, **changes)
+        )
+
+    def find_artifact(
+        self, key: str, stage: str = None, fingerprint: str = None
+    ) -> typing.Optional[Transcription]:
+        """
+        The transcription that holds the result for a stage key, if any.
+        Given a stage, only a transcription whose stage still completed with
+        the fingerprint of the entry is returned, or with fingerprint, for
+        entries that don't record one. Transcriptions move on when they are
+        re-run with other inputs, and their index entries are stale then.
+        """
+
+        entry = self.backend.read_artifact(key)
+        if not entry:
+            return None
+
+        transcription_id, held = entry
+        t = self.select(transcription_id)
+        if t and stage and (t.stages or {}).get(stage) != (held or fingerprint):
+            return None
+        return t
+
+    def add_artifact(
+        self, key: str, transcription_id: str, fingerprint: str = None
+    ):
+        "Index a result. fingerprint is that of the stage, if not the key's"
+        self.backend.write_artifact(key, transcription_id, fingerprint)
 
     def select(self, transcription_id: str) -> typing.Optional[Transcription]:
         if not transcription_id:
-            raise Exception(f"id not specified")
+            raise StoreError(f"id not specified")
+
+        # only ids that passed the guard below are ever cached
+        t = self.cache.get(
+            transcription_id, lambda: self.backend.stamp(transcription_id)
+        )
+        if t:
+            return shallow_copy(t)
 
         # guard against path traversal attacks
-        if transcription_id not in transcriptions:
+        if not self.backend.exists(transcription_id):
             return None
 
-        path = self.media_path / transcription_id
-        meta = path.with_suffix(".json")
-        if not meta.exists():
-            raise Exception(f"id not found")
+        # stamp before reading, so a concurrent write is never cached
+        stamp = self.backend.stamp(transcription_id)
+        t = Transcription.from_dict(self.backend.read(transcription_id))
+        self.cache.put(transcription_id, stamp, t)
+        return shallow_copy(t)
 
-        with open(meta, "r") as f:
-            t_dict = json.load(f)
-            t = Transcription.from_dict(t_dict)
-            transcriptions[transcription_id] = t
-            return t
+
+def shallow_copy(t: Transcription) -> Transcription:
+    """
+    A copy of a cached transcription that callers can modify, apart from
+    its large fields. Those are shared with the cache, and are replaced
+    rather than modified in place, e.g. with replace(t, transcript=...).
+    """
+
+    return replace(
+        t,
+        track=t.track and replace(t.track),
+        upload=t.upload and replace(t.upload),
+        stages=t.stages and dict(t.stages),
+    )
+
+
+def read_back(t: Transcription) -> Transcription:
+    """
+    A transcription as a backend reads it back after writing it, e.g. with
+    the single precision times of encoded alignments.
+    """
+
+    return Transcription.from_dict(
+        {
+            k: v if v is None else decode_field(encode_field(k, v))
+            for k, v in asdict(t).items()
+        }
+    )
+
+
+def encode_field(name: str, value) -> typing.Union[str, bytes]:
+    "Alignments are stored in their binary encoding, everything else as json"
+    if name == "alignment":
+        return AlignmentColumns.from_words(value.get("words") or []).to_bytes()
+    return json.dumps(value, cls=JSONEncoder)
+
+
+def decode_field(data: typing.Union[str, bytes]):
+    if isinstance(data, bytes) and data.startswith(ALIGNMENT_MAGIC):
+        return {"words": AlignmentColumns.from_bytes(data).words()}
+    return json.loads(data)
+
+
+def write_atomic(path: Path, content: typing.Union[str, bytes]):
+    """
+    Write to a temporary file and rename it into place. Readers never see a
+    partial file, and every write produces a new inode.
+    """
+
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp, "wb" if isinstance(content, bytes) else "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def link_file(source: Path, target: Path):
+    """
+    Hard link source to target, replacing target. Both names then refer to
+    one file, which is never copied.
+    """
+
+    tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+    os.link(source, tmp)
+    os.replace(tmp, target)
+
+
+def file_stamp(path: Path):
+    """
+    Identifies a version of a file on the volume. Files are replaced rather
+    than rewritten in place, so the inode changes on every write, in this or
+    any other container, even when mtime resolution is coarse.
+    """
+
+    try:
+        stat = path.stat()
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
 
 
 # store on nfs
-db = Store(MEDIA_PATH)
+db = Store(MEDIA_PATH, backend=backend_from_env(MEDIA_PATH))
 
 
 # whisper gpt
@@ -306,6 +1218,41 @@ def dataclass_to_event(x):
     return f"event: {type(x).__name__}\ndata: {data}\n\n"
 
 
+@dataclass
+class Heartbeat:
+    pass
+
+
+async def with_heartbeats(
+    events: typing.AsyncIterator[str], seconds: float = HEARTBEAT_SECONDS
+):
+    """
+    Pass on server sent events, and a heartbeat after every silence of
+    seconds. Keeps proxies from closing the stream during long stages, and
+    lets clients tell a slow stage from a dead connection.
+    """
+
+    pending = None
+    try:
+        while True:
+            # a timeout must not cancel the event that is being waited for
+            pending = pending or asyncio.ensure_future(events.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=seconds)
+            if not done:
+                yield dataclass_to_event(Heartbeat())
+                continue
+
+            try:
+                event = pending.result()
+            except StopAsyncIteration:
+                return
+            pending = None
+            yield event
+    finally:
+        if pending:
+            pending.cancel()
+
+
 def get_device():
     import torch
 
@@ -325,4 +1272,6 @@ class JSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Path):
             return str(obj)
+        if is_dataclass(obj):
+            return asdict(obj)
         return json.JSONEncoder.default(self, obj)
@@ -1,4 +1,7 @@
+from dataclasses import fields, is_dataclass
+import json
 import textwrap
+import typing
 
 import common
 
@@ -51,3 +54,42 @@ def seconds_to_srt(seconds: float):
     minutes = int(seconds // 60)
     hours = int(minutes // 60)
     return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+
+def iter_json(value, batch_size: int = 1000) -> typing.Iterator[str]:
+    """
+    Encode value as json, piece by piece. Dataclasses and dicts are walked,
+    and long lists are encoded batch_size items at a time, so that the whole
+    document is never held in memory at once.
+    """
+
+    if is_dataclass(value):
+        value = {f.name: getattr(value, f.name) for f in fields(value)}
+
+    if isinstance(value, dict):
+        yield "{"
+        for i, (k, v) in enumerate(value.items()):
+            yield f"{', ' if i else ''}{json.dumps(str(k))}: "
+            yield from iter_json(v, batch_size)
+        yield "}"
+    elif isinstance(value, list) and len(value) > batch_size:
+        yield "["
+        for i in range(0, len(value), batch_size):
+            batch = json.dumps(value[i : i + batch_size], cls=common.JSONEncoder)
+            yield f"{', ' if i else ''}{batch[1:-1]}"
+        yield "]"
+    else:
+        yield json.dumps(value, cls=common.JSONEncoder)
+
+
+def buffered(pieces: typing.Iterable[str], size: int = 64 * 1024):
+    "Join small pieces of text into utf-8 chunks of about size bytes"
+    buffer, n_bytes = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        n_bytes += len(piece)
+        if n_bytes >= size:
+            yield "".join(buffer).encode("utf-8")
+            buffer, n_bytes = [], 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
@@ -29,6 +29,9 @@ import {
 // bounds the size of individual http requests.
 const uploadChunkSize = 1024 * 1024 * 16; // 16MB
 
+// chunks in flight at once. fills high latency links.
+const uploadConcurrency = 4;
+
 // bounds the memory usage of the hashing algorithm.
 const hashingChunkSize = 1024 * 1024 * 512; // 0.5GB
 
@@ -195,12 +198,27 @@ export default function Upload({
         filename: file.name,
         content_type: file.type,
         size_bytes: file.size,
+        chunk_size: uploadChunkSize,
       }),
     });
 
     return JSON.parse(await res.text());
   }
 
+  /**
+   * Checks that all chunks arrived and assembles the upload.
+   *
+   */
+  async function finalizeUpload(id: string, file: File): Promise<boolean> {
+    const res = await fetch(`/upload/${id}/finalize`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ size_bytes: file.size }),
+    });
+
+    return res.ok;
+  }
+
   /**
    * Upload a single chunk of the media file.
    *
@@ -212,37 +230,13 @@ export default function Upload({
     end: number,
     total: number,
     contentType: string,
+    onProgress: (loaded: number) => void,
   ): Promise<{ status: number }> {
     // manage progress
     function hProgress({ loaded }: { loaded: number }) {
-      const percentDone = Math.round((100 * (start + loaded)) / total);
-      const currentBytes = start + loaded;
       setUploading(true);
       setError(null);
-      if (percentDone === 100) {
-        setProgress(null);
-        showState(states.transcoding);
-      } else {
-        setProgress((lastProgress) => {
-          if (lastProgress == null) {
-            return {
-              percent: percentDone,
-              currentBytes,
-              totalBytes: total,
-            };
-          }
-
-          const lastBytes = lastProgress.currentBytes || 0;
-          if (currentBytes > lastBytes) {
-            return {
-              percent: percentDone,
-              currentBytes,
-              totalBytes: total,
-            };
-          }
-          return lastProgress;
-        });
-      }
+      onProgress(loaded);
     }
 
     return new Promise<{ status: number }>((resolve, reject) => {
@@ -268,35 +262,24 @@ export default function Upload({
   /**
    * Attempt to resume an upload.
    *
-   * Returns the start position in bytes to resume from, or null if we cannot
-   * resume.
+   * Returns the indices of the chunks that are still missing, or null if we
+   * cannot resume.
    *
    */
-  async function resume(id: string, file: File): Promise<number | null> {
+  async function resume(id: string): Promise<number[] | null> {
     try {
-      const res = await fetch(`/upload/${id}`, {
-        method: 'PUT',
-        headers: {
-          'X-Content-Length': '0',
-          'Content-Range': `bytes=*/${file.size}`,
-        },
-      });
-
-      if (res.status === 404) {
-        // Resume has expired
-        return null;
-      } if (res.status !== 308) {
-        // Resume failed
+      const res = await fetch(`/upload/${id}/chunks`);
+      if (!res.ok) {
+        // resume has expired, or this was not a parallel upload
         return null;
       }
-      const range = res.headers.get('Range') || '';
-      const match = range.match(/^bytes=(\d+)-(\d+)$/);
-      if (!match) {
-        // resume failed
+
+      const { chunk_size: chunkSize, missing } = await res.json();
+      if (chunkSize !== uploadChunkSize) {
         return null;
       }
 
-      return parseInt(match[2], 10) + 1;
+      return missing;
     } catch (e) {
       // resume failed
       return null;
@@ -306,16 +289,16 @@ export default function Upload({
   /**
    * Chunked upload of the media file.
    *
-   * Splits the file into chunks and uploads them one by one. We do this to
-   * keep individual http requests small, since modal.com has a fixed timeout
-   * of 150 seconds for web requests.
+   * Splits the file into chunks and uploads several of them at a time, in
+   * any order. We do this to keep individual http requests small, since
+   * modal.com has a fixed timeout of 150 seconds for web requests.
    *
    */
   async function upload(file: File) {
     // for smaller files we don't want to flash hashing progress
     const isLargeFile = file.size > 1024 * 1024 * 1024;
     const showHashingProgress: boolean = isLargeFile;
-    let start: number | null = null;
+    let missing: number[] | null = null;
     let nErrors = 0;
 
     // geometric backoff
@@ -347,14 +330,15 @@ export default function Upload({
     const mediaHash = await hash(file, hashingProgress);
     let id = getTranscription(mediaHash);
     if (id) {
-      start = await resume(id, file);
-      log.info(`Requested resume of ${id}: got ${start}`);
+      missing = await resume(id);
+      log.info(`Requested resume of ${id}: ${missing?.length} chunks missing`);
     }
 
     // this is a new file, or resume failed
-    if (!id || !start) {
+    if (!id || !missing) {
       id = await initUpload(file);
-      start = 0;
+      const nChunks = Math.ceil(file.size / uploadChunkSize);
+      missing = Array.from({ length: nChunks }, (_, i) => i);
       log.info(`Initialized new transcription ${id}.`);
     }
 
@@ -372,72 +356,144 @@ export default function Upload({
     setProgress(null);
     showState(states.uploading);
 
+    // transcode while uploading. pipeline progress is shown once the upload
+    // is complete
+    let uploaded = false;
+    let pipelineFailed = false;
+    let pipelineState: TranscriptionState = states.transcoding;
+    function whenUploaded<T>(fn: (x: T) => void) {
+      return (x: T) => {
+        if (uploaded) {
+          fn(x);
+        }
+      };
+    }
+    const stopPipeline = process({
+      transcriptionId: id,
+      progressive: true,
+      setEta: whenUploaded(setEta),
+      setProgress: whenUploaded(setProgress),
+      setShowEta: whenUploaded(setShowEta),
+      showState: (state) => {
+        pipelineState = state;
+        whenUploaded(showState)(state);
+      },
+      onComplete: () => navigate(`/studio/${id}`),
+      onError: () => {
+        pipelineFailed = true;
+        if (uploaded) {
+          setUploadError();
+        }
+      },
+    });
+
     // start upload
+    const uploadId = id;
     const uploadStartedAt = Date.now();
+    const queue = [...missing];
+    const inFlight = new Map<number, number>();
+    let bytesDone = file.size - missing.reduce(
+      (n, i) => n + Math.min(uploadChunkSize, file.size - i * uploadChunkSize),
+      0,
+    );
     let bytesUploaded = 0;
-    while (start < file.size) {
-      const end = Math.min(start + uploadChunkSize, file.size);
-      const chunk = file.slice(start, end);
-      let response;
-
-      try {
-        response = await uploadChunk(
-          id,
-          chunk,
-          start,
-          end,
-          file.size,
-          file.type,
-        );
-      } catch (e) {
-        log.info(`upload chunk failed. nErrors: ${nErrors}`, e);
-        if (nErrors <= 3) {
-          log.info('backing off...');
-          await backoff();
-          continue;
-        } else if (await waitForInternet()) {
+    let failed = false;
+
+    const showProgress = () => {
+      let currentBytes = bytesDone;
+      inFlight.forEach((loaded) => { currentBytes += loaded; });
+      setProgress({
+        percent: Math.min(99, Math.round((100 * currentBytes) / file.size)),
+        currentBytes,
+        totalBytes: file.size,
+      });
+    };
+
+    const worker = async () => {
+      while (queue.length > 0 && !failed) {
+        const index = queue.shift() as number;
+        const start = index * uploadChunkSize;
+        const end = Math.min(start + uploadChunkSize, file.size);
+        let response;
+
+        try {
+          response = await uploadChunk(
+            uploadId,
+            file.slice(start, end),
+            start,
+            end,
+            file.size,
+            file.type,
+            (loaded) => {
+              inFlight.set(index, loaded);
+              showProgress();
+            },
+          );
+        } catch (e) {
+          // try this chunk again later
+          log.info(`upload chunk failed. nErrors: ${nErrors}`, e);
+          inFlight.delete(index);
+          queue.push(index);
+          if (nErrors <= 3) {
+            log.info('backing off...');
+            await backoff();
+          } else if (!(await waitForInternet())) {
+            // upload failed, giving up
+            failed = true;
+          }
           continue;
-        } else {
-          // upload failed, giving up
-          setUploadError();
-          return;
         }
-      }
 
-      if (response.status === 308) {
-        // calculate upload speed for this chunk
-        bytesUploaded += (end - start);
-        const uploadDuration = (Date.now() - uploadStartedAt) / 1000;
-        const currentBps = bytesUploaded / uploadDuration;
-        const bytesRemaining = file.size - bytesUploaded;
-        const etaSeconds = bytesRemaining / currentBps;
-        setEta(etaSeconds);
-        setBps(currentBps);
-        // set showEta if 60 seconds have elapsed and there are more than
-        // 2 minutes of upload time remaining
-        if (uploadDuration > 60 && etaSeconds > 120) {
-          setShowEta(true);
-        }
-        // prepare for next chunk
-        start = end;
-        nErrors = 0;
-      } else if (response.status === 200) {
-        break;
-      } else {
-        nErrors += 1;
-        if (nErrors >= 3) {
-          // upload failed, giving up
-          setUploadError();
-          return;
+        inFlight.delete(index);
+        if (response.status === 308) {
+          // calculate upload speed
+          bytesDone += end - start;
+          bytesUploaded += end - start;
+          const uploadDuration = (Date.now() - uploadStartedAt) / 1000;
+          const currentBps = bytesUploaded / uploadDuration;
+          const etaSeconds = (file.size - bytesDone) / currentBps;
+          setEta(etaSeconds);
+          setBps(currentBps);
+          showProgress();
+          // set showEta if 60 seconds have elapsed and there are more than
+          // 2 minutes of upload time remaining
+          if (uploadDuration > 60 && etaSeconds > 120) {
+            setShowEta(true);
+          }
+          nErrors = 0;
+        } else {
+          queue.push(index);
+          nErrors += 1;
+          if (nErrors >= 3) {
+            // upload failed, giving up
+            failed = true;
+          }
         }
       }
+    };
+
+    await Promise.all(
+      Array.from({ length: uploadConcurrency }, () => worker()),
+    );
+
+    if (failed || !(await finalizeUpload(uploadId, file))) {
+      stopPipeline();
+      setUploadError();
+      return;
     }
 
-    // upload completed, now process
+    // upload completed, show the pipeline
+    uploaded = true;
     setProgress(null);
     setEta(null);
     setBps(null);
     setShowEta(false);
+    showState(pipelineState);
+    if (!pipelineFailed) {
+      return;
+    }
+
+    // progressive processing failed, so process the complete upload
     showState(states.transcoding);
     process({
       transcriptionId: id,
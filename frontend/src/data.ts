@@ -9,8 +9,21 @@ const debounceTimeSeconds = 5;
  *
  */
 
-export async function getTranscription(transcriptionId: string | undefined) {
-  return fetch(`/transcription/${transcriptionId}`, {});
+export async function getTranscription(
+  transcriptionId: string | undefined,
+  fields: string[] | null = null,
+) {
+  const query = fields ? `?${new URLSearchParams({ fields: fields.join(',') })}` : '';
+  return fetch(`/transcription/${transcriptionId}${query}`, {});
+}
+
+/**
+ * Get the binary word alignment
+ *
+ */
+
+export async function getAlignment(transcriptionId: string | undefined) {
+  return fetch(`/transcription/${transcriptionId}/alignment`, {});
 }
 
 /**
@@ -5,6 +5,7 @@ import * as _ from 'underscore';
 
 import {
   collapseSpeakers,
+  decodeAlignment,
   Transcription,
   ZDocument,
   transcriptionToZDocument,
@@ -214,3 +215,24 @@ test('convert transcription to document', () => {
 
   expect(gotContent).toEqual(wantTurns.map((turn) => turn.content));
 });
+
+test('decode binary alignment', () => {
+  // common.Alignment.to_bytes() of three words
+  const bytes = new Uint8Array([
+    84, 84, 65, 76, 1, 0, 0, 0, 3, 0, 0, 0, 2, 0, 0, 0, 4, 0, 0, 0,
+    0, 0, 0, 0, 2, 0, 0, 0, 4, 0, 0, 0,
+    0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0,
+    0, 0, 0, 63, 0, 0, 128, 63, 0, 0, 192, 63,
+    0, 0, 128, 63, 0, 0, 192, 63, 0, 0, 0, 64,
+    0, 0, 0, 63, 0, 0, 128, 63, 0, 0, 128, 62,
+    104, 105, 121, 111,
+  ]);
+
+  expect(decodeAlignment(bytes.buffer)).toEqual({
+    words: [
+      { label: 'hi', start: 0.5, end: 1.0, score: 0.5 },
+      { label: 'yo', start: 1.0, end: 1.5, score: 1.0 },
+      { label: 'hi', start: 1.5, end: 2.0, score: 0.25 },
+    ],
+  });
+});
@@ -201,13 +201,19 @@ export const help = {
   ].join(' '),
 };
 
+// consecutive failed reconnects before processing is given up on
+const maxReconnects = 5;
+
 /**
- * Process audio. Transcodes and transcribes the media file.
+ * Process audio. Transcodes and transcribes the media file. Progressive
+ * processing starts while the upload is still arriving. Returns a function
+ * that stops listening for progress.
  *
  */
 export const process = ({
   transcriptionId,
   language = null,
+  progressive = false,
   setTranscript = () => {},
   setEta = () => {},
   setShowEta = () => {},
@@ -218,6 +224,7 @@ export const process = ({
 } : {
   transcriptionId: string;
   language?: string | null;
+  progressive?: boolean;
   setTranscript?: (transcript: WhisperResult) => void;
   setEta?: (eta: number | null) => void;
   setShowEta?: (show: boolean) => void;
@@ -227,13 +234,22 @@ export const process = ({
   onError?: () => void;
 }) => {
   const id = encodeURIComponent(transcriptionId);
-  let url = `/transcribe/${id}`;
+  const params = new URLSearchParams({ streaming: 'true' });
 
   // add language if specified
   if (language != null) {
-    url = `${url}?language=${language}`;
+    params.set('language', language);
+  }
+
+  if (progressive) {
+    params.set('progressive', 'true');
   }
 
+  const url = `/transcribe/${id}?${params}`;
+
+  // transcript so far, when whisper streams partial results
+  const partial: WhisperResult = { text: '', segments: [], language: language || '' };
+
   // eta timers
   let transcodingStartedAt: number | null;
   let transcribingStartedAt: number | null;
@@ -262,7 +278,12 @@ export const process = ({
         setEta(null);
         setShowEta(false);
       } else {
-        const [remaining, show] = eta(transcodingStartedAt, percentDone);
+        let [remaining, show] = eta(transcodingStartedAt, percentDone);
+        // ffmpeg knows its speed, which is steadier than our estimate
+        if (data.eta_seconds != null) {
+          remaining = Math.round(data.eta_seconds);
+          show = remaining > 120;
+        }
         setProgress({ percent: percentDone } as Progress);
         setEta(remaining);
         if (show) {
@@ -276,7 +297,7 @@ export const process = ({
   sse.addEventListener('TranscriptionProgress', (ev) => {
     const data = JSON.parse(ev.data);
     const percentDone = data.percent_done;
-    const { transcript } = data;
+    const { transcript, segments } = data;
     transcribingStartedAt = transcribingStartedAt || Date.now();
     if (transcript == null) {
       const [remaining, show] = eta(transcribingStartedAt, percentDone);
@@ -285,6 +306,11 @@ export const process = ({
       if (show) {
         setShowEta(true);
       }
+      if (segments != null) {
+        partial.segments = [...partial.segments, ...segments];
+        partial.text = partial.segments.map((s) => s.text).join('');
+        setTranscript({ ...partial });
+      }
     } else {
       setTranscript(transcript);
     }
@@ -327,10 +353,19 @@ export const process = ({
     }
   });
 
+  // the pipeline runs as a detached job. dropped connections are reopened
+  // by the browser, which resumes from the last event it saw
+  let nErrors = 0;
+  sse.onopen = () => { nErrors = 0; };
   sse.onerror = () => {
-    sse.close();
-    onError();
+    nErrors += 1;
+    if (sse.readyState === EventSource.CLOSED || nErrors > maxReconnects) {
+      sse.close();
+      onError();
+    }
   };
+
+  return () => sse.close();
 };
 
 /**
@@ -537,3 +572,48 @@ export function roundAlignmentTimecodes(a: Alignment): Alignment {
 
   return { words };
 }
+
+/**
+ * Decode the binary columnar alignment served by
+ * /transcription/{id}/alignment. Columns are viewed in place, which assumes
+ * a little endian platform.
+ *
+ */
+export function decodeAlignment(buffer: ArrayBuffer): Alignment {
+  const header = new DataView(buffer, 0, 20);
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+  if (magic !== 'TTAL' || header.getUint16(4, true) !== 1) {
+    throw new Error('Not a binary alignment');
+  }
+
+  const nWords = header.getUint32(8, true);
+  const nLabels = header.getUint32(12, true);
+  const nText = header.getUint32(16, true);
+
+  let at = 20;
+  const offsets = new Uint32Array(buffer, at, nLabels + 1);
+  at += 4 * (nLabels + 1);
+  const labelIds = new Uint32Array(buffer, at, nWords);
+  at += 4 * nWords;
+  const starts = new Float32Array(buffer, at, nWords);
+  at += 4 * nWords;
+  const ends = new Float32Array(buffer, at, nWords);
+  at += 4 * nWords;
+  const scores = new Float32Array(buffer, at, nWords);
+  at += 4 * nWords;
+
+  const text = new Uint8Array(buffer, at, nText);
+  const decoder = new TextDecoder();
+  const labels = Array.from({ length: nLabels }, (_, i) => (
+    decoder.decode(text.subarray(offsets[i], offsets[i + 1]))
+  ));
+
+  const words = Array.from(labelIds, (id, i) => ({
+    label: labels[id],
+    start: starts[i],
+    end: ends[i],
+    score: scores[i],
+  }));
+
+  return { words };
+}
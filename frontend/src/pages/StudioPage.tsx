@@ -37,6 +37,7 @@ import {
   TranscriptionState,
   WhisperResult,
   ZDocument,
+  decodeAlignment,
   help,
   languageLongName,
   process,
@@ -48,6 +49,7 @@ import {
 
 // data
 import {
+  getAlignment,
   getTranscription,
   debouncedPutTitle,
   debouncedPutDescription,
@@ -109,9 +111,19 @@ export default function StudioPage() {
   useEffect(() => {
     const get = async () => {
       try {
-        const res = await getTranscription(transcriptionId);
+        // the alignment is fetched in its compact binary encoding
+        const [res, alignmentRes] = await Promise.all([
+          getTranscription(transcriptionId, [
+            'transcription_id', 'upload', 'track', 'transcript',
+            'diarization', 'transcoded', 'path', 'language',
+          ]),
+          getAlignment(transcriptionId),
+        ]);
         if (res.ok) {
           const meta = JSON.parse(await res.text());
+          meta.alignment = alignmentRes.ok
+            ? decodeAlignment(await alignmentRes.arrayBuffer())
+            : null;
           setTitle(meta.track.title);
           setDescription(meta.track.description);
 
@@ -446,7 +458,7 @@ export default function StudioPage() {
           setPlaying={setPlaying}
           elapsed={elapsed}
           setElapsed={setElapsedFromPlayer}
-          initialUrl={`/media/${transcriptionId}`}
+          initialUrl={`/media/${transcriptionId}/proxy`}
         />
       </div>
       <div id="play-button" className="fixed bottom-16 w-full flex justify-center">
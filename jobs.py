@@ -0,0 +1,321 @@
+"""
+Detached pipeline jobs. A job runs the pipeline of a transcription in its own
+container, and appends every event to a log on the volume. Clients follow
+the log rather than the pipeline, so they can disconnect and resubscribe
+from the last event they saw, and all viewers of a transcription share the
+job that is running for it.
+
+Jobs of a transcription are numbered, and each has a manifest and a log in
+the jobs directory of the transcription. Event ids are job-index, counting
+events from 1.
+"""
+
+from pathlib import Path
+import asyncio
+import json
+import logging
+import os
+import time
+import typing
+import uuid
+
+from modal import Image
+
+import common
+import scheduler
+from common import app
+from pipeline import PipelineProgress, batch, pipeline
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# jobs that have not touched their log for this long are presumed dead.
+# running jobs touch it at least every common.HEARTBEAT_SECONDS
+STALE_SECONDS = 120
+
+# finished jobs kept per transcription, for clients that resubscribe late
+KEEP_JOBS = 2
+
+# files a single bulk import may hold
+MAX_BATCH_FILES = 1000
+
+# job parameters that change its results. a request only joins a running job
+# that agrees with it on these
+RESULT_PARAMS = ("language", "asr_options")
+
+jobs_image = Image.debian_slim(python_version="3.10.8")
+
+
+class JobError(Exception):
+    pass
+
+
+class JobLog:
+    """
+    The manifest and event log of one job. The log holds one sse event per
+    line, and is only ever appended to by the job itself.
+    """
+
+    def __init__(self, path: Path, number: int):
+        self.path = Path(path)
+        self.number = number
+
+    @property
+    def manifest_file(self):
+        return self.path / f"{self.number:05d}.json"
+
+    @property
+    def log_file(self):
+        return self.path / f"{self.number:05d}.log"
+
+    def event_id(self, index: int) -> str:
+        return f"{self.number}-{index}"
+
+    def manifest(self) -> dict:
+        try:
+            return json.loads(self.manifest_file.read_text())
+        except FileNotFoundError:
+            return {}
+
+    def write_manifest(self, **manifest):
+        common.write_atomic(self.manifest_file, json.dumps(manifest))
+
+    def finish(self, error: str = None):
+        manifest = self.manifest()
+        if error:
+            self.write_manifest(**manifest | {"state": "error", "error": error})
+        else:
+            self.write_manifest(**manifest | {"state": "completed"})
+
+    def append(self, event: str):
+        with open(self.log_file, "a") as f:
+            f.write(json.dumps(event) + "\n")
+
+    def touch(self):
+        os.utime(self.log_file)
+
+    def stale(self) -> bool:
+        try:
+            return time.time() - self.log_file.stat().st_mtime > STALE_SECONDS
+        except FileNotFoundError:
+            return True
+
+    def running(self) -> bool:
+        return self.manifest().get("state") == "running" and not self.stale()
+
+    def read(self, offset: int) -> typing.Tuple[typing.List[str], int]:
+        "Complete events from offset on, and the offset after them"
+        with open(self.log_file, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # the job may be half way through appending the last line
+        data = data[: data.rfind(b"\n") + 1]
+        return [json.loads(x) for x in data.splitlines()], offset + len(data)
+
+    async def follow(self, after: int = 0, poll_seconds: float = 0.5):
+        """
+        Yield (event_id, event) tuples for the events after index after,
+        until the job is done. Raises JobError if the job died.
+        """
+
+        index, offset = 0, 0
+        while True:
+            # read the manifest before the log, so that no events are lost
+            # when the job finishes in between the two reads
+            manifest = await asyncio.to_thread(self.manifest)
+            events, offset = await asyncio.to_thread(self.read, offset)
+            for event in events:
+                index += 1
+                if index > after:
+                    yield self.event_id(index), event
+
+            if manifest.get("state") in ("completed", "error"):
+                return
+            if await asyncio.to_thread(self.stale):
+                raise JobError(f"job {self.number} stopped at {index} events")
+
+            await asyncio.sleep(poll_seconds)
+
+
+def latest_job(path: Path) -> typing.Optional[JobLog]:
+    numbers = [int(x.stem) for x in Path(path).glob("[0-9]*.json")]
+    if numbers:
+        return JobLog(path, max(numbers))
+
+
+def claim_job(path: Path, **params) -> typing.Optional[JobLog]:
+    """
+    Create the next job, unless one is running. Returns None if another
+    client claimed it first.
+    """
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    latest = latest_job(path)
+    if latest and latest.running():
+        return None
+
+    job = JobLog(path, latest.number + 1 if latest else 1)
+    job.log_file.touch()
+
+    # linking fails if the manifest exists, so only one client wins
+    manifest = {"state": "running", "started": time.time(), **params}
+    tmp = path / f".{uuid.uuid4().hex}.tmp"
+    tmp.write_text(json.dumps(manifest))
+    try:
+        os.link(tmp, job.manifest_file)
+    except FileExistsError:
+        return None
+    finally:
+        tmp.unlink()
+
+    for number in range(1, job.number - KEEP_JOBS + 1):
+        JobLog(path, number).manifest_file.unlink(missing_ok=True)
+        JobLog(path, number).log_file.unlink(missing_ok=True)
+
+    logger.info(f"claimed job {job.number} in {path}")
+    return job
+
+
+def resume(
+    t: common.Transcription, last_event_id: str
+) -> typing.Tuple[typing.Optional[JobLog], int]:
+    """
+    The job and event index that a Last-Event-ID points to. Returns no job
+    if the id is invalid, or the job is gone.
+    """
+
+    number, _, index = last_event_id.partition("-")
+    try:
+        job = JobLog(t.jobs_path, int(number))
+        index = int(index)
+    except ValueError:
+        return None, 0
+
+    if not job.manifest_file.exists():
+        return None, 0
+    return job, index
+
+
+async def submit(t: common.Transcription, **params) -> JobLog:
+    """
+    The running job of a transcription, or a newly started one. Raises
+    JobError if the running job was started with other RESULT_PARAMS.
+    """
+
+    while True:
+        latest = await asyncio.to_thread(latest_job, t.jobs_path)
+        if latest and await asyncio.to_thread(latest.running):
+            manifest = await asyncio.to_thread(latest.manifest)
+            for name in RESULT_PARAMS:
+                if manifest.get(name) != params.get(name):
+                    raise JobError(
+                        f"job {latest.number} is running with another "
+                        f"{name}: {manifest.get(name)}"
+                    )
+
+            logger.info(f"joining job {latest.number}")
+            return latest
+
+        job = await asyncio.to_thread(claim_job, t.jobs_path, **params)
+        if job:
+            try:
+                await run_job.spawn.aio(
+                    t.transcription_id, job.number, **params
+                )
+            except Exception as e:
+                await asyncio.to_thread(job.finish, error=str(e))
+                raise
+            return job
+
+
+async def run(job: JobLog, updates: typing.AsyncIterator):
+    """
+    Append pipeline updates to the log of a job, and touch it during silent
+    stretches so that followers can tell a slow job from a dead one.
+    """
+
+    heartbeat = common.dataclass_to_event(common.Heartbeat())
+
+    async def events():
+        async for update in updates:
+            yield common.dataclass_to_event(update)
+
+    try:
+        async for event in common.with_heartbeats(events()):
+            if event == heartbeat:
+                await asyncio.to_thread(job.touch)
+            else:
+                await asyncio.to_thread(job.append, event)
+    except Exception as e:
+        logger.error(e)
+        event = common.dataclass_to_event(PipelineProgress(state="error"))
+        await asyncio.to_thread(job.append, event)
+        await asyncio.to_thread(job.finish, error=str(e))
+    else:
+        await asyncio.to_thread(job.finish)
+
+
+@app.function(
+    image=jobs_image,
+    network_file_systems=common.nfs,
+    container_idle_timeout=60,
+    timeout=3600,
+)
+async def run_job(
+    transcription_id: str,
+    number: int,
+    language: str = None,
+    streaming: bool = False,
+    progressive: bool = False,
+    priority: int = scheduler.NORMAL,
+    asr_options: dict = None,
+    prompt: str = None,
+):
+    """
+    Run the pipeline of a transcription as a job, detached from the clients
+    that follow it. prompt conditions whisper, e.g. on names in the track's
+    description.
+    """
+
+    t = await asyncio.to_thread(common.db.select, transcription_id)
+    if not t:
+        raise JobError(f"invalid id : {transcription_id}")
+
+    job = JobLog(t.jobs_path, number)
+    updates = pipeline(
+        transcription_id,
+        language,
+        prompt,
+        streaming=streaming,
+        progressive=progressive,
+        priority=priority,
+        asr_options=asr_options,
+    )
+    await run(job, updates)
+
+
+@app.function(
+    image=jobs_image,
+    network_file_systems=common.nfs,
+    container_idle_timeout=60,
+    timeout=3600,
+)
+async def run_batch(
+    transcription_ids: typing.List[str],
+    language: str = None,
+    prompt: str = None,
+):
+    """
+    Run a bulk import, detached from the client that submitted it. Results
+    are saved per transcription as they arrive, and failures are logged.
+    """
+
+    failed = 0
+    async for transcription_id, update in batch(
+        transcription_ids, language, prompt
+    ):
+        if isinstance(update, PipelineProgress) and update.state == "error":
+            failed += 1
+
+    logger.info(f"batch of {len(transcription_ids)} done, {failed} failed")
@@ -0,0 +1,144 @@
+"""
+Process wide registry of loaded models. Modal keeps containers around
+between calls, so models held here are loaded once per container rather than
+once per request.
+"""
+
+from dataclasses import asdict, dataclass
+from pathlib import Path
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+import common
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# stats of each container, published to the volume for the web containers
+METRICS_PATH = common.MEDIA_PATH / "models"
+
+# containers that published longer ago than this have gone
+METRICS_MAX_AGE_SECONDS = 24 * 3600
+
+
+@dataclass
+class ModelStats:
+    """
+    Load and usage counters of a single model
+    """
+
+    # calls that found the model already loaded
+    hits: int = 0
+    # calls that had to load the model
+    misses: int = 0
+    # total time spent loading, in seconds
+    load_seconds: float = 0.0
+
+
+class ModelRegistry:
+    """
+    Loaded models keyed by model name and device. With a metrics file, the
+    stats are written there after every call.
+    """
+
+    def __init__(self, metrics_file: Path = None):
+        self.models = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.metrics_file = metrics_file
+
+    def get(self, name: str, device: str, load: typing.Callable):
+        """
+        Return the model for name and device, calling load() only if it has
+        not been loaded by this process before.
+        """
+
+        try:
+            return self.load(name, device, load)
+        finally:
+            self.publish()
+
+    def load(self, name: str, device: str, load: typing.Callable):
+        key = (name, str(device))
+        with self.lock:
+            stats = self.counters.setdefault(key, ModelStats())
+            if key in self.models:
+                stats.hits += 1
+                logger.info(f"model {name} on {device}: hit")
+                return self.models[key]
+
+            started = time.monotonic()
+            model = load()
+            seconds = time.monotonic() - started
+            stats.misses += 1
+            stats.load_seconds += seconds
+            self.models[key] = model
+            logger.info(f"model {name} on {device}: loaded in {seconds:.2f}s")
+            return model
+
+    def publish(self):
+        "Write the stats to the metrics file, if there is one"
+        if not self.metrics_file:
+            return
+        try:
+            self.metrics_file.parent.mkdir(parents=True, exist_ok=True)
+            common.write_atomic(self.metrics_file, json.dumps(self.stats()))
+        except OSError as e:
+            logger.warning(f"cannot publish model stats: {e}")
+
+    def stats(self) -> typing.Dict[str, dict]:
+        with self.lock:
+            return {
+                f"{name}@{device}": asdict(stats)
+                for (name, device), stats in self.counters.items()
+            }
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.counters.clear()
+
+
+def read_metrics(path: Path = METRICS_PATH) -> typing.Dict[str, dict]:
+    """
+    The stats last published by each container, summed per model, with the
+    number of containers that have loaded it.
+    """
+
+    metrics = {}
+    if not path.exists():
+        return metrics
+
+    for metrics_file in path.glob("*.json"):
+        try:
+            age = time.time() - metrics_file.stat().st_mtime
+            if age > METRICS_MAX_AGE_SECONDS:
+                continue
+            published = json.loads(metrics_file.read_text())
+        except (OSError, ValueError):
+            # gone, or replaced while reading
+            continue
+
+        for key, stats in published.items():
+            total = metrics.setdefault(
+                key, asdict(ModelStats()) | {"containers": 0}
+            )
+            for field, value in stats.items():
+                total[field] = total.get(field, 0) + value
+            total["containers"] += 1
+
+    return metrics
+
+
+def metrics_file() -> typing.Optional[Path]:
+    "Where this container publishes, when it runs on modal"
+    task_id = os.getenv("MODAL_TASK_ID")
+    return METRICS_PATH / f"{task_id}.json" if task_id else None
+
+
+# models held by this process
+registry = ModelRegistry(metrics_file())
@@ -0,0 +1,132 @@
+"""
+Waveform peaks for the editor timeline. Peaks are computed once from the
+transcoded wav, at every zoom level, and stored next to it, so that drawing a
+waveform never needs the media itself.
+
+The peaks file is little endian: a header, the number of peaks per level,
+then each level as int16 (min, max) pairs, finest level first.
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+import logging
+import struct
+
+from modal import Image
+
+import common
+from common import app
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class PeaksError(Exception):
+    pass
+
+
+# magic, version, number of levels, sample rate, samples per peak at level 0
+PEAKS_HEADER = struct.Struct("<4sHHII")
+PEAKS_MAGIC = b"TTPK"
+PEAKS_VERSION = 1
+
+# resolution of the finest level. 16 ms at 16khz
+SAMPLES_PER_PEAK = 256
+
+# bytes per (min, max) pair
+PEAK_SIZE = 4
+
+peaks_image = Image.debian_slim(python_version="3.10.8").pip_install("numpy")
+
+
+@dataclass
+class PeaksSlice:
+    """
+    Peaks of one zoom level, as int16 (min, max) pairs
+    """
+
+    # zoom level. 0 is the finest
+    zoom: int
+    # sample rate of the transcoded audio
+    sample_rate: int
+    # samples per peak at this zoom level
+    samples_per_peak: int
+    # index of the first peak in data
+    offset: int
+    # int16 (min, max) pairs
+    data: bytes
+
+
+@app.function(
+    cpu=2.0,
+    container_idle_timeout=180,
+    image=peaks_image,
+    network_file_systems=common.nfs,
+    timeout=600,
+)
+def peaks(transcription_id: str, force_reprocessing: bool = False):
+    """
+    Compute the peaks of a transcoded file.
+    """
+
+    import audio
+
+    t = common.db.select(transcription_id)
+    if not t:
+        raise PeaksError(f"invalid id : {transcription_id}")
+
+    wav = common.file_stamp(t.transcoded_file)
+    if wav is None:
+        raise PeaksError(f"not transcoded : {transcription_id}")
+
+    # stamps are (inode, mtime, size)
+    stamp = common.file_stamp(t.peaks_file)
+    if stamp and stamp[1] >= wav[1] and not force_reprocessing:
+        logger.info(f"peaks are up to date")
+        return
+
+    samples, sample_rate = audio.read_wav(t.transcoded_file)
+    levels = audio.peak_pyramid(samples, SAMPLES_PER_PEAK)
+    write_peaks(t.peaks_file, levels, sample_rate)
+
+
+def write_peaks(path: Path, levels: list, sample_rate: int):
+    header = PEAKS_HEADER.pack(
+        PEAKS_MAGIC, PEAKS_VERSION, len(levels), sample_rate, SAMPLES_PER_PEAK
+    )
+    counts = struct.pack(f"<{len(levels)}I", *[len(x) for x in levels])
+    data = b"".join(level.astype("<i2").tobytes() for level in levels)
+    common.write_atomic(path, header + counts + data)
+
+
+def read_peaks(
+    path: Path, zoom: int, start: float = None, end: float = None
+) -> PeaksSlice:
+    """
+    Read the peaks of one zoom level, optionally only those between start
+    and end seconds. Only the header and the requested peaks are read.
+    """
+
+    with open(path, "rb") as f:
+        magic, version, n_levels, sample_rate, samples_per_peak = (
+            PEAKS_HEADER.unpack(f.read(PEAKS_HEADER.size))
+        )
+        if magic != PEAKS_MAGIC or version != PEAKS_VERSION:
+            raise PeaksError(f"not a peaks file: {path}")
+        if not 0 <= zoom < n_levels:
+            raise PeaksError(f"zoom must be between 0 and {n_levels - 1}")
+
+        counts = struct.unpack(f"<{n_levels}I", f.read(4 * n_levels))
+        samples_per_peak *= 2**zoom
+        first, last = 0, counts[zoom]
+        if start is not None:
+            first = int(start * sample_rate) // samples_per_peak
+            first = min(last, max(0, first))
+        if end is not None:
+            last = -(-int(end * sample_rate) // samples_per_peak)
+            last = max(first, min(counts[zoom], last))
+
+        f.seek(PEAK_SIZE * (sum(counts[:zoom]) + first), 1)
+        data = f.read(PEAK_SIZE * (last - first))
+
+    return PeaksSlice(zoom, sample_rate, samples_per_peak, first, data)
@@ -1,16 +1,45 @@
-from dataclasses import dataclass, replace
+from dataclasses import asdict, dataclass, replace
+import asyncio
+import functools
+import hashlib
+import json
 import logging
 import typing
 
-from align import align, align_piecewise_linear
-from annotate import annotate, AnnotationProgress
-from transcode import transcode, TranscodingProgress
-from transcribe import transcribe, TranscriptionProgress
+from align import (
+    align,
+    align_piecewise_linear,
+    AlignmentProgress,
+    ALIGNER,
+    SECONDS_PER_WINDOW,
+)
+from annotate import annotate, AnnotationProgress, DIARIZATION_MODEL
+from peaks import peaks, SAMPLES_PER_PEAK
+from transcode import streamable, transcode, TranscodingProgress, SAMPLE_RATE
+from transcribe import (
+    BatchProgress,
+    map_workers,
+    transcribe,
+    transcribe_batch,
+    transcribe_cpu,
+    transcribe_map,
+    TranscriptionProgress,
+)
+import asr
 import common
+import scheduler
+import uploads
+import vad
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# files transcoded at once by batch
+BATCH_TRANSCODES = 32
+
+# files per batch transcription call
+BATCH_FILES = 64
+
 import common
 from common import app
 
@@ -25,96 +54,305 @@ class PipelineProgress:
     transcription: typing.Optional[common.Transcription] = None
 
 
-def pipeline(
+# what each stage leaves behind: fields of the transcription, and files next
+# to the upload. the first file is the one the stage can't do without
+STAGE_ARTIFACTS = {
+    "transcode": (
+        ["transcoded", "track"],
+        ["transcoded_file", "audio_proxy_file", "video_proxy_file"],
+    ),
+    "transcribe": (["transcript", "language"], []),
+    "align": (["alignment"], []),
+    "annotate": (["diarization"], []),
+    "peaks": ([], ["peaks_file"]),
+    "vad": ([], ["speech_map_file", "speech_file"]),
+}
+
+
+async def pipeline(
     transcription_id: str,
     language: str = None,
     prompt: str = None,
     media_path: str = common.MEDIA_PATH,
     local_mode: bool = False,
+    streaming: bool = False,
+    transcribe_workers: int = None,
+    progressive: bool = False,
+    priority: int = scheduler.NORMAL,
+    asr_options: dict = None,
+    speech: bool = None,
 ):
     """
-    The media processing pipeline
+    The media processing pipeline. Long files are transcribed on several
+    workers at once, unless transcribe_workers is given. With progressive,
+    transcoding starts while the upload is still arriving. asr_options picks
+    the recognition backend, as in asr.AsrOptions. With speech, vad finds the
+    speech after transcoding, and the later stages skip the silence. It is
+    on for new transcriptions unless given.
+
+    Stages are awaited with modal's async calls, so a running pipeline holds
+    no thread while its stages work. Store calls block on the volume, so they
+    run in threads.
     """
 
-    t = common.db.select(transcription_id)
+    t = await asyncio.to_thread(common.db.select, transcription_id)
     if not t:
         raise PipelineError(f"invalid id : {transcription_id}")
 
     try:
+        options = asr.AsrOptions.from_dict(asr_options)
+        transcribe_stage = "transcribe_cpu" if options.cpu else "transcribe"
+
         # bit awkward. supports local modal tests
-        transcode_fn = transcode.remote_gen
-        transcribe_fn = transcribe.remote_gen
-        annotate_fn = annotate.remote
-        align_fn = align.remote
+        transcode_fn = transcode.remote_gen.aio
+        streamable_fn = streamable.remote.aio
+        transcribe_fn = scheduler.scheduled_gen(transcribe_stage, priority)
+        transcribe_map_fn = scheduler.scheduled_gen("transcribe_map", priority)
+        annotate_fn = scheduler.scheduled("annotate", priority)
+        align_fn = scheduler.scheduled("align", priority)
+        peaks_fn = peaks.remote.aio
+        vad_fn = vad.vad.remote.aio
         if local_mode:
-            transcode_fn = transcode.local
-            transcribe_fn = transcribe.local
-            annotate_fn = annotate.local
-            align_fn = align.local
+            transcode_fn = in_thread_gen(transcode.local)
+            streamable_fn = in_thread(streamable.local)
+            transcribe_fn = in_thread_gen(
+                transcribe_cpu.local if options.cpu else transcribe.local
+            )
+            transcribe_map_fn = in_thread_gen(
+                functools.partial(transcribe_map.local, local_mode=True)
+            )
+            annotate_fn = in_thread(annotate.local)
+            align_fn = in_thread(align.local)
+            peaks_fn = in_thread(peaks.local)
+            vad_fn = in_thread(vad.vad.local)
+
+        # a transcription is reopened in the language it was transcribed in
+        if not language and t.transcribed:
+            language = t.language
+
+        # stages are skipped while their inputs are unchanged. changes
+        # cascade, since each fingerprint includes those of its inputs
+        fingerprints = stage_fingerprints(language, prompt, options)
+        if t.stages is None:
+            t = replace(t, stages=legacy_stages(t, fingerprints, language))
+            await asyncio.to_thread(
+                common.db.update, transcription_id, stages=t.stages
+            )
+        needs_transcoding = not fresh(t, "transcode", fingerprints)
+
+        # transcripts made without vad, of this or an earlier upload of the
+        # same media, are kept. streamed transcription starts before there
+        # is anything to run vad on, so it reads the whole track, and only
+        # the stages after it skip the silence
+        if speech is None:
+            speech = not (
+                fresh(t, "transcribe", fingerprints)
+                or await asyncio.to_thread(
+                    reusable, t, "transcribe", fingerprints["transcribe"]
+                )
+            )
+        streamed = streaming and needs_transcoding
+        if speech:
+            fingerprints = stage_fingerprints(
+                language, prompt, options, True, streamed
+            )
+        needs_transcribing = not fresh(t, "transcribe", fingerprints)
+
+        # reuse the results of earlier uploads of the same media
+        if needs_transcoding and (
+            shared := await asyncio.to_thread(
+                reuse, t, "transcode", fingerprints["transcode"]
+            )
+        ):
+            t, needs_transcoding = shared, False
+            yield PipelineProgress(state="transcoding")
+            yield TranscodingProgress(percent_done=100, track=t.track)
+
+        if needs_transcribing and (
+            shared := await asyncio.to_thread(
+                reuse, t, "transcribe", fingerprints["transcribe"]
+            )
+        ):
+            t, needs_transcribing = shared, False
+            yield PipelineProgress(state="transcribing")
+            yield TranscriptionProgress(
+                percent_done=100, transcript=t.transcript
+            )
+
+        # uploads that can't be read front to back are waited for here, not
+        # in a transcoder
+        if progressive and needs_transcoding:
+            if not await streamable_fn(transcription_id):
+                logger.info(f"cannot stream upload. waiting for all of it")
+                size_bytes = t.upload.size_bytes
+                await asyncio.to_thread(uploads.wait_for, t, size_bytes)
+                progressive = False
+
+        # transcode and transcribe at the same time. whisper starts on the
+        # first chunks while ffmpeg is still working through the upload
+        if streaming and needs_transcoding and needs_transcribing:
+            logger.info(f"transcoding and transcribing...")
+
+            # the transcriber may start following before the transcoder has
+            # replaced the chunks of an earlier run
+            chunks = common.ChunkedAudio(t.transcoded_chunks_path)
+            await asyncio.to_thread(chunks.clear)
+            yield PipelineProgress(state="transcoding")
+            yield PipelineProgress(state="transcribing")
+            stages = {
+                "transcode": transcode_fn(
+                    transcription_id,
+                    media_path=media_path,
+                    force_reprocessing=True,
+                    chunk_seconds=common.CHUNK_SECONDS,
+                    progressive=progressive,
+                ),
+                "transcribe": transcribe_fn(
+                    transcription_id,
+                    language,
+                    prompt,
+                    streaming=True,
+                    asr_options=asdict(options),
+                ),
+            }
+
+            async for name, update in interleave(stages):
+                match name:
+                    case "transcode":
+                        t, update = await asyncio.to_thread(
+                            on_transcoding, t, update
+                        )
+                    case "transcribe":
+                        t, update = await asyncio.to_thread(
+                            on_transcription, t, update, language
+                        )
+                yield update
+
+            needs_transcoding = needs_transcribing = False
 
         # transcode
-        if (not t.transcoded) or (not t.track):
+        if needs_transcoding:
             logger.info(f"transcoding...")
             yield PipelineProgress(state="transcoding")
-            for update in transcode_fn(transcription_id, media_path=media_path):
-                match update:
-                    case TranscodingProgress(percent_done, None):
-                        yield update
-                    case TranscodingProgress(
-                        percent_done, track
-                    ) if track is not None:
-                        logger.info(f"completed transcoding. {track}")
-                        t = replace(t, transcoded=True, track=track)
-                        common.db.create(t)
-                        yield update
-                    case x:
-                        raise ValueError(
-                            f"cannot parse TranscodingProgress: {x}"
-                        )
+            async for update in transcode_fn(
+                transcription_id,
+                media_path=media_path,
+                force_reprocessing=True,
+                progressive=progressive,
+            ):
+                t, update = await asyncio.to_thread(on_transcoding, t, update)
+                yield update
         else:
             logger.info(f"already transcoded. continuing")
 
+        # find the speech, which is all that the later stages look at
+        if speech and not fresh(t, "vad", fingerprints):
+            if shared := await asyncio.to_thread(
+                reuse, t, "vad", fingerprints["vad"]
+            ):
+                t = shared
+            else:
+                logger.info("detecting speech...")
+                await vad_fn(transcription_id)
+            t = await asyncio.to_thread(complete, t, fingerprints, "vad")
+
         # transcribe
-        changing_language = language and language != t.language
-        if (not t.transcribed) or changing_language:
-            logger.info("transcribing...")
+        if needs_transcribing:
+            # map workers only run the default whisper model on gpus
+            n_workers = 1
+            if options == asr.AsrOptions():
+                n_workers = transcribe_workers or map_workers(t.track.duration)
+            if n_workers > 1:
+                transcribe_fn = functools.partial(
+                    transcribe_map_fn, n_workers=n_workers, speech=speech
+                )
+            else:
+                transcribe_fn = functools.partial(
+                    transcribe_fn, asr_options=asdict(options), speech=speech
+                )
+
+            logger.info(f"transcribing on {n_workers} workers ({options})...")
             yield PipelineProgress(state="transcribing")
-            for update in transcribe_fn(transcription_id, language, prompt):
-                match update:
-                    case int(percent_done):
-                        yield TranscriptionProgress(percent_done=percent_done)
-                    case dict(transcript):
-                        # save results
-                        if not language:
-                            # save the detected language
-                            language = transcript.get("language")
-                        # completed
-                        logger.info(f"completed transcription.")
-                        t = replace(t, transcript=transcript, language=language)
-                        common.db.create(t)
-                        yield TranscriptionProgress(
-                            percent_done=100, transcript=t.transcript
-                        )
-                    case _:
-                        update_str = f"{update} ({type(update)})"
-                        raise ValueError(
-                            f"cannot parse TranscriptionProgress: {update_str}"
-                        )
+            async for update in transcribe_fn(
+                transcription_id, language, prompt
+            ):
+                t, update = await asyncio.to_thread(
+                    on_transcription, t, update, language
+                )
+                yield update
         else:
             logger.info(f"already transcribed. continuing")
 
-        # align
-        logger.info("aligning...")
-        yield PipelineProgress(state="aligning")
-        t.alignment = align_fn(transcription_id, language=language)
+        # detected languages are an input from here on. uploads that ask for
+        # detection again find this transcript under what they asked for
+        requested = fingerprints["transcribe"]
+        language = t.language
+        fingerprints = stage_fingerprints(
+            language, prompt, options, speech, streamed
+        )
+        if requested != fingerprints["transcribe"]:
+            await asyncio.to_thread(
+                remember, t, requested, fingerprints["transcribe"]
+            )
+        stale = [
+            stage
+            for stage in ["transcode", "transcribe"]
+            if not fresh(t, stage, fingerprints)
+        ]
+        t = await asyncio.to_thread(complete, t, fingerprints, *stale)
 
-        # ... and diarize
-        logger.info("diarizing...")
+        # align, diarize and draw peaks. all of them only read the transcoded
+        # file and the transcript, so run them at the same time
+        logger.info("aligning and diarizing...")
+        yield PipelineProgress(state="aligning")
         yield PipelineProgress(state="annotating")
-        t.diarization = annotate_fn(transcription_id)
+        stages = {
+            "align": lambda: align_fn(
+                transcription_id, language=language, speech=speech
+            ),
+            "annotate": lambda: annotate_fn(transcription_id, speech=speech),
+            # the editor can do without peaks, so failing them loses nothing
+            "peaks": optional(
+                lambda: peaks_fn(transcription_id, force_reprocessing=True)
+            ),
+        }
+
+        for name in list(stages):
+            if fresh(t, name, fingerprints):
+                del stages[name]
+            elif shared := await asyncio.to_thread(
+                reuse, t, name, fingerprints[name]
+            ):
+                t = await asyncio.to_thread(
+                    complete, shared, fingerprints, name
+                )
+                del stages[name]
+
+        if "align" not in stages:
+            yield AlignmentProgress(percent_done=100)
+        if "annotate" not in stages:
+            yield AnnotationProgress(percent_done=100)
+
+        changes = {}
+        async for name, result in run_concurrently(stages):
+            match name:
+                case "align":
+                    logger.info("completed alignment.")
+                    changes["alignment"] = result
+                    yield AlignmentProgress(percent_done=100)
+                case "annotate":
+                    logger.info("completed diarization.")
+                    changes["diarization"] = result
+                    yield AnnotationProgress(percent_done=100)
+                case "peaks" if isinstance(result, Exception):
+                    del stages["peaks"]
+                case "peaks":
+                    logger.info("completed peaks.")
 
         # .. and save
-        common.db.create(t)
+        t = await asyncio.to_thread(
+            complete, t, fingerprints, *stages, **changes
+        )
         logger.info("competed.")
 
         yield PipelineProgress(state="completed", transcription=t)
@@ -125,3 +363,435 @@ def pipeline(
         print(traceback.format_exc())
         logger.error(e)
         yield PipelineProgress(state="error")
+
+
+async def batch(
+    transcription_ids: typing.List[str],
+    language: str = None,
+    prompt: str = None,
+    media_path: str = common.MEDIA_PATH,
+    local_mode: bool = False,
+    priority: int = scheduler.BULK,
+):
+    """
+    Transcode and transcribe many short files, e.g. a bulk import of voice
+    notes. Files are transcribed in batches, each on a single resident
+    model. Yields (transcription_id, update) tuples, and saves each result as
+    soon as it arrives. A file that fails does not fail the others.
+    """
+
+    if local_mode:
+        transcode_fn = in_thread_gen(transcode.local)
+        batch_fn = in_thread_gen(transcribe_batch.local)
+    else:
+        transcode_fn = transcode.remote_gen.aio
+        batch_fn = scheduler.scheduled_gen("transcribe_batch", priority)
+
+    fingerprints = stage_fingerprints(language, prompt)
+    transcriptions = {}
+    for transcription_id in transcription_ids:
+        t = await asyncio.to_thread(common.db.select, transcription_id)
+        if not t:
+            logger.error(f"invalid id : {transcription_id}")
+            yield transcription_id, PipelineProgress(state="error")
+            continue
+        if t.stages is None:
+            t = replace(t, stages=legacy_stages(t, fingerprints, language))
+            await asyncio.to_thread(
+                common.db.update, transcription_id, stages=t.stages
+            )
+        transcriptions[transcription_id] = t
+
+    # transcode a group of files at a time
+    failed = set()
+    pending = [
+        x
+        for x, t in transcriptions.items()
+        if not fresh(t, "transcode", fingerprints)
+    ]
+    for group in chunked(pending, BATCH_TRANSCODES):
+        stages = {
+            x: guarded(
+                transcode_fn(x, media_path=media_path, force_reprocessing=True)
+            )
+            for x in group
+        }
+        async for x, update in interleave(stages):
+            if isinstance(update, scheduler.Failure):
+                logger.error(f"transcoding {x} failed: {update.error}")
+                failed.add(x)
+                yield x, PipelineProgress(state="error")
+                continue
+
+            t, update = await asyncio.to_thread(
+                on_transcoding, transcriptions[x], update
+            )
+            if update.track is not None:
+                t = await asyncio.to_thread(
+                    complete, t, fingerprints, "transcode"
+                )
+            transcriptions[x] = t
+            yield x, update
+
+    # transcribe the rest in batches, as many at once as the scheduler allows
+    pending = [
+        x
+        for x, t in transcriptions.items()
+        if x not in failed and not fresh(t, "transcribe", fingerprints)
+    ]
+    groups = dict(enumerate(chunked(pending, BATCH_FILES)))
+    stages = {
+        i: guarded(batch_fn(group, language, prompt))
+        for i, group in groups.items()
+    }
+    done = set()
+    async for i, update in interleave(stages):
+        match update:
+            case scheduler.Failure(error):
+                logger.error(f"batch {i} failed: {error}")
+                for x in groups[i]:
+                    if x not in done:
+                        done.add(x)
+                        yield x, PipelineProgress(state="error")
+            case BatchProgress(x, _, _, error) if error:
+                logger.error(error)
+                done.add(x)
+                yield x, PipelineProgress(state="error")
+            case BatchProgress(x, percent_done, None):
+                yield x, TranscriptionProgress(percent_done=percent_done)
+            case BatchProgress(x, _, transcript):
+                t, update = await asyncio.to_thread(
+                    on_transcription, transcriptions[x], transcript, language
+                )
+
+                # as in the pipeline, the detected language is an input
+                detected = stage_fingerprints(t.language, prompt)
+                if detected["transcribe"] != fingerprints["transcribe"]:
+                    await asyncio.to_thread(
+                        remember,
+                        t,
+                        fingerprints["transcribe"],
+                        detected["transcribe"],
+                    )
+                transcriptions[x] = await asyncio.to_thread(
+                    complete, t, detected, "transcribe"
+                )
+                done.add(x)
+                yield x, update
+
+
+def chunked(items: list, n: int) -> typing.List[list]:
+    return [items[i : i + n] for i in range(0, len(items), n)]
+
+
+async def guarded(generator: typing.AsyncIterator):
+    "Pass on the updates of a generator, ending with its failure, if any"
+    try:
+        async for update in generator:
+            yield update
+    except Exception as e:
+        yield scheduler.Failure(e)
+
+
+def on_transcoding(t: common.Transcription, update):
+    """
+    Handle a single transcoder update. Returns the updated transcription and
+    the progress event to send on.
+    """
+
+    match update:
+        case TranscodingProgress(percent_done, None):
+            return t, update
+        case TranscodingProgress(percent_done, track) if track is not None:
+            logger.info(f"completed transcoding. {track}")
+            t = replace(t, transcoded=True, track=track)
+            common.db.update(t.transcription_id, transcoded=True, track=track)
+            return t, update
+        case x:
+            raise ValueError(f"cannot parse TranscodingProgress: {x}")
+
+
+def on_transcription(t: common.Transcription, update, language: str = None):
+    """
+    Handle a single transcriber update. Returns the updated transcription and
+    the progress event to send on.
+    """
+
+    match update:
+        case int(percent_done):
+            return t, TranscriptionProgress(percent_done=percent_done)
+        case TranscriptionProgress():
+            return t, update
+        case dict(transcript):
+            # save results
+            if not language:
+                # save the detected language
+                language = transcript.get("language")
+            # completed
+            logger.info(f"completed transcription.")
+            t = replace(t, transcript=transcript, language=language)
+            common.db.update(
+                t.transcription_id, transcript=transcript, language=language
+            )
+            return t, TranscriptionProgress(
+                percent_done=100, transcript=t.transcript
+            )
+        case _:
+            update_str = f"{update} ({type(update)})"
+            raise ValueError(f"cannot parse TranscriptionProgress: {update_str}")
+
+
+async def interleave(generators: typing.Dict[str, typing.AsyncIterator]):
+    """
+    Consume several async generators at the same time. Yields (name, item)
+    tuples in the order in which items arrive. Raises the first error of any
+    of the generators.
+    """
+
+    done = object()
+    q = asyncio.Queue()
+
+    async def consume(name, generator):
+        try:
+            async for item in generator:
+                await q.put((name, item))
+            await q.put((name, done))
+        except Exception as e:
+            await q.put((name, e))
+
+    tasks = [
+        asyncio.create_task(consume(name, generator))
+        for name, generator in generators.items()
+    ]
+    try:
+        running = len(tasks)
+        while running:
+            name, item = await q.get()
+            if item is done:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield name, item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def run_concurrently(stages: typing.Dict[str, typing.Callable]):
+    """
+    Run independent pipeline stages at the same time. Yields (name, result)
+    tuples in order of completion. Stages are async callables, either modal
+    async calls or local calls in threads.
+    """
+
+    tasks = {asyncio.create_task(fn()): name for name, fn in stages.items()}
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield tasks[task], task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def optional(fn: typing.Callable):
+    """
+    A stage whose failure is logged and returned rather than raised, so that
+    it never aborts the stages it runs with.
+    """
+
+    async def call():
+        try:
+            return await fn()
+        except Exception as e:
+            logger.error(f"optional stage failed: {e}")
+            return e
+
+    return call
+
+
+def in_thread(fn: typing.Callable):
+    "An async version of a blocking call, for local mode"
+
+    async def call(*args, **kwargs):
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+    return call
+
+
+def in_thread_gen(fn: typing.Callable):
+    "An async version of a blocking generator, for local mode"
+
+    async def iterate(*args, **kwargs):
+        done = object()
+        generator = fn(*args, **kwargs)
+        while True:
+            item = await asyncio.to_thread(next, generator, done)
+            if item is done:
+                return
+            yield item
+
+    return iterate
+
+
+def stage_fingerprints(
+    language: str,
+    prompt: str,
+    options: asr.AsrOptions = None,
+    speech: bool = False,
+    streamed: bool = False,
+) -> typing.Dict[str, str]:
+    """
+    Fingerprints of everything each stage depends on, apart from the upload,
+    which never changes for a transcription. With speech, transcription,
+    alignment and diarization read the speech found by vad, apart from
+    streamed transcription, which reads the whole track.
+    """
+
+    options = options or asr.AsrOptions()
+
+    transcode = fingerprint("transcode", sample_rate=SAMPLE_RATE)
+    fingerprints, speech_inputs = {}, []
+    if speech:
+        fingerprints["vad"] = fingerprint(
+            "vad",
+            transcode,
+            threshold_db=vad.THRESHOLD_DB,
+            margin_db=vad.MARGIN_DB,
+            min_silence_seconds=vad.MIN_SILENCE_SECONDS,
+            pad_seconds=vad.PAD_SECONDS,
+            gap_seconds=vad.GAP_SECONDS,
+        )
+        speech_inputs = [fingerprints["vad"]]
+
+    transcribe = fingerprint(
+        "transcribe",
+        transcode,
+        *([] if streamed else speech_inputs),
+        language=language,
+        prompt=prompt,
+        **options.fingerprint_inputs(),
+    )
+    return fingerprints | {
+        "transcode": transcode,
+        "transcribe": transcribe,
+        "align": fingerprint(
+            "align",
+            transcribe,
+            *speech_inputs,
+            aligner=ALIGNER,
+            seconds_per_window=SECONDS_PER_WINDOW,
+        ),
+        "annotate": fingerprint(
+            "annotate", transcode, *speech_inputs, model=DIARIZATION_MODEL
+        ),
+        "peaks": fingerprint(
+            "peaks", transcode, samples_per_peak=SAMPLES_PER_PEAK
+        ),
+    }
+
+
+def fingerprint(stage: str, *upstream: str, **inputs) -> str:
+    key = json.dumps([stage, upstream, inputs], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def legacy_stages(
+    t: common.Transcription, fingerprints: dict, language: str
+) -> dict:
+    """
+    The stages that a transcription from before fingerprints has completed,
+    judged by the results it holds.
+    """
+
+    done = []
+    if t.transcoded and t.track:
+        done.append("transcode")
+        if t.peaks_file.exists():
+            done.append("peaks")
+        if t.diarization and t.diarization.turns:
+            done.append("annotate")
+        if t.transcribed and language == t.language:
+            done.append("transcribe")
+            if t.alignment and t.alignment.words:
+                done.append("align")
+
+    return {stage: fingerprints[stage] for stage in done}
+
+
+def fresh(t: common.Transcription, stage: str, fingerprints: dict) -> bool:
+    "Whether a stage completed with the inputs it has now"
+    return (t.stages or {}).get(stage) == fingerprints[stage]
+
+
+def complete(t: common.Transcription, fingerprints: dict, *stages, **changes):
+    """
+    Save the results of stages along with their fingerprints, and index them
+    for later uploads of the same media. Returns the updated transcription.
+    """
+
+    done = (t.stages or {}) | {stage: fingerprints[stage] for stage in stages}
+    if stages or changes:
+        common.db.update(t.transcription_id, stages=done, **changes)
+    for stage in stages:
+        remember(t, fingerprints[stage])
+
+    return replace(t, stages=done, **changes)
+
+
+def artifact_key(media_hash: str, fingerprint: str) -> typing.Optional[str]:
+    "Key of a stage result in the artifacts index"
+    if media_hash:
+        key = f"{media_hash}:{fingerprint}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
+def reuse(t: common.Transcription, stage: str, fingerprint: str):
+    """
+    Give t the result of a stage from an earlier upload of the same media.
+    Files are hard linked and fields shared, so nothing is copied. Returns
+    the updated transcription, or None if there is no earlier result.
+    """
+
+    key = artifact_key(t.upload.media_hash, fingerprint) if t.upload else None
+    source = common.db.find_artifact(key, stage, fingerprint) if key else None
+    if not source or source.transcription_id == t.transcription_id:
+        return None
+
+    names, files = STAGE_ARTIFACTS[stage]
+    if files and not getattr(source, files[0]).exists():
+        return None
+
+    for name in files:
+        if getattr(source, name).exists():
+            common.link_file(getattr(source, name), getattr(t, name))
+    if names:
+        common.db.share(source, t.transcription_id, *names)
+
+    logger.info(f"reusing {stage} of {source.transcription_id}")
+    return replace(t, **{name: getattr(source, name) for name in names})
+
+
+def reusable(t: common.Transcription, stage: str, fingerprint: str) -> bool:
+    "Whether t or an earlier upload of the same media has a stage result"
+    key = artifact_key(t.upload.media_hash, fingerprint) if t.upload else None
+    return bool(key and common.db.find_artifact(key, stage, fingerprint))
+
+
+def remember(
+    t: common.Transcription, fingerprint: str, resolved: str = None
+):
+    """
+    Record that t holds the result for a fingerprint. Results found under
+    what was asked for, like language detection, are recorded along with
+    the fingerprint that the stage resolved to.
+    """
+
+    key = artifact_key(t.upload.media_hash, fingerprint) if t.upload else None
+    if key:
+        common.db.add_artifact(key, t.transcription_id, resolved)
@@ -0,0 +1,266 @@
+"""
+Serve files by byte range, as media players request them when seeking.
+Bodies are handed to the server as file ranges where it supports the asgi
+zerocopysend extension, and are read with pread otherwise.
+"""
+
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+import logging
+import os
+import typing
+import uuid
+
+import anyio
+from starlette.responses import Response
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# largest read when the server can't send files itself
+MEDIA_CHUNK_SIZE = 1024 * 1024
+
+# asgi extension for handing file ranges to the server
+ZEROCOPY = "http.response.zerocopysend"
+
+
+class RangeError(Exception):
+    pass
+
+
+def parse_ranges(
+    header: str, total: int
+) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Parse a Range header into sorted, merged (start, end) byte ranges, both
+    inclusive. Open ended (500-) and suffix (-500) ranges are resolved
+    against the total size. Raises RangeError if the header is invalid or no
+    range is satisfiable.
+    """
+
+    unit, _, specs = header.partition("=")
+    if unit.strip() != "bytes" or not specs:
+        raise RangeError(f"invalid range: {header}")
+
+    ranges = []
+    for spec in specs.split(","):
+        first, dash, last = spec.strip().partition("-")
+        try:
+            if not dash or (not first and not last):
+                raise ValueError()
+            if not first:
+                # the last n bytes
+                start, end = max(0, total - int(last)), total - 1
+            else:
+                start = int(first)
+                end = int(last) if last else total - 1
+                if last and end < start:
+                    raise ValueError()
+                end = min(end, total - 1)
+        except ValueError:
+            raise RangeError(f"invalid range: {header}")
+
+        if start <= end:
+            ranges.append((start, end))
+
+    if not ranges:
+        raise RangeError(f"unsatisfiable range: {header}")
+
+    # merge overlapping and adjacent ranges
+    merged = [sorted(ranges)[0]]
+    for start, end in sorted(ranges)[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def entity_tag(stat: os.stat_result) -> str:
+    "A strong etag. Uploads are replaced rather than modified in place"
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def last_modified(stat: os.stat_result) -> str:
+    return formatdate(stat.st_mtime, usegmt=True)
+
+
+def not_modified(headers: typing.Mapping, etag: str, mtime: float) -> bool:
+    "Whether the client's copy is current, so that a 304 can be sent"
+
+    if_none_match = headers.get("if-none-match")
+    if if_none_match:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+
+    return False
+
+
+def if_range_holds(if_range: str, etag: str, modified: str) -> bool:
+    """
+    Whether a Range request may be honoured. If-Range holds either an etag
+    or a date, both of which must match exactly.
+    """
+
+    if not if_range:
+        return True
+    if if_range.startswith("W/"):
+        return False
+    return if_range.strip() in (etag, modified)
+
+
+class FileRangeResponse(Response):
+    """
+    Sends parts of a file, each behind an optional prefix, followed by a
+    trailer. Multipart bodies put their part headers in the prefixes.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        parts: typing.List[typing.Tuple[bytes, int, int]],
+        trailer: bytes = b"",
+        status_code: int = 200,
+        headers: typing.Mapping = None,
+        media_type: str = None,
+    ):
+        self.path = path
+        self.parts = parts
+        self.trailer = trailer
+        length = len(trailer) + sum(
+            len(prefix) + end - start + 1 for prefix, start, end in parts
+        )
+        super().__init__(
+            status_code=status_code,
+            headers={**(headers or {}), "Content-Length": str(length)},
+            media_type=media_type,
+        )
+
+    async def __call__(self, scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+
+        if scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        zerocopy = ZEROCOPY in scope.get("extensions", {})
+        with open(self.path, "rb") as f:
+            for prefix, start, end in self.parts:
+                if prefix:
+                    body = {"body": prefix, "more_body": True}
+                    await send({"type": "http.response.body", **body})
+                if zerocopy:
+                    await send(
+                        {
+                            "type": ZEROCOPY,
+                            "file": f,
+                            "offset": start,
+                            "count": end - start + 1,
+                            "more_body": True,
+                        }
+                    )
+                else:
+                    await send_range(send, f.fileno(), start, end)
+
+        await send({"type": "http.response.body", "body": self.trailer})
+
+
+async def send_range(send, fd: int, start: int, end: int):
+    pos = start
+    while pos <= end:
+        size = min(MEDIA_CHUNK_SIZE, end - pos + 1)
+        chunk = await anyio.to_thread.run_sync(os.pread, fd, size, pos)
+        if not chunk:
+            raise RangeError(f"file truncated at {pos}")
+        await send(
+            {"type": "http.response.body", "body": chunk, "more_body": True}
+        )
+        pos += len(chunk)
+
+
+def file_response(
+    path: Path, content_type: str, headers: typing.Mapping
+) -> Response:
+    """
+    Answer a GET or HEAD for path, honouring Range, If-Range,
+    If-None-Match and If-Modified-Since request headers.
+    """
+
+    stat = os.stat(path)
+    total = stat.st_size
+    etag = entity_tag(stat)
+    modified = last_modified(stat)
+    validators = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": modified,
+    }
+
+    if not_modified(headers, etag, stat.st_mtime):
+        return Response(status_code=304, headers=validators)
+
+    range_header = headers.get("range")
+    if not range_header or not if_range_holds(
+        headers.get("if-range"), etag, modified
+    ):
+        parts = [(b"", 0, total - 1)] if total else []
+        return FileRangeResponse(
+            path, parts, headers=validators, media_type=content_type
+        )
+
+    try:
+        ranges = parse_ranges(range_header, total)
+    except RangeError as e:
+        logger.error(e)
+        return Response(
+            status_code=416, headers={"Content-Range": f"bytes */{total}"}
+        )
+
+    logger.info(f"reading ranges {ranges} of {total}")
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        return FileRangeResponse(
+            path,
+            [(b"", start, end)],
+            status_code=206,
+            headers=validators
+            | {"Content-Range": f"bytes {start}-{end}/{total}"},
+            media_type=content_type,
+        )
+
+    boundary = uuid.uuid4().hex
+    parts = [
+        (
+            (b"\r\n" if i else b"")
+            + f"--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{total}\r\n\r\n".encode(),
+            start,
+            end,
+        )
+        for i, (start, end) in enumerate(ranges)
+    ]
+    return FileRangeResponse(
+        path,
+        parts,
+        trailer=f"\r\n--{boundary}--\r\n".encode(),
+        status_code=206,
+        headers=validators,
+        media_type=f"multipart/byteranges; boundary={boundary}",
+    )
@@ -0,0 +1,359 @@
+"""
+Scheduling of the gpu stages of the pipeline. Stage calls are queued, and
+each pool of gpus runs a limited number of them at once. Queued calls run in
+priority order: interactive re-runs first and bulk imports last, and shorter
+files first within each of these. Short calls of a stage are batched onto one
+slot, so that they run back to back on one warm container.
+
+One container runs the scheduler for the whole app. Pipelines call the gpu
+stages through it, and it calls the stages with an executor, which is a stub
+in tests.
+"""
+
+from dataclasses import dataclass, field
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import json
+import logging
+import math
+import statistics
+import time
+import typing
+
+from modal import Image
+
+from align import align
+from annotate import annotate
+from transcribe import (
+    transcribe,
+    transcribe_batch,
+    transcribe_cpu,
+    transcribe_map,
+)
+import common
+from common import app
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# priority classes. lower runs first
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+# gpus per pool, i.e. the most concurrent calls of its stages. the cpu pool
+# counts cpu only containers instead
+POOL_LIMITS = {"transcribe": 8, "align": 4, "annotate": 4, "cpu": 16}
+
+# stages by the pool whose gpus they use. map workers each take a gpu
+STAGE_POOLS = {
+    "transcribe": "transcribe",
+    "transcribe_cpu": "cpu",
+    "transcribe_map": "transcribe",
+    "transcribe_batch": "transcribe",
+    "align": "align",
+    "annotate": "annotate",
+}
+
+# files up to this long are batched
+BATCH_MAX_SECONDS = 180
+
+# most calls in a batch
+BATCH_SIZE = 4
+
+# waits kept for the wait time metrics
+WAITS_KEPT = 1000
+
+# the scheduler container publishes its metrics to the volume this often
+METRICS_SECONDS = 5
+METRICS_FILE = common.MEDIA_PATH / "scheduler.json"
+
+scheduler_image = Image.debian_slim(python_version="3.10.8")
+
+
+class SchedulerError(Exception):
+    pass
+
+
+@dataclass
+class Call:
+    "A queued stage call"
+
+    stage: str
+    args: tuple
+    kwargs: dict
+    priority: int
+    # seconds of media, if known
+    duration: float
+    # gpus used
+    weight: int
+    # submission order, which breaks ties
+    seq: int
+    submitted: float = field(default_factory=time.monotonic)
+    updates: asyncio.Queue = field(default_factory=asyncio.Queue)
+    cancelled: bool = False
+
+    @property
+    def key(self):
+        duration = math.inf if self.duration is None else self.duration
+        return (self.priority, duration, self.seq)
+
+    @property
+    def short(self):
+        return (
+            self.weight == 1
+            and self.duration is not None
+            and self.duration <= BATCH_MAX_SECONDS
+        )
+
+
+@dataclass
+class Failure:
+    error: Exception
+
+
+# the last update of a call
+DONE = object()
+
+
+class Scheduler:
+    """
+    Queues stage calls and runs them with execute, an async generator that
+    yields the updates of a call. Runs in one event loop.
+    """
+
+    def __init__(
+        self,
+        execute: typing.Callable[[Call], typing.AsyncIterator],
+        limits: typing.Dict[str, int] = None,
+        batch_size: int = BATCH_SIZE,
+    ):
+        self.execute = execute
+        self.limits = limits or POOL_LIMITS
+        self.batch_size = batch_size
+        self.queues = collections.defaultdict(list)
+        self.running = collections.defaultdict(int)
+        self.waits = collections.deque(maxlen=WAITS_KEPT)
+        self.seq = itertools.count()
+        self.tasks = set()
+
+    async def submit(
+        self,
+        stage: str,
+        *args,
+        priority: int = NORMAL,
+        duration: float = None,
+        weight: int = 1,
+        **kwargs,
+    ):
+        """
+        Queue a stage call, and yield its updates once it runs. Raises the
+        error of the call, if it failed.
+        """
+
+        pool = STAGE_POOLS.get(stage)
+        if pool not in self.limits:
+            raise SchedulerError(f"unknown stage: {stage}")
+
+        call = Call(
+            stage=stage,
+            args=args,
+            kwargs=kwargs,
+            priority=priority,
+            duration=duration,
+            weight=min(weight, self.limits[pool]),
+            seq=next(self.seq),
+        )
+        heapq.heappush(self.queues[pool], (call.key, call))
+        self.dispatch(pool)
+
+        try:
+            while (update := await call.updates.get()) is not DONE:
+                if isinstance(update, Failure):
+                    raise update.error
+                yield update
+        finally:
+            # a call that was given up on before it ran is dropped
+            call.cancelled = True
+
+    def dispatch(self, pool: str):
+        "Start queued calls of a pool while it has free gpus"
+        queue = self.queues[pool]
+        while queue:
+            _, call = queue[0]
+            if call.cancelled:
+                heapq.heappop(queue)
+                continue
+            # calls behind a heavy one wait too, so that it is not starved
+            if self.running[pool] + call.weight > self.limits[pool]:
+                break
+
+            heapq.heappop(queue)
+            batch = [call]
+            while call.short and queue and len(batch) < self.batch_size:
+                _, other = queue[0]
+                if not other.short or other.stage != call.stage:
+                    break
+                heapq.heappop(queue)
+                if not other.cancelled:
+                    batch.append(other)
+
+            now = time.monotonic()
+            self.waits.extend(now - x.submitted for x in batch)
+            self.running[pool] += call.weight
+            task = asyncio.create_task(self.run(pool, call.weight, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, pool: str, weight: int, batch: typing.List[Call]):
+        "Run a batch of calls back to back on one slot of a pool"
+        try:
+            for call in batch:
+                if call.cancelled:
+                    continue
+                try:
+                    async for update in self.execute(call):
+                        call.updates.put_nowait(update)
+                    call.updates.put_nowait(DONE)
+                except Exception as e:
+                    logger.error(f"{call.stage} failed: {e}")
+                    call.updates.put_nowait(Failure(e))
+        finally:
+            self.running[pool] -= weight
+            self.dispatch(pool)
+
+    def metrics(self) -> dict:
+        "Queue lengths and gpus in use per pool, and recent wait times"
+        waits = sorted(self.waits)
+        return {
+            "queued": {
+                pool: sum(not call.cancelled for _, call in queue)
+                for pool, queue in self.queues.items()
+            },
+            "running": dict(self.running),
+            "wait_seconds": {
+                "count": len(waits),
+                "mean": statistics.fmean(waits) if waits else 0.0,
+                "p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                "max": waits[-1] if waits else 0.0,
+            },
+        }
+
+    async def publish(self, seconds: float = METRICS_SECONDS):
+        "Write the metrics to the volume, for the web containers"
+        while True:
+            metrics = json.dumps(self.metrics())
+            await asyncio.to_thread(common.write_atomic, METRICS_FILE, metrics)
+            await asyncio.sleep(seconds)
+
+
+def read_metrics() -> dict:
+    "The metrics last published by the scheduler container"
+    try:
+        return json.loads(METRICS_FILE.read_text())
+    except FileNotFoundError:
+        return {}
+
+
+async def modal_execute(call: Call):
+    "Executes calls as modal function calls"
+    match call.stage:
+        case "transcribe":
+            fn = transcribe.remote_gen.aio
+        case "transcribe_cpu":
+            fn = transcribe_cpu.remote_gen.aio
+        case "transcribe_map":
+            fn = transcribe_map.remote_gen.aio
+        case "transcribe_batch":
+            fn = transcribe_batch.remote_gen.aio
+        case "align":
+            yield await align.remote.aio(*call.args, **call.kwargs)
+            return
+        case "annotate":
+            yield await annotate.remote.aio(*call.args, **call.kwargs)
+            return
+
+    async for update in fn(*call.args, **call.kwargs):
+        yield update
+
+
+@functools.cache
+def default_scheduler() -> Scheduler:
+    "The scheduler of this container. Needs a running event loop"
+    scheduler = Scheduler(modal_execute)
+    scheduler.tasks.add(asyncio.create_task(scheduler.publish()))
+    return scheduler
+
+
+@app.function(
+    image=scheduler_image,
+    network_file_systems=common.nfs,
+    concurrency_limit=1,
+    allow_concurrent_inputs=1000,
+    keep_warm=1,
+    timeout=3600,
+)
+async def schedule(
+    stage: str,
+    args: tuple,
+    kwargs: dict,
+    priority: int = NORMAL,
+    duration: float = None,
+    weight: int = 1,
+):
+    """
+    Run a stage call through the scheduler of the app, and yield its updates.
+    """
+
+    scheduler = default_scheduler()
+    async for update in scheduler.submit(
+        stage,
+        *args,
+        priority=priority,
+        duration=duration,
+        weight=weight,
+        **kwargs,
+    ):
+        yield update
+
+
+def scheduled_gen(stage: str, priority: int = NORMAL):
+    "A generator stage, called through the scheduler"
+
+    async def call(transcription_id, *args, **kwargs):
+        # batches are queued by the duration of all of their files
+        ids = transcription_id
+        if isinstance(transcription_id, str):
+            ids = [transcription_id]
+
+        duration = 0.0
+        for x in ids:
+            t = await asyncio.to_thread(common.db.select, x)
+            if not t or not t.track or t.track.duration is None:
+                duration = None
+                break
+            duration += t.track.duration
+
+        weight = kwargs.get("n_workers", 1)
+        async for update in schedule.remote_gen.aio(
+            stage, (transcription_id, *args), kwargs, priority, duration, weight
+        ):
+            yield update
+
+    return call
+
+
+def scheduled(stage: str, priority: int = NORMAL):
+    "A stage with a single result, called through the scheduler"
+    gen = scheduled_gen(stage, priority)
+
+    async def call(*args, **kwargs):
+        result = None
+        async for result in gen(*args, **kwargs):
+            pass
+        return result
+
+    return call
@@ -1,15 +1,22 @@
-from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+import asyncio
+import hashlib
 import json
 import os
 from pathlib import Path
+import struct
 from unittest.mock import patch
 
 from fastapi import HTTPException, status
 from fastapi.testclient import TestClient
+import numpy as np
 import pytest
 
 import app
 import common
+import jobs
+import peaks
 
 
 @dataclass
@@ -76,6 +83,66 @@ def test_upload_chunk(client, transcription_id="abc"):
             assert res.status_code == 200, res.text
 
 
+parallel_stub = MockedStub()
+
+
+@patch("app.app", new=parallel_stub)
+@patch("common.app", new=parallel_stub)
+@patch("common.transcriptions", new=dict())
+def test_parallel_upload(client):
+    content = os.urandom(3 * 65536 + 100)
+    with common.tmpdir_scope() as tmp_dir:
+        media_path = Path(tmp_dir)
+        with patch("common.db", new=common.Store(media_path)), patch(
+            "common.MEDIA_PATH", new=media_path
+        ):
+            res = client.post(
+                "/upload",
+                json={
+                    "filename": "file.name",
+                    "content_type": "audio/mp3",
+                    "size_bytes": len(content),
+                    "chunk_size": 65536,
+                },
+            )
+            assert res.status_code == 200, res.text
+            transcription_id = res.json()
+
+            def put(start, end):
+                return client.put(
+                    f"/upload/{transcription_id}",
+                    content=content[start : end + 1],
+                    headers={
+                        "Content-Range": f"bytes={start}-{end}/{len(content)}",
+                        "Content-Type": "audio/mp3",
+                    },
+                )
+
+            # in parallel and out of order
+            spans = [(196608, 196707), (65536, 131071), (0, 65535)]
+            with ThreadPoolExecutor(3) as pool:
+                for res in pool.map(lambda s: put(*s), spans):
+                    assert res.status_code == 308, res.text
+
+            # not on a chunk boundary
+            assert put(100, 65635).status_code == 400
+
+            res = client.get(f"/upload/{transcription_id}/chunks")
+            assert res.json() == {"chunk_size": 65536, "missing": [2]}
+
+            url = f"/upload/{transcription_id}/finalize"
+            res = client.post(url, json={"size_bytes": len(content)})
+            assert res.status_code == 409
+
+            assert put(131072, 196607).status_code == 308
+            checksum = f"sha256:{hashlib.sha256(content).hexdigest()}"
+            res = client.post(
+                url, json={"size_bytes": len(content), "checksum": checksum}
+            )
+            assert res.status_code == 200, res.text
+            assert (media_path / transcription_id).read_bytes() == content
+
+
 resume_stub = MockedStub()
 
 
@@ -229,3 +296,378 @@ we're speaking about which is
 """
 
             assert res.text.startswith(want)
+
+
+alignment_stub = MockedStub()
+
+
+@patch("app.app", new=alignment_stub)
+@patch("common.app", new=alignment_stub)
+@patch("common.transcriptions", new=dict())
+def test_alignment(client, transcription_id="abc"):
+    alignment = common.Alignment(words=[common.Segment("hi", 0.5, 1.0, 0.5)])
+    with common.tmpdir_scope() as tmp_dir:
+        media_path = Path(tmp_dir)
+        with patch("common.db", new=common.Store(media_path)):
+            common.db.create(
+                common.Transcription(
+                    transcription_id=transcription_id,
+                    path=media_path / transcription_id,
+                    alignment=alignment,
+                    upload=common.UploadInfo(filename="file.name"),
+                )
+            )
+
+            res = client.get(f"/transcription/{transcription_id}/alignment")
+            assert res.status_code == 200
+            assert res.headers["content-type"] == "application/octet-stream"
+            assert common.Alignment.from_bytes(res.content) == alignment
+
+
+transcription_stub = MockedStub()
+
+
+@patch("app.app", new=transcription_stub)
+@patch("common.app", new=transcription_stub)
+@patch("common.transcriptions", new=dict())
+def test_transcription(client, transcription_id="abc"):
+    words = [common.Segment(f"w{i}", i, i + 1, 1.0) for i in range(2500)]
+    with common.tmpdir_scope() as tmp_dir:
+        media_path = Path(tmp_dir)
+        with patch("common.db", new=common.Store(media_path)):
+            t = common.Transcription(
+                transcription_id=transcription_id,
+                path=media_path / transcription_id,
+                track=common.Track(title="my track"),
+                transcript={
+                    "text": "a b",
+                    "segments": [
+                        {"id": 0, "start": 0.0, "end": 60.0, "text": "a"},
+                        {"id": 1, "start": 60.0, "end": 120.0, "text": "b"},
+                    ],
+                },
+                alignment=common.Alignment(words=words),
+                upload=common.UploadInfo(filename="file.name"),
+            )
+            common.db.create(t)
+
+            # everything, as before, and as the store reads it back
+            res = client.get(f"/transcription/{transcription_id}")
+            assert res.status_code == 200
+            t = common.read_back(t)
+            want = json.loads(json.dumps(asdict(t), cls=common.JSONEncoder))
+            assert res.json() == want
+
+            # some fields
+            res = client.get(
+                f"/transcription/{transcription_id}?fields=track,language"
+            )
+            assert res.json() == {"track": want["track"], "language": None}
+
+            # a time range
+            res = client.get(
+                f"/transcription/{transcription_id}"
+                "?fields=transcript,alignment&from=100&to=110"
+            )
+            got = res.json()
+            assert [s["id"] for s in got["transcript"]["segments"]] == [1]
+            labels = [w["label"] for w in got["alignment"]["words"]]
+            assert labels == [f"w{i}" for i in range(100, 110)]
+
+            res = client.get(f"/transcription/{transcription_id}?fields=nope")
+            assert res.status_code == 400
+
+
+transcribe_stub = MockedStub()
+
+
+async def failing_pipeline(transcription_id, language, **kwargs):
+    yield app.PipelineProgress(state="transcoding")
+    raise ValueError("boom")
+
+
+@dataclass
+class LocalJobs:
+    "Runs jobs in the calling event loop instead of spawning them"
+
+    spawned: list = field(default_factory=list)
+    params: list = field(default_factory=list)
+
+    @property
+    def spawn(self):
+        return self
+
+    async def aio(self, transcription_id, number, **kwargs):
+        self.params.append(kwargs)
+        t = common.db.select(transcription_id)
+        job = jobs.JobLog(t.jobs_path, number)
+        updates = failing_pipeline(transcription_id, **kwargs)
+        self.spawned.append(asyncio.create_task(jobs.run(job, updates)))
+
+
+@patch("app.app", new=transcribe_stub)
+@patch("common.app", new=transcribe_stub)
+@patch("common.transcriptions", new=dict())
+def test_transcribe_events(client, transcription_id="abc"):
+    with common.tmpdir_scope() as tmp_dir:
+        media_path = Path(tmp_dir)
+        local_jobs = LocalJobs()
+        with (
+            patch("common.db", new=common.Store(media_path)),
+            patch("jobs.run_job", new=local_jobs),
+        ):
+            common.db.create(
+                common.Transcription(
+                    transcription_id=transcription_id,
+                    path=media_path / transcription_id,
+                    upload=common.UploadInfo(filename="file.name"),
+                )
+            )
+
+            res = client.get(f"/transcribe/{transcription_id}")
+            assert res.status_code == 200
+            assert res.headers["content-type"].startswith("text/event-stream")
+            events = [e for e in res.text.split("\n\n") if e]
+            assert events == [
+                f"id: 1-{i + 1}\n"
+                + common.dataclass_to_event(app.PipelineProgress(s))[:-2]
+                for i, s in enumerate(["transcoding", "error"])
+            ]
+
+            # reconnecting replays the job instead of starting another
+            res = client.get(
+                f"/transcribe/{transcription_id}",
+                headers={"Last-Event-ID": "1-1"},
+            )
+            assert res.text.startswith("id: 1-2\n")
+            assert len(local_jobs.spawned) == 1
+
+            # a new viewer of a finished job starts the next one
+            res = client.get(f"/transcribe/{transcription_id}")
+            assert res.text.startswith("id: 2-1\n")
+            assert len(local_jobs.spawned) == 2
+
+            res = client.get("/transcribe/nope")
+            assert res.status_code == 404
+
+
+@dataclass
+class SpawnedBatches:
+    "Records bulk imports instead of spawning them"
+
+    spawned: list = field(default_factory=list)
+
+    @property
+    def spawn(self):
+        return self
+
+    async def aio(self, transcription_ids, **kwargs):
+        self.spawned.append((transcription_ids, kwargs))
+
+
+batch_stub = MockedStub()
+
+
+@patch("app.app", new=batch_stub)
+@patch("common.app", new=batch_stub)
+@patch("common.transcriptions", new=dict())
+def test_bulk_import(client):
+    with common.tmpdir_scope() as tmp_dir:
+        media_path = Path(tmp_dir)
+        batches = SpawnedBatches()
+        with (
+            patch("common.db", new=common.Store(media_path)),
+            patch("jobs.run_batch", new=batches),
+        ):
+            common.db.create_many(
+                [
+                    common.Transcription(
+                        transcription_id=transcription_id,
+                        path=media_path / transcription_id,
+                        upload=common.UploadInfo(filename="file.name"),
+                    )
+                    for transcription_id in ["a", "b"]
+                ]
+            )
+
+            ids = {"transcription_ids": ["a", "b", "a"], "language": "de"}
+            res = client.post("/batch", json=ids)
+            assert res.status_code == 202
+            assert batches.spawned == [(["a", "b"], {"language": "de"})]
+
+            res = client.post("/batch", json={"transcription_ids": ["nope"]})
+            assert res.status_code == 404
+            res = client.post("/batch", json={"transcription_ids": []})
+            assert res.status_code == 400
+            assert len(batches.spawned) == 1
+
+
+class StubGPT:
+    def complete(self, description):
+        return f"Names: {description}"
+
+
+@patch("app.app", new=transcribe_stub)
+@patch("common.app", new=transcribe_stub)
+@patch("common.transcriptions", new=dict())
+@patch("common.whisper_gpt", new=StubGPT)
+def test_transcribe_prompt(client, transcription_id="abc"):
+    with common.tmpdir_scope() as tmp_dir:
+        media_path = Path(tmp_dir)
+        local_jobs = LocalJobs()
+        with (
+            patch("common.db", new=common.Store(media_path)),
+            patch("jobs.run_job", new=local_jobs),
+        ):
+            common.db.create(
+                common.Transcription(
+                    transcription_id=transcription_id,
+                    path=media_path / transcription_id,
+                    track=common.Track(description="Ada Lovelace"),
+                    upload=common.UploadInfo(filename="file.name"),
+                )
+            )
+
+            # the prompt from the description reaches the job
+            client.get(f"/transcribe/{transcription_id}")
+            assert local_jobs.params[0]["prompt"] == "Names: Ada Lovelace"
+
+            # asr options come from clients, so only known ones are loaded
+            for query in ["model=someone/huge-model", "device=cuda:3"]:
+                res = client.get(f"/transcribe/{transcription_id}?{query}")
+                assert res.status_code == 400
+            assert len(local_jobs.params) == 1
+
+
+media_stub = MockedStub()
+
+
+@patch("app.app", new=media_stub)
+@patch("common.app", new=media_stub)
+@patch("common.transcriptions", new=dict())
+def test_media(client, transcription_id="abc"):
+    content = os.urandom(3000)
+    with common.tmpdir_scope() as tmp_dir:
+        media_path = Path(tmp_dir)
+        with patch("common.db", new=common.Store(media_path)):
+            (media_path / transcription_id).write_bytes(content)
+            common.db.create(
+                common.Transcription(
+                    transcription_id=transcription_id,
+                    path=media_path / transcription_id,
+                    upload=common.UploadInfo(content_type="audio/mp3"),
+                )
+            )
+            url = f"/media/{transcription_id}"
+
+            # whole file
+            res = client.get(url)
+            assert res.status_code == 200
+            assert res.content == content
+            etag = res.headers["etag"]
+
+            # a single range
+            res = client.get(url, headers={"range": "bytes=100-"})
+            assert res.status_code == 206
+            assert res.content == content[100:]
+            assert res.headers["content-length"] == "2900"
+            assert res.headers["content-range"] == "bytes 100-2999/3000"
+
+            # several ranges
+            res = client.get(url, headers={"range": "bytes=0-9,-10"})
+            assert res.status_code == 206
+            assert res.headers["content-length"] == str(len(res.content))
+            boundary = res.headers["content-type"].split("boundary=")[1]
+            parts = res.content.split(f"--{boundary}".encode())
+            assert parts[1].endswith(b"\r\n\r\n" + content[:10] + b"\r\n")
+            assert b"Content-Range: bytes 2990-2999/3000" in parts[2]
+            assert parts[2].endswith(content[-10:] + b"\r\n")
+            assert parts[3] == b"--\r\n"
+
+            # validators
+            res = client.get(url, headers={"if-none-match": etag})
+            assert res.status_code == 304
+            res = client.get(
+                url, headers={"range": "bytes=0-9", "if-range": etag}
+            )
+            assert res.status_code == 206
+            res = client.get(
+                url, headers={"range": "bytes=0-9", "if-range": '"stale"'}
+            )
+            assert res.status_code == 200
+            assert res.content == content
+
+            res = client.get(url, headers={"range": "bytes=5000-"})
+            assert res.status_code == 416
+            assert res.headers["content-range"] == "bytes */3000"
+
+            res = client.head(url, headers={"range": "bytes=0-9"})
+            assert res.headers["content-length"] == "10"
+            assert res.content == b""
+
+
+@patch("app.app", new=media_stub)
+@patch("common.app", new=media_stub)
+@patch("common.transcriptions", new=dict())
+def test_media_proxy(client, transcription_id="abc"):
+    with common.tmpdir_scope() as tmp_dir:
+        media_path = Path(tmp_dir)
+        with patch("common.db", new=common.Store(media_path)):
+            t = common.Transcription(
+                transcription_id=transcription_id,
+                path=media_path / transcription_id,
+                upload=common.UploadInfo(content_type="audio/mp3"),
+            )
+            t.uploaded_file.write_bytes(b"original")
+            t.audio_proxy_file.write_bytes(b"proxy")
+            common.db.create(t)
+            url = f"/media/{transcription_id}/proxy"
+
+            # the proxy may be incomplete until transcoding has finished
+            res = client.get(url)
+            assert res.content == b"original"
+            assert res.headers["content-type"] == "audio/mp3"
+
+            common.db.update(transcription_id, transcoded=True)
+            res = client.get(url)
+            assert res.content == b"proxy"
+            assert res.headers["content-type"] == "audio/mp4"
+
+
+peaks_stub = MockedStub()
+
+
+@patch("app.app", new=peaks_stub)
+@patch("common.app", new=peaks_stub)
+@patch("common.transcriptions", new=dict())
+def test_peaks(client, transcription_id="abc"):
+    with common.tmpdir_scope() as tmp_dir:
+        media_path = Path(tmp_dir)
+        with patch("common.db", new=common.Store(media_path)):
+            t = common.Transcription(
+                transcription_id=transcription_id,
+                path=media_path / transcription_id,
+                upload=common.UploadInfo(),
+            )
+            common.db.create(t)
+
+            res = client.get(f"/peaks/{transcription_id}")
+            assert res.status_code == 404
+
+            levels = [np.array([[-1, 1], [-2, 2]]), np.array([[-2, 2]])]
+            peaks.write_peaks(t.peaks_file, levels, 16000)
+
+            res = client.get(f"/peaks/{transcription_id}?zoom=1")
+            assert res.status_code == 200
+            assert res.content == struct.pack("<hh", -2, 2)
+            assert res.headers["peaks-samples-per-peak"] == "512"
+
+            res = client.get(f"/peaks/{transcription_id}?zoom=2")
+            assert res.status_code == 400
+
+
+def test_metrics(client):
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert "hits" in res.json()["store_cache"]
+    assert "models" in res.json()
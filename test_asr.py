@@ -0,0 +1,81 @@
+from dataclasses import replace
+from types import SimpleNamespace
+
+import pytest
+
+import asr
+
+
+class StubFasterWhisper:
+    "Yields segments the way faster_whisper.WhisperModel.transcribe does"
+
+    def __init__(self, spans):
+        self.spans = spans
+
+    def transcribe(self, audio_file, language=None, initial_prompt=None):
+        segments = (
+            SimpleNamespace(
+                seek=int(start * 100),
+                start=start,
+                end=end,
+                text=text,
+                tokens=(1, 2),
+                temperature=0.0,
+                avg_logprob=-0.2,
+                compression_ratio=1.1,
+                no_speech_prob=0.01,
+            )
+            for start, end, text in self.spans
+        )
+        info = SimpleNamespace(language=language or "en", duration=20.0)
+        return segments, info
+
+
+def test_faster_whisper_transcript():
+    spans = [(0.0, 4.0, " One."), (5.0, 10.0, " Two."), (12.0, 20.0, " Three.")]
+    backend = object.__new__(asr.FasterWhisperBackend)
+    backend.model = StubFasterWhisper(spans)
+
+    progress = []
+    transcript = backend.transcribe("a.wav", 20.0, progress=progress.append)
+
+    # shaped like a whisper transcript, so align and formats can read it
+    assert transcript["text"] == " One. Two. Three."
+    assert transcript["language"] == "en"
+    assert [s["id"] for s in transcript["segments"]] == [0, 1, 2]
+    assert transcript["segments"][1]["start"] == 5.0
+    assert transcript["segments"][1]["tokens"] == [1, 2]
+    assert progress == [20, 50, 99]
+
+
+def test_options():
+    assert asr.AsrOptions.from_dict(None) == asr.AsrOptions()
+    options = asr.AsrOptions.from_dict(
+        {"backend": "faster-whisper", "model": None, "device": "cpu"}
+    )
+    assert options.backend == asr.FASTER_WHISPER
+    assert options.model == asr.AsrOptions().model
+    assert options.cpu
+
+    # defaults of the backend on the device
+    faster = asr.AsrOptions(backend=asr.FASTER_WHISPER)
+    assert faster.resolved_compute_type == "float16"
+    assert replace(faster, device="cpu").resolved_compute_type == "int8"
+    assert asr.AsrOptions(device="cpu").resolved_compute_type == "float32"
+
+    with pytest.raises(asr.AsrError):
+        asr.AsrOptions.from_dict({"backend": "nope"})
+    with pytest.raises(asr.AsrError):
+        asr.AsrOptions.from_dict({"beam_size": 5})
+
+    # only what a container can safely load
+    for d in [
+        {"model": "someone/huge-model"},
+        {"model": "/etc"},
+        {"backend": "whisper", "model": "large-v3"},
+        {"compute_type": "int8"},
+        {"backend": "faster-whisper", "compute_type": "int4"},
+        {"device": "cuda:3"},
+    ]:
+        with pytest.raises(asr.AsrError):
+            asr.AsrOptions.from_dict(d)
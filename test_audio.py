@@ -0,0 +1,114 @@
+from pathlib import Path
+import wave
+
+import numpy as np
+
+import audio
+import common
+
+
+def write_wav(path, samples, sample_rate=16000):
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.astype(np.int16).tobytes())
+
+
+def tone(seconds, sample_rate=16000, amplitude=8000):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return amplitude * np.sin(2 * np.pi * 440 * t)
+
+
+def silence(seconds, sample_rate=16000):
+    return np.zeros(int(seconds * sample_rate))
+
+
+def test_read_wav():
+    with common.tmpdir_scope() as tmp:
+        path = Path(tmp) / "a.wav"
+        write_wav(path, tone(1.5))
+        samples, sample_rate = audio.read_wav(path)
+        assert sample_rate == 16000
+        assert len(samples) == 24000
+        assert samples.dtype == np.int16
+        assert np.abs(audio.to_float(samples)).max() <= 1.0
+
+
+def test_read_stereo_fixture():
+    samples, sample_rate = audio.read_wav(Path("fixtures/one.wav"))
+    assert sample_rate == 16000
+    assert samples.shape == (22640, 2)
+    assert audio.to_float(samples).shape == (22640,)
+
+
+def test_split_at_silence():
+    samples = np.concatenate(
+        [tone(8), silence(1), tone(9), silence(0.5), tone(5)]
+    ).astype(np.int16)
+
+    spans = audio.split_at_silence(
+        samples, 16000, chunk_seconds=10, search_seconds=4
+    )
+
+    # cuts fall into the silences, not at fixed 10s boundaries
+    assert len(spans) == 3
+    assert spans[0][0] == 0
+    assert spans[-1][1] == len(samples)
+    assert 8.0 <= spans[0][1] / 16000 <= 9.0
+    assert 17.0 <= spans[1][1] / 16000 <= 18.5
+    for (_, end), (start, _) in zip(spans, spans[1:]):
+        assert end == start
+
+
+def test_speech_regions():
+    samples = np.concatenate(
+        [silence(3), tone(2), silence(5), tone(1), silence(0.5), tone(1)]
+    ).astype(np.int16)
+
+    regions = audio.speech_regions(samples, 16000, pad_seconds=0.2)
+    seconds = [(start / 16000, end / 16000) for start, end in regions]
+
+    # padded up to the ends of the file, and the short pause is bridged
+    assert len(seconds) == 2
+    assert np.allclose(seconds[0], (2.8, 5.2), atol=0.05)
+    assert np.allclose(seconds[1], (9.8, 12.5), atol=0.05)
+
+
+def test_speech_regions_silence():
+    samples = silence(10).astype(np.int16)
+    assert audio.speech_regions(samples, 16000) == []
+
+
+def test_split_short():
+    samples = tone(3).astype(np.int16)
+    assert audio.split_at_silence(samples, 16000, chunk_seconds=10) == [
+        (0, len(samples))
+    ]
+
+
+def test_read_float_fixture():
+    samples, sample_rate = audio.read_wav(Path("fixtures/two.wav"))
+    assert samples.dtype == np.float32
+    assert sample_rate == 44100
+    assert audio.to_float(samples).ndim == 1
+
+
+def test_peak_pyramid():
+    samples = np.array([1, -5, 3, 2, 9, -1, 0, 4, 7], dtype=np.int16)
+    levels = audio.peak_pyramid(samples, samples_per_peak=2)
+    assert [x.tolist() for x in levels] == [
+        [[-5, 1], [2, 3], [-1, 9], [0, 4], [7, 7]],
+        [[-5, 3], [-1, 9], [7, 7]],
+        [[-5, 9], [7, 7]],
+        [[-5, 9]],
+    ]
+
+
+def test_peak_pyramid_float_fixture():
+    samples, _ = audio.read_wav(Path("fixtures/two.wav"))
+    levels = audio.peak_pyramid(samples)
+    assert len(levels[0]) == len(samples) // 256
+    assert all(x.dtype == np.int16 for x in levels)
+    assert levels[-1][0, 0] == round(samples.min() * 32767)
+    assert levels[-1][0, 1] == round(samples.max() * 32767)
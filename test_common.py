@@ -1,4 +1,12 @@
+from pathlib import Path
+import asyncio
 import json
+import sqlite3
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
 
 import common
 
@@ -9,3 +17,428 @@ def test_from_dict():
         t = common.Transcription.from_dict(d)
         assert t.transcription_id == "e4f0f909-8772-4b18-a397-a9b4c4726476"
         assert t.transcript["language"] == "en"
+
+
+def test_alignment_bytes():
+    words = [
+        common.Segment("hello", 0.1, 0.5, 0.9),
+        common.Segment("wörld", 0.5, 1.25, None),
+        common.Segment("hello", 7200.12, 7200.5, 1.0),
+    ]
+
+    got = common.Alignment.from_bytes(common.Alignment(words=words).to_bytes())
+    assert [w.label for w in got.words] == ["hello", "wörld", "hello"]
+    assert got.words[1].score is None
+    for w, want in zip(got.words, words):
+        assert w.start == pytest.approx(want.start, abs=1e-3)
+        assert w.end == pytest.approx(want.end, abs=1e-3)
+
+    # labels are stored once
+    columns = common.AlignmentColumns.from_words(words)
+    assert columns.labels == ["hello", "wörld"]
+    assert list(columns.label_ids) == [0, 1, 0]
+
+
+def test_alignment_bytes_error():
+    data = common.Alignment(words=[common.Segment("a", 0, 1, 1)]).to_bytes()
+    with pytest.raises(common.AlignmentError):
+        common.Alignment.from_bytes(data[:-1])
+    with pytest.raises(common.AlignmentError):
+        common.Alignment.from_bytes(b"{}" + data[2:])
+
+
+def test_follow_chunks():
+    with common.tmpdir_scope() as tmp:
+        chunks = common.ChunkedAudio(Path(tmp) / "abc.chunks")
+        chunks.start(duration=45.0, chunk_seconds=30)
+
+        def transcode():
+            time.sleep(0.1)
+            with open(chunks.index_file, "w") as f:
+                f.write("00000.wav,0.000000,30.000000\n")
+                f.flush()
+                time.sleep(0.1)
+                f.write("00001.wav,30.000000,45.000000\n")
+            chunks.finish()
+
+        writer = threading.Thread(target=transcode)
+        writer.start()
+        got = list(chunks.follow(poll_seconds=0.01))
+        writer.join()
+
+        assert [c.path.name for c in got] == ["00000.wav", "00001.wav"]
+        assert got[1].start == 30.0
+        assert got[1].end == 45.0
+
+
+def test_follow_chunks_rerun():
+    with common.tmpdir_scope() as tmp:
+        chunks = common.ChunkedAudio(Path(tmp) / "abc.chunks")
+        chunks.start(duration=45.0, chunk_seconds=30)
+        with open(chunks.index_file, "w") as f:
+            f.write("00000.wav,0.000000,30.000000\n")
+        chunks.finish()
+        chunks.clear()
+
+        # the follower of the next run waits for its transcoder
+        def transcode():
+            time.sleep(0.1)
+            chunks.start(duration=20.0, chunk_seconds=30)
+            with open(chunks.index_file, "w") as f:
+                f.write("00000.wav,0.000000,20.000000\n")
+            chunks.finish()
+
+        writer = threading.Thread(target=transcode)
+        writer.start()
+        got = list(chunks.follow(poll_seconds=0.01))
+        writer.join()
+
+        assert [c.end for c in got] == [20.0]
+
+
+def test_follow_chunks_error():
+    with common.tmpdir_scope() as tmp:
+        chunks = common.ChunkedAudio(Path(tmp) / "abc.chunks")
+        chunks.start(duration=45.0, chunk_seconds=30)
+        chunks.finish(error="ffmpeg failed : 1")
+
+        with pytest.raises(common.ChunkError):
+            list(chunks.follow(poll_seconds=0.01))
+
+
+def test_with_heartbeats():
+    async def events():
+        yield "a"
+        await asyncio.sleep(0.25)
+        yield "b"
+
+    async def run():
+        stream = common.with_heartbeats(events(), seconds=0.1)
+        return [event async for event in stream]
+
+    got = asyncio.run(run())
+    heartbeat = common.dataclass_to_event(common.Heartbeat())
+    assert got[0] == "a" and got[-1] == "b"
+    assert got[1:-1] == [heartbeat, heartbeat]
+
+
+@patch("common.transcriptions", new=dict())
+def test_select_cache(transcription_id="abc"):
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        db = common.Store(media_path)
+        db.create(
+            common.Transcription(
+                transcription_id=transcription_id,
+                path=media_path / transcription_id,
+                track=common.Track(title="one"),
+                upload=common.UploadInfo(),
+            )
+        )
+
+        # written through on create
+        assert db.select(transcription_id).track.title == "one"
+        assert db.cache.stats()["hits"] == 1
+
+        # callers get their own copy
+        t = db.select(transcription_id)
+        t.track = common.Track(title="changed")
+        assert db.select(transcription_id).track.title == "one"
+
+        # another container writes the file
+        other = common.Store(media_path)
+        t = other.select(transcription_id)
+        t.track = common.Track(title="two")
+        other.create(t)
+
+        assert db.select(transcription_id).track.title == "two"
+        assert db.cache.stats()["stale"] == 1
+
+
+@patch("common.transcriptions", new=dict())
+def test_select_cache_reads_back(transcription_id="abc"):
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        db = common.Store(media_path)
+        words = [common.Segment("hello", 0.1, 0.5, 0.9)]
+        db.create(
+            common.Transcription(
+                transcription_id=transcription_id,
+                path=media_path / transcription_id,
+                transcript={"segments": [{"text": "hello"}]},
+                alignment=common.Alignment(words=words),
+                stages={"transcode": "a"},
+                upload=common.UploadInfo(),
+            )
+        )
+
+        # the same as a container without a warm cache reads it
+        cold = common.Store(media_path).select(transcription_id)
+        assert db.select(transcription_id) == cold
+        assert db.cache.stats()["hits"] == 1
+
+        # small fields are copies, large ones are shared and never copied
+        t = db.select(transcription_id)
+        t.stages["transcode"] = "b"
+        t.upload.filename = "changed"
+        assert db.select(transcription_id) == cold
+        assert t.transcript is db.select(transcription_id).transcript
+
+
+@patch("common.transcriptions", new=dict())
+def test_select_cache_size(transcription_id="abc"):
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        db = common.Store(media_path, cache_size=2)
+        for transcription_id in ["a", "b", "c"]:
+            db.create(
+                common.Transcription(
+                    transcription_id=transcription_id,
+                    path=media_path / transcription_id,
+                    upload=common.UploadInfo(),
+                )
+            )
+
+        assert db.cache.stats()["size"] == 2
+        assert db.select("a").transcription_id == "a"
+        assert db.cache.stats()["misses"] == 1
+
+
+@patch("common.transcriptions", new=dict())
+def test_select_unknown_id():
+    with common.tmpdir_scope() as tmp:
+        db = common.Store(Path(tmp))
+        assert db.select("../etc/passwd") is None
+
+
+class CountingDict(dict):
+    "Records writes, like the remote modal dict would see them"
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def __setitem__(self, key, value):
+        self.writes += 1
+        super().__setitem__(key, value)
+
+
+def test_select_is_read_only(transcription_id="abc"):
+    transcriptions = CountingDict()
+    with patch("common.transcriptions", new=transcriptions):
+        with common.tmpdir_scope() as tmp:
+            media_path = Path(tmp)
+            common.Store(media_path).create(
+                common.Transcription(
+                    transcription_id=transcription_id,
+                    path=media_path / transcription_id,
+                    transcript={"text": "hello"},
+                    upload=common.UploadInfo(),
+                )
+            )
+
+            # a fresh container, without a warm cache
+            t = common.Store(media_path).select(transcription_id)
+            assert t.transcript["text"] == "hello"
+            assert transcriptions.writes == 1
+            assert set(transcriptions[transcription_id]) == {"version"}
+
+
+def backends(media_path: Path):
+    return {
+        "modal": common.ModalBackend(media_path),
+        "file": common.FileBackend(media_path),
+        "sqlite": common.SQLiteBackend(media_path / "test.sqlite"),
+    }
+
+
+@pytest.mark.parametrize("name", ["modal", "file", "sqlite"])
+@patch("common.transcriptions", new=dict())
+def test_backends(name, transcription_id="abc"):
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        db = common.Store(media_path, backend=backends(media_path)[name])
+        assert db.select(transcription_id) is None
+
+        db.create(
+            common.Transcription(
+                transcription_id=transcription_id,
+                path=media_path / transcription_id,
+                track=common.Track(title="one"),
+                transcript={"text": "hello"},
+                alignment=common.Alignment([common.Segment("hello", 0, 1, 1)]),
+                upload=common.UploadInfo(filename="a.mp3"),
+            )
+        )
+
+        db.update(transcription_id, track=common.Track(title="two"))
+
+        # read through a cold store
+        t = common.Store(media_path, backend=db.backend).select(transcription_id)
+        assert t.track.title == "two"
+        assert t.transcript["text"] == "hello"
+        assert t.alignment.words == [common.Segment("hello", 0, 1, 1)]
+        assert t.upload.filename == "a.mp3"
+        assert t.path == str(media_path / transcription_id)
+
+        # and through the warm one
+        assert db.select(transcription_id).track.title == "two"
+
+
+@pytest.mark.parametrize("name", ["modal", "file", "sqlite"])
+@patch("common.transcriptions", new=dict())
+def test_backends_create_many(name):
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        db = common.Store(media_path, backend=backends(media_path)[name])
+        db.create_many(
+            [
+                common.Transcription(
+                    transcription_id=transcription_id,
+                    path=media_path / transcription_id,
+                    upload=common.UploadInfo(),
+                )
+                for transcription_id in ["a", "b", "c"]
+            ]
+        )
+
+        cold = common.Store(media_path, backend=db.backend)
+        assert [cold.select(i).transcription_id for i in "abc"] == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize("name", ["modal", "file", "sqlite"])
+@patch("common.transcriptions", new=dict())
+def test_backends_share(name):
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        db = common.Store(media_path, backend=backends(media_path)[name])
+        db.create_many(
+            [
+                common.Transcription(
+                    transcription_id="a",
+                    path=media_path / "a",
+                    transcript={"text": "hello"},
+                    language="de",
+                    upload=common.UploadInfo(),
+                ),
+                common.Transcription(
+                    transcription_id="b",
+                    path=media_path / "b",
+                    upload=common.UploadInfo(),
+                ),
+            ]
+        )
+
+        assert db.find_artifact("key") is None
+        db.add_artifact("key", "a")
+        source = db.find_artifact("key")
+        assert source.transcription_id == "a"
+
+        db.share(source, "b", "transcript", "language")
+        for store in [db, common.Store(media_path, backend=db.backend)]:
+            t = store.select("b")
+            assert t.transcript == {"text": "hello"}
+            assert t.language == "de"
+
+        # file blobs are shared by reference
+        if name != "sqlite":
+            a = db.backend.blob_file("a", "transcript")
+            b = db.backend.blob_file("b", "transcript")
+            assert a.stat().st_ino == b.stat().st_ino
+
+
+def test_sqlite_backend_new_columns():
+    with common.tmpdir_scope() as tmp:
+        path = Path(tmp) / "test.sqlite"
+        with sqlite3.connect(path) as conn:
+            conn.execute(
+                "CREATE TABLE transcriptions ("
+                "transcription_id TEXT PRIMARY KEY, "
+                "version INTEGER NOT NULL, upload TEXT)"
+            )
+
+        db = common.Store(Path(tmp), backend=common.SQLiteBackend(path))
+        db.create(
+            common.Transcription(
+                transcription_id="abc",
+                upload=common.UploadInfo(),
+                stages={"transcode": "f00"},
+            )
+        )
+        t = common.Store(Path(tmp), backend=db.backend).select("abc")
+        assert t.stages == {"transcode": "f00"}
+
+
+def test_file_backend_guard():
+    with common.tmpdir_scope() as tmp:
+        backend = common.FileBackend(Path(tmp))
+        assert not backend.exists("../abc")
+        assert not backend.exists(".abc")
+
+
+def test_file_backend_blobs(transcription_id="abc"):
+    with common.tmpdir_scope() as tmp:
+        backend = common.FileBackend(Path(tmp))
+        backend.write(
+            transcription_id,
+            {"transcription_id": transcription_id, "transcript": {"text": "hi"}},
+        )
+
+        # large fields are kept out of the meta file
+        with open(backend.meta_file(transcription_id)) as f:
+            assert "transcript" not in json.load(f)
+
+        # and are not rewritten by updates to small fields
+        blob = backend.blob_file(transcription_id, "transcript")
+        stamp = common.file_stamp(blob)
+        backend.update(transcription_id, {"track": {"title": "one"}})
+        assert common.file_stamp(blob) == stamp
+
+        doc = backend.read(transcription_id)
+        assert doc["transcript"] == {"text": "hi"}
+        assert doc["track"] == {"title": "one"}
+        assert doc["alignment"] is None
+
+        backend.update(transcription_id, {"transcript": None})
+        assert not blob.exists()
+
+
+def test_file_backend_inline_fields(transcription_id="abc"):
+    with common.tmpdir_scope() as tmp:
+        backend = common.FileBackend(Path(tmp))
+        with open(backend.meta_file(transcription_id), "w") as f:
+            json.dump({"transcript": {"text": "hi"}}, f)
+
+        assert backend.read(transcription_id)["transcript"] == {"text": "hi"}
+
+        # updates move inline fields out to blobs, rather than dropping them
+        backend.update(transcription_id, {"track": {"title": "one"}})
+        with open(backend.meta_file(transcription_id)) as f:
+            assert "transcript" not in json.load(f)
+        doc = backend.read(transcription_id)
+        assert doc["transcript"] == {"text": "hi"}
+        assert doc["track"] == {"title": "one"}
+
+
+def test_sqlite_update_unknown_field():
+    with common.tmpdir_scope() as tmp:
+        backend = common.SQLiteBackend(Path(tmp) / "test.sqlite")
+        with pytest.raises(common.StoreError):
+            backend.update("abc", {"title; DROP TABLE transcriptions": 1})
+
+
+def test_backend_from_env():
+    with patch.dict("os.environ", {"STORE_BACKEND": "file"}):
+        assert type(common.backend_from_env(Path("/tmp"))) == common.FileBackend
+
+    # sqlite stays off the media volume
+    with common.tmpdir_scope() as tmp:
+        env = {"STORE_BACKEND": "sqlite", "SQLITE_PATH": f"{tmp}/t.sqlite"}
+        with patch.dict("os.environ", env):
+            backend = common.backend_from_env(Path(tmp) / "media")
+            assert backend.path == Path(tmp) / "t.sqlite"
+
+    with patch.dict("os.environ", {"STORE_BACKEND": "sqlite"}):
+        with patch("common.SQLITE_PATH", new=Path("/tmp/t.sqlite")):
+            backend = common.backend_from_env(common.MEDIA_PATH)
+            assert backend.path == Path("/tmp/t.sqlite")
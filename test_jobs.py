@@ -0,0 +1,125 @@
+from pathlib import Path
+import asyncio
+import os
+import time
+
+import pytest
+
+from pipeline import PipelineProgress
+import common
+import jobs
+
+
+def test_claim_job():
+    with common.tmpdir_scope() as tmp:
+        path = Path(tmp) / "abc.jobs"
+        job = jobs.claim_job(path, language="en")
+        assert job.number == 1
+        assert job.running()
+        assert job.manifest()["language"] == "en"
+
+        # viewers share the running job
+        assert jobs.claim_job(path) is None
+        assert jobs.latest_job(path).number == 1
+
+        # the next job starts once the last one is done
+        job.finish()
+        assert not job.running()
+        assert jobs.claim_job(path).number == 2
+
+        # jobs that stopped touching their log are dead
+        past = time.time() - jobs.STALE_SECONDS - 1
+        os.utime(jobs.latest_job(path).log_file, (past, past))
+        assert jobs.claim_job(path).number == 3
+
+        # only the latest jobs are kept
+        assert not has_files(path, 1)
+        assert has_files(path, 2)
+
+
+def has_files(path, number):
+    job = jobs.JobLog(path, number)
+    return job.manifest_file.exists() and job.log_file.exists()
+
+
+def test_follow():
+    with common.tmpdir_scope() as tmp:
+        job = jobs.claim_job(Path(tmp))
+
+        async def updates():
+            for state in ["transcoding", "transcribing", "completed"]:
+                await asyncio.sleep(0.02)
+                yield PipelineProgress(state=state)
+
+        async def follow(after):
+            return [x async for x in job.follow(after, poll_seconds=0.01)]
+
+        async def run():
+            task = asyncio.create_task(jobs.run(job, updates()))
+            events = await follow(0)
+            await task
+            return events
+
+        events = asyncio.run(run())
+        assert [event_id for event_id, _ in events] == ["1-1", "1-2", "1-3"]
+        assert events[0][1] == common.dataclass_to_event(
+            PipelineProgress(state="transcoding")
+        )
+        assert job.manifest()["state"] == "completed"
+
+        # resubscribing replays the rest of the log
+        assert asyncio.run(follow(2)) == events[2:]
+
+
+def test_follow_dead_job():
+    with common.tmpdir_scope() as tmp:
+        job = jobs.claim_job(Path(tmp))
+        job.append(common.dataclass_to_event(PipelineProgress("transcoding")))
+        past = time.time() - jobs.STALE_SECONDS - 1
+        os.utime(job.log_file, (past, past))
+
+        async def follow():
+            return [x async for x in job.follow(poll_seconds=0.01)]
+
+        with pytest.raises(jobs.JobError):
+            asyncio.run(follow())
+
+
+def test_resume(transcription_id="abc"):
+    with common.tmpdir_scope() as tmp:
+        t = common.Transcription(
+            transcription_id=transcription_id,
+            path=Path(tmp) / transcription_id,
+            upload=common.UploadInfo(),
+        )
+        jobs.claim_job(t.jobs_path)
+
+        job, after = jobs.resume(t, "1-7")
+        assert (job.number, after) == (1, 7)
+        assert jobs.resume(t, "2-7") == (None, 0)
+        assert jobs.resume(t, "nope") == (None, 0)
+
+
+def test_submit_joins_matching_job(transcription_id="abc"):
+    with common.tmpdir_scope() as tmp:
+        t = common.Transcription(
+            transcription_id=transcription_id,
+            path=Path(tmp) / transcription_id,
+            upload=common.UploadInfo(),
+        )
+        options = {"backend": "whisper"}
+        jobs.claim_job(t.jobs_path, language="en", asr_options=options)
+
+        # other viewers join, whatever their prompt or streaming
+        job = asyncio.run(
+            jobs.submit(
+                t, language="en", asr_options=options, streaming=True
+            )
+        )
+        assert job.number == 1
+
+        # but never get results for parameters they did not ask for
+        with pytest.raises(jobs.JobError):
+            asyncio.run(jobs.submit(t, language="de", asr_options=options))
+        with pytest.raises(jobs.JobError):
+            asyncio.run(jobs.submit(t, language="en", asr_options={}))
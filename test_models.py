@@ -0,0 +1,76 @@
+from pathlib import Path
+import os
+import time
+
+import common
+import models
+
+
+def test_registry_loads_once():
+    registry = models.ModelRegistry()
+    loads = []
+
+    def load():
+        loads.append(1)
+        return object()
+
+    first = registry.get("tiny", "cpu", load)
+    second = registry.get("tiny", "cpu", load)
+
+    assert first is second
+    assert len(loads) == 1
+
+    stats = registry.stats()["tiny@cpu"]
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["load_seconds"] >= 0
+
+
+def test_registry_keys_by_device():
+    registry = models.ModelRegistry()
+    cpu = registry.get("tiny", "cpu", object)
+    gpu = registry.get("tiny", "cuda:0", object)
+
+    assert cpu is not gpu
+    assert set(registry.stats()) == {"tiny@cpu", "tiny@cuda:0"}
+
+
+def test_registry_failed_load():
+    registry = models.ModelRegistry()
+
+    def fail():
+        raise RuntimeError("out of memory")
+
+    try:
+        registry.get("tiny", "cpu", fail)
+    except RuntimeError:
+        pass
+
+    # a failed load is retried on the next call
+    model = registry.get("tiny", "cpu", object)
+    assert model is not None
+    assert registry.stats()["tiny@cpu"]["misses"] == 1
+
+
+def test_registry_publishes():
+    with common.tmpdir_scope() as tmp:
+        path = Path(tmp) / "models"
+        one = models.ModelRegistry(path / "one.json")
+        two = models.ModelRegistry(path / "two.json")
+        one.get("tiny", "cpu", object)
+        one.get("tiny", "cpu", object)
+        two.get("tiny", "cpu", object)
+        two.get("base", "cpu", object)
+
+        # summed over containers
+        metrics = models.read_metrics(path)
+        assert metrics["tiny@cpu"]["hits"] == 1
+        assert metrics["tiny@cpu"]["misses"] == 2
+        assert metrics["tiny@cpu"]["containers"] == 2
+        assert metrics["base@cpu"]["containers"] == 1
+
+        # containers that are long gone are left out
+        old = time.time() - models.METRICS_MAX_AGE_SECONDS - 1
+        os.utime(path / "two.json", (old, old))
+        assert set(models.read_metrics(path)) == {"tiny@cpu"}
+        assert models.read_metrics(Path(tmp) / "nope") == {}
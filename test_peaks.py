@@ -0,0 +1,44 @@
+from pathlib import Path
+import struct
+
+import numpy as np
+import pytest
+
+import audio
+import common
+import peaks
+
+
+def write_peaks(path, n_samples=16000 * 10, sample_rate=16000):
+    samples = (np.arange(n_samples) % 1000).astype(np.int16)
+    levels = audio.peak_pyramid(samples, peaks.SAMPLES_PER_PEAK)
+    peaks.write_peaks(path, levels, sample_rate)
+    return levels
+
+
+def test_read_peaks():
+    with common.tmpdir_scope() as tmp:
+        path = Path(tmp) / "abc.peaks"
+        levels = write_peaks(path)
+
+        got = peaks.read_peaks(path, zoom=2)
+        assert got.samples_per_peak == 1024
+        assert got.offset == 0
+        assert got.data == levels[2].astype("<i2").tobytes()
+
+        # seconds 2 to 3 at the finest level
+        got = peaks.read_peaks(path, zoom=0, start=2, end=3)
+        assert got.offset == 125
+        assert got.data == levels[0][125:188].astype("<i2").tobytes()
+
+        # the coarsest level is a single peak
+        got = peaks.read_peaks(path, zoom=len(levels) - 1)
+        assert struct.unpack("<hh", got.data) == (0, 999)
+
+
+def test_read_peaks_zoom_error():
+    with common.tmpdir_scope() as tmp:
+        path = Path(tmp) / "abc.peaks"
+        levels = write_peaks(path)
+        with pytest.raises(peaks.PeaksError):
+            peaks.read_peaks(path, zoom=len(levels))
@@ -1,12 +1,20 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from pathlib import Path
+from types import SimpleNamespace
 import shutil
+from unittest.mock import MagicMock, patch
 from unittest.mock import patch
-from unittest.mock import patch
+import asyncio
+import time
+
+import pytest
 
+from align import AlignmentProgress
+from annotate import AnnotationProgress
 from pipeline import PipelineProgress
 from transcode import TranscodingProgress
 from transcribe import TranscriptionProgress
+import asr
 import common
 import pipeline
 import transcode
@@ -42,7 +50,9 @@ pipeline_stub = MockedStub()
 
 
 @patch("annotate.app", new=pipeline_stub)
+@patch("vad.app", new=pipeline_stub)
 @patch("common.app", new=pipeline_stub)
+@patch("peaks.app", new=pipeline_stub)
 @patch("pipeline.app", new=pipeline_stub)
 @patch("transcode.app", new=pipeline_stub)
 @patch("transcribe.app", new=pipeline_stub)
@@ -68,7 +78,7 @@ def test_pipeline(transcription_id="abc"):
                 )
             )
 
-            updates = list(
+            updates = collect(
                 pipeline.pipeline(
                     transcription_id,
                     "en",
@@ -84,12 +94,412 @@ def test_pipeline(transcription_id="abc"):
             assert type(updates[1]) == TranscodingProgress
             assert updates[4].track.duration > 1.4
 
-            assert type(updates[-3]) == TranscriptionProgress
-            assert updates[-3].percent_done is 100
-            assert updates[-3].transcript["text"].strip() == "One."
+            assert type(updates[-6]) == TranscriptionProgress
+            assert updates[-6].percent_done is 100
+            assert updates[-6].transcript["text"].strip() == "One."
+
+            assert type(updates[-5]) == PipelineProgress
+            assert updates[-5].state == "aligning"
+
+            assert type(updates[-4]) == PipelineProgress
+            assert updates[-4].state == "annotating"
 
-            assert type(updates[-2]) == PipelineProgress
-            assert updates[-2].state == "annotating"
+            # align and annotate finish in any order
+            finished = {type(u) for u in updates[-3:-1]}
+            assert finished == {AlignmentProgress, AnnotationProgress}
 
             assert type(updates[-1]) == PipelineProgress
             assert updates[-1].state == "completed"
+            assert updates[-1].transcription.alignment.words
+            assert updates[-1].transcription.diarization.turns
+            assert updates[-1].transcription.peaks_file.exists()
+
+
+@patch("common.transcriptions", new=dict())
+def test_pipeline_reuse():
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        store = common.Store(media_path, backend=common.FileBackend(media_path))
+        with patch("common.db", new=store):
+            upload = common.UploadInfo(media_hash="f00")
+            source, target = [
+                common.Transcription(
+                    transcription_id=transcription_id,
+                    path=media_path / transcription_id,
+                    upload=upload,
+                )
+                for transcription_id in ["source", "target"]
+            ]
+
+            # a finished transcription of the same media
+            fingerprints = pipeline.stage_fingerprints("en", None)
+            source = replace(
+                source,
+                stages=fingerprints,
+                transcoded=True,
+                track=common.Track(duration=1.5),
+                transcript={"text": "One."},
+                language="en",
+                alignment=common.Alignment([common.Segment("one", 0, 1, 1)]),
+                diarization=common.Diarization([common.Turn("A", 0, 1)]),
+            )
+            source.transcoded_file.write_bytes(b"wav")
+            source.peaks_file.write_bytes(b"peaks")
+            common.db.create_many([source, target])
+
+            for fingerprint in fingerprints.values():
+                pipeline.remember(source, fingerprint)
+
+            # nothing runs, so no stage function is patched
+            run = pipeline.pipeline("target", "en", local_mode=True)
+            updates = collect(run)
+            assert updates[-1].state == "completed"
+
+            t = updates[-1].transcription
+            assert t.transcript["text"] == "One."
+            assert t.alignment.words[0].label == "one"
+            assert t.diarization.turns[0].speaker == "A"
+            assert t.track.duration == 1.5
+
+            # files are linked, not copied
+            wav = source.transcoded_file.stat()
+            assert t.transcoded_file.stat().st_ino == wav.st_ino
+            assert t.peaks_file.read_bytes() == b"peaks"
+
+            t = common.Store(media_path, backend=store.backend).select("target")
+            assert t.transcoded
+            assert t.alignment.words[0].label == "one"
+            assert t.stages == fingerprints
+
+
+@patch("common.transcriptions", new=dict())
+def test_reuse_source_rerun():
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        store = common.Store(media_path, backend=common.FileBackend(media_path))
+        with patch("common.db", new=store):
+            upload = common.UploadInfo(media_hash="f00")
+            source, target = [
+                common.Transcription(
+                    transcription_id=transcription_id,
+                    path=media_path / transcription_id,
+                    upload=upload,
+                )
+                for transcription_id in ["source", "target"]
+            ]
+            common.db.create_many([source, target])
+
+            # detected as english, then re-run in german
+            auto = pipeline.stage_fingerprints(None, None)["transcribe"]
+            en = pipeline.stage_fingerprints("en", None)["transcribe"]
+            de = pipeline.stage_fingerprints("de", None)
+            pipeline.remember(source, auto, en)
+            pipeline.remember(source, en)
+            source = pipeline.complete(
+                source, de, "transcribe", transcript={"text": "Eins."}
+            )
+
+            # the index entries of the english run are stale
+            assert not pipeline.reuse(target, "transcribe", auto)
+            assert not pipeline.reuse(target, "transcribe", en)
+            assert not pipeline.reusable(target, "transcribe", auto)
+
+            t = pipeline.reuse(target, "transcribe", de["transcribe"])
+            assert t.transcript == {"text": "Eins."}
+
+
+def fake_transcode(transcription_id, **kwargs):
+    yield TranscodingProgress(percent_done=50)
+    yield TranscodingProgress(100, track=common.Track(duration=60))
+
+
+def fake_transcribe_batch(transcription_ids, language, prompt=None):
+    for x in transcription_ids:
+        yield transcribe.BatchProgress(x, 50)
+    for x in transcription_ids:
+        if x == "broken":
+            yield transcribe.BatchProgress(x, 100, error="unreadable")
+        else:
+            transcript = {"text": x, "segments": [], "language": "de"}
+            yield transcribe.BatchProgress(x, 100, transcript)
+
+
+@patch("common.transcriptions", new=dict())
+@patch("pipeline.transcode", new=SimpleNamespace(local=fake_transcode))
+@patch(
+    "pipeline.transcribe_batch",
+    new=SimpleNamespace(local=fake_transcribe_batch),
+)
+def test_batch():
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        store = common.Store(media_path, backend=common.FileBackend(media_path))
+        with patch("common.db", new=store):
+            common.db.create_many(
+                [
+                    common.Transcription(
+                        transcription_id=transcription_id,
+                        path=media_path / transcription_id,
+                        upload=common.UploadInfo(),
+                    )
+                    for transcription_id in ["a", "b", "broken"]
+                ]
+            )
+
+            ids = ["a", "b", "broken", "missing"]
+            updates = collect(pipeline.batch(ids, local_mode=True))
+
+            errors = {
+                x
+                for x, update in updates
+                if isinstance(update, PipelineProgress)
+                and update.state == "error"
+            }
+            assert errors == {"broken", "missing"}
+
+            for x in ["a", "b"]:
+                progress = [u for y, u in updates if y == x]
+                assert type(progress[0]) == TranscodingProgress
+                assert progress[-1].percent_done == 100
+                assert progress[-1].transcript["text"] == x
+
+                # saved with the detected language, so a pipeline skips it
+                t = common.db.select(x)
+                assert t.language == "de"
+                fingerprints = pipeline.stage_fingerprints("de", None)
+                assert pipeline.fresh(t, "transcribe", fingerprints)
+                assert pipeline.fresh(t, "transcode", fingerprints)
+
+            assert not common.db.select("broken").transcribed
+
+
+def test_stage_fingerprints():
+    en = pipeline.stage_fingerprints("en", None)
+    de = pipeline.stage_fingerprints("de", None)
+
+    # a new language invalidates the transcript and everything built on it
+    changed = {stage for stage in en if en[stage] != de[stage]}
+    assert changed == {"transcribe", "align"}
+    assert pipeline.stage_fingerprints("en", None) == en
+
+
+def test_stage_fingerprints_asr():
+    default = pipeline.stage_fingerprints("en", None)
+    whisper = asr.AsrOptions(device="cpu")
+    faster = asr.AsrOptions(backend=asr.FASTER_WHISPER, compute_type="int8")
+
+    # the default backend keeps the fingerprints from before backends
+    assert pipeline.stage_fingerprints("en", None, whisper) == default
+    changed = pipeline.stage_fingerprints("en", None, faster)
+    assert {s for s in default if default[s] != changed[s]} == {
+        "transcribe",
+        "align",
+    }
+
+    # the backend's default compute type is that of the device it runs on
+    gpu = asr.AsrOptions(backend=asr.FASTER_WHISPER)
+    cpu = asr.AsrOptions(backend=asr.FASTER_WHISPER, device="cpu")
+    fingerprints = pipeline.stage_fingerprints("en", None, cpu)
+    assert fingerprints == changed
+    assert pipeline.stage_fingerprints("en", None, gpu) != changed
+
+
+def test_stage_fingerprints_speech():
+    default = pipeline.stage_fingerprints("en", None)
+    speech = pipeline.stage_fingerprints("en", None, speech=True)
+
+    # stages that read the speech file, and the alignment of the transcript
+    changed = {s for s in default if default[s] != speech[s]}
+    assert changed == {"transcribe", "align", "annotate"}
+    assert set(speech) - set(default) == {"vad"}
+
+    # streamed transcription reads the whole track, and the rest the speech
+    streamed = pipeline.stage_fingerprints(
+        "en", None, speech=True, streamed=True
+    )
+    assert streamed["transcribe"] == default["transcribe"]
+    assert streamed["align"] not in (default["align"], speech["align"])
+    assert streamed["annotate"] == speech["annotate"]
+
+
+@patch("common.transcriptions", new=dict())
+def test_pipeline_reopen():
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        store = common.Store(media_path, backend=common.FileBackend(media_path))
+        with patch("common.db", new=store):
+            # completed before fingerprints were recorded
+            t = common.Transcription(
+                transcription_id="abc",
+                path=media_path / "abc",
+                upload=common.UploadInfo(),
+                transcoded=True,
+                track=common.Track(duration=1.5),
+                transcript={"text": "One."},
+                language="en",
+                alignment=common.Alignment([common.Segment("one", 0, 1, 1)]),
+                diarization=common.Diarization([common.Turn("A", 0, 1)]),
+            )
+            t.peaks_file.write_bytes(b"peaks")
+            common.db.create(t)
+
+            # nothing runs, so no stage function is patched
+            for _ in range(2):
+                updates = collect(pipeline.pipeline("abc", local_mode=True))
+                assert updates[-1].state == "completed"
+                assert updates[-1].transcription.transcript["text"] == "One."
+
+            fingerprints = pipeline.stage_fingerprints("en", None)
+            assert common.db.select("abc").stages == fingerprints
+
+
+class StageCalls:
+    "Local stand ins for the stages of a pipeline, which record their calls"
+
+    def __init__(self):
+        self.calls = {}
+
+    def record(self, name, fn):
+        def call(*args, **kwargs):
+            self.calls[name] = kwargs
+            return fn(*args, **kwargs)
+
+        # remote calls are looked up, but never made in local mode
+        return MagicMock(local=call)
+
+
+@patch("common.transcriptions", new=dict())
+def test_pipeline_streaming_speech():
+    def stream(transcription_id, language, prompt, **kwargs):
+        yield TranscriptionProgress(50)
+        yield {"text": "One.", "segments": [], "language": "en"}
+
+    def no_peaks(transcription_id, **kwargs):
+        raise ValueError("no wav")
+
+    def no_speakers(transcription_id, **kwargs):
+        return common.Diarization([])
+
+    stages = StageCalls()
+    record = stages.record
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        store = common.Store(media_path, backend=common.FileBackend(media_path))
+        with (
+            patch("common.db", new=store),
+            patch("pipeline.transcode", record("transcode", fake_transcode)),
+            patch("pipeline.transcribe", record("transcribe", stream)),
+            patch("vad.vad", record("vad", lambda x: None)),
+            patch("pipeline.align", record("align", lambda x, **kw: None)),
+            patch("pipeline.annotate", record("annotate", no_speakers)),
+            patch("pipeline.peaks", record("peaks", no_peaks)),
+        ):
+            common.db.create(
+                common.Transcription(
+                    transcription_id="abc",
+                    path=media_path / "abc",
+                    upload=common.UploadInfo(),
+                )
+            )
+
+            # as the editor runs new uploads
+            updates = collect(
+                pipeline.pipeline("abc", "en", streaming=True, local_mode=True)
+            )
+            assert updates[-1].state == "completed"
+
+            # whisper streams the whole track, and the rest skip the silence
+            assert stages.calls["transcribe"]["streaming"]
+            assert "vad" in stages.calls
+            assert stages.calls["align"]["speech"]
+            assert stages.calls["annotate"]["speech"]
+
+            fingerprints = pipeline.stage_fingerprints(
+                "en", None, speech=True, streamed=True
+            )
+            del fingerprints["peaks"]
+            assert common.db.select("abc").stages == fingerprints
+
+
+def test_run_concurrently():
+    def stage(name, seconds):
+        async def run():
+            await asyncio.sleep(seconds)
+            return name
+
+        return run
+
+    started = time.monotonic()
+    results = collect(
+        pipeline.run_concurrently(
+            {"slow": stage("slow", 0.2), "fast": stage("fast", 0.1)}
+        )
+    )
+
+    assert results == [("fast", "fast"), ("slow", "slow")]
+    assert time.monotonic() - started < 0.3
+
+
+def test_run_concurrently_optional():
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        return "slow"
+
+    results = dict(
+        collect(
+            pipeline.run_concurrently(
+                {"peaks": pipeline.optional(failing), "align": slow}
+            )
+        )
+    )
+
+    assert isinstance(results["peaks"], ValueError)
+    assert results["align"] == "slow"
+
+
+def test_in_thread_gen():
+    def blocking(n):
+        for i in range(n):
+            time.sleep(0.01)
+            yield i
+
+    assert collect(pipeline.in_thread_gen(blocking)(3)) == [0, 1, 2]
+
+
+def test_interleave():
+    async def stage(name, n):
+        for i in range(n):
+            await asyncio.sleep(0.01)
+            yield i
+
+    updates = collect(
+        pipeline.interleave({"a": stage("a", 3), "b": stage("b", 2)})
+    )
+    assert [i for name, i in updates if name == "a"] == [0, 1, 2]
+    assert [i for name, i in updates if name == "b"] == [0, 1]
+
+
+def test_interleave_error():
+    async def failing():
+        yield 1
+        raise ValueError("boom")
+
+    async def numbers():
+        yield 1
+        yield 2
+
+    with pytest.raises(ValueError):
+        collect(pipeline.interleave({"a": failing(), "b": numbers()}))
+
+
+def collect(generator) -> list:
+    "Run an async generator to completion"
+
+    async def run():
+        return [item async for item in generator]
+
+    return asyncio.run(run())
@@ -0,0 +1,65 @@
+from pathlib import Path
+import asyncio
+import os
+
+import pytest
+
+import common
+import ranges
+
+
+def test_parse_ranges():
+    assert ranges.parse_ranges("bytes=0-99", 1000) == [(0, 99)]
+    assert ranges.parse_ranges("bytes=900-", 1000) == [(900, 999)]
+    assert ranges.parse_ranges("bytes=-100", 1000) == [(900, 999)]
+    assert ranges.parse_ranges("bytes=-2000", 1000) == [(0, 999)]
+    assert ranges.parse_ranges("bytes=500-2000", 1000) == [(500, 999)]
+
+    # sorted and merged
+    got = ranges.parse_ranges("bytes=500-599, 0-9, 10-19, 550-650", 1000)
+    assert got == [(0, 19), (500, 650)]
+
+    # unsatisfiable ranges are dropped
+    assert ranges.parse_ranges("bytes=0-9,2000-", 1000) == [(0, 9)]
+
+
+@pytest.mark.parametrize(
+    "header", ["bytes=2000-", "bytes=-0", "bytes=5-1", "lines=0-1", "bytes=a-b"]
+)
+def test_parse_ranges_error(header):
+    with pytest.raises(ranges.RangeError):
+        ranges.parse_ranges(header, 1000)
+
+
+def test_not_modified():
+    etag = '"abc"'
+    assert ranges.not_modified({"if-none-match": '"x", "abc"'}, etag, 0)
+    assert ranges.not_modified({"if-none-match": 'W/"abc"'}, etag, 0)
+    assert not ranges.not_modified({"if-none-match": '"x"'}, etag, 0)
+
+    since = "Sun, 06 Nov 1994 08:49:37 GMT"
+    assert ranges.not_modified({"if-modified-since": since}, etag, 784111777)
+    assert not ranges.not_modified(
+        {"if-modified-since": since}, etag, 784111778
+    )
+
+
+def test_zerocopy_send():
+    with common.tmpdir_scope() as tmp:
+        path = Path(tmp) / "media"
+        path.write_bytes(bytes(range(256)))
+        headers = {"range": "bytes=10-19"}
+        response = ranges.file_response(path, "audio/mp3", headers)
+
+        sent = []
+
+        async def send(message):
+            if message["type"] == ranges.ZEROCOPY:
+                fd = message["file"].fileno()
+                sent.append(os.pread(fd, message["count"], message["offset"]))
+            else:
+                sent.append(message.get("body", b""))
+
+        scope = {"method": "GET", "extensions": {ranges.ZEROCOPY: {}}}
+        asyncio.run(response(scope, None, send))
+        assert b"".join(sent) == bytes(range(10, 20))
@@ -0,0 +1,175 @@
+import asyncio
+
+import pytest
+
+import scheduler
+
+
+class StubExecutor:
+    "Records which calls run at the same time, and in which order"
+
+    def __init__(self, seconds: float = 0.01):
+        self.seconds = seconds
+        self.started = []
+        self.running = 0
+        self.most_running = 0
+
+    async def __call__(self, call):
+        self.started.append(call.args[0])
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        try:
+            if call.kwargs.get("fail"):
+                raise ValueError("boom")
+            await asyncio.sleep(self.seconds)
+            yield f"{call.args[0]} halfway"
+            yield f"{call.args[0]} done"
+        finally:
+            self.running -= 1
+
+
+async def collect(generator) -> list:
+    return [update async for update in generator]
+
+
+def test_submit():
+    execute = StubExecutor()
+
+    async def run():
+        s = scheduler.Scheduler(execute, limits={"align": 1})
+        return await collect(s.submit("align", "a", duration=60))
+
+    assert asyncio.run(run()) == ["a halfway", "a done"]
+
+
+def test_submit_unknown_stage():
+    async def run():
+        s = scheduler.Scheduler(StubExecutor())
+        return await collect(s.submit("nope", "a"))
+
+    with pytest.raises(scheduler.SchedulerError):
+        asyncio.run(run())
+
+
+def test_limits():
+    execute = StubExecutor()
+
+    async def run():
+        s = scheduler.Scheduler(execute, limits={"annotate": 2})
+        calls = [s.submit("annotate", i, duration=600) for i in range(6)]
+        await asyncio.gather(*[collect(x) for x in calls])
+
+    asyncio.run(run())
+    assert execute.most_running == 2
+    assert sorted(execute.started) == list(range(6))
+
+
+def test_priority():
+    execute = StubExecutor()
+
+    async def run():
+        s = scheduler.Scheduler(execute, limits={"align": 1})
+        # occupies the only gpu while the rest queue up
+        first = asyncio.create_task(collect(s.submit("align", "first")))
+        await asyncio.sleep(0)
+        calls = [
+            ("bulk", scheduler.BULK, 60),
+            ("long", scheduler.NORMAL, 3600),
+            ("short", scheduler.NORMAL, 600),
+            ("rerun", scheduler.INTERACTIVE, 3600),
+        ]
+        await asyncio.gather(
+            first,
+            *[
+                collect(s.submit("align", x, priority=p, duration=d))
+                for x, p, d in calls
+            ],
+        )
+
+    asyncio.run(run())
+    assert execute.started == ["first", "rerun", "short", "long", "bulk"]
+
+
+def test_batches():
+    execute = StubExecutor()
+
+    async def run():
+        s = scheduler.Scheduler(
+            execute, limits={"transcribe": 2}, batch_size=3
+        )
+        batches = []
+        run_batch = s.run
+
+        async def record(pool, weight, batch):
+            batches.append([call.args[0] for call in batch])
+            await run_batch(pool, weight, batch)
+
+        s.run = record
+        calls = [s.submit("transcribe", i, duration=60) for i in range(6)]
+        await asyncio.gather(*[collect(x) for x in calls])
+        return batches, s.metrics()
+
+    batches, metrics = asyncio.run(run())
+
+    # the first two start at once, and the queued ones are then batched
+    assert batches == [[0], [1], [2, 3, 4], [5]]
+    assert execute.most_running == 2
+    assert metrics["wait_seconds"]["count"] == 6
+    assert metrics["queued"] == {"transcribe": 0}
+    assert metrics["running"] == {"transcribe": 0}
+
+
+def test_weights():
+    execute = StubExecutor()
+
+    async def run():
+        s = scheduler.Scheduler(execute, limits={"transcribe": 4})
+        await asyncio.gather(
+            collect(s.submit("transcribe_map", "map", weight=3)),
+            collect(s.submit("transcribe", "a", duration=600)),
+            collect(s.submit("transcribe", "b", duration=600)),
+        )
+
+    asyncio.run(run())
+
+    # the map call uses three of the four gpus, so b waits for one
+    assert execute.started == ["map", "a", "b"]
+    assert execute.most_running == 2
+
+
+def test_failures():
+    execute = StubExecutor()
+
+    async def run():
+        s = scheduler.Scheduler(execute, limits={"transcribe": 1})
+        return await asyncio.gather(
+            collect(s.submit("transcribe", "a", duration=60, fail=True)),
+            collect(s.submit("transcribe", "b", duration=60)),
+            return_exceptions=True,
+        )
+
+    failed, succeeded = asyncio.run(run())
+
+    # a failed call does not fail the others in its batch
+    assert isinstance(failed, ValueError)
+    assert succeeded == ["b halfway", "b done"]
+
+
+def test_metrics():
+    execute = StubExecutor(seconds=0.1)
+
+    async def run():
+        s = scheduler.Scheduler(execute, limits={"align": 1})
+        tasks = [
+            asyncio.create_task(collect(s.submit("align", i, duration=600)))
+            for i in range(3)
+        ]
+        await asyncio.sleep(0.05)
+        metrics = s.metrics()
+        await asyncio.gather(*tasks)
+        return metrics
+
+    metrics = asyncio.run(run())
+    assert metrics["queued"] == {"align": 2}
+    assert metrics["running"] == {"align": 1}
+    assert metrics["wait_seconds"]["count"] == 1
@@ -2,6 +2,9 @@ from dataclasses import dataclass, field
 from pathlib import Path
 import json
 import shutil
+import socket
+import threading
+import time
 from unittest.mock import patch
 
 import ffmpeg
@@ -64,3 +67,218 @@ def test_transcode(transcription_id="overgrown.mp3"):
             probe = ffmpeg.probe(t.transcoded_file)
             assert probe["format"]["format_name"] == "wav"
             assert int(float(probe["format"]["duration"])) == 222
+
+            # files shared with another upload are replaced, not rewritten
+            shared = media_path / "shared.wav"
+            common.link_file(t.transcoded_file, shared)
+            before = shared.read_bytes()
+            for _ in transcode.transcode.local(
+                transcription_id, media_path=media_path, force_reprocessing=True
+            ):
+                pass
+            assert shared.read_bytes() == before
+            assert t.transcoded_file.stat().st_ino != shared.stat().st_ino
+            assert not list(media_path.glob(".*.tmp"))
+
+
+@patch("transcode.app", new=transcode_stub)
+@patch("common.app", new=transcode_stub)
+@patch("common.transcriptions", new=dict())
+def test_transcode_chunks(transcription_id="overgrown.mp3"):
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        with patch("common.db", new=common.Store(media_path)):
+            from_file = fixtures / transcription_id
+            to_file = media_path / transcription_id
+            shutil.copyfile(from_file, to_file)
+            t = common.Transcription(
+                transcription_id=transcription_id,
+                path=to_file,
+                upload=common.UploadInfo(
+                    filename="file.name",
+                    content_type="audio/mp3",
+                    size_bytes=15,
+                ),
+            )
+            common.db.create(t)
+
+            updates = list(
+                transcode.transcode.local(
+                    transcription_id,
+                    media_path=media_path,
+                    force_reprocessing=True,
+                    chunk_seconds=30,
+                )
+            )
+
+            assert updates[-1].track.title == "Overgrown"
+
+            chunks = common.ChunkedAudio(t.transcoded_chunks_path)
+            assert chunks.manifest()["state"] == "completed"
+            assert len(chunks.chunks()) == 8
+            assert chunks.chunks()[-1].end > 222
+
+            probe = ffmpeg.probe(chunks.chunks()[0].path)
+            assert int(float(probe["format"]["duration"])) == 30
+
+
+@patch("transcode.app", new=transcode_stub)
+@patch("common.app", new=transcode_stub)
+@patch("common.transcriptions", new=dict())
+def test_transcode_proxy(transcription_id="overgrown.mp3"):
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        with patch("common.db", new=common.Store(media_path)):
+            from_file = fixtures / transcription_id
+            to_file = media_path / transcription_id
+            shutil.copyfile(from_file, to_file)
+            t = common.Transcription(
+                transcription_id=transcription_id,
+                path=to_file,
+                upload=common.UploadInfo(
+                    filename="file.name",
+                    content_type="audio/mp3",
+                    size_bytes=15,
+                ),
+            )
+            common.db.create(t)
+
+            list(
+                transcode.transcode.local(
+                    transcription_id,
+                    media_path=media_path,
+                    force_reprocessing=True,
+                )
+            )
+
+            # a 128kbps mp3 gets an audio proxy at half the size
+            assert not t.video_proxy_file.exists()
+            probe = ffmpeg.probe(t.audio_proxy_file)
+            assert probe["streams"][0]["codec_name"] == "aac"
+            assert int(float(probe["format"]["duration"])) == 222
+            assert t.audio_proxy_file.stat().st_size < to_file.stat().st_size
+
+
+@patch("transcode.app", new=transcode_stub)
+@patch("common.app", new=transcode_stub)
+@patch("common.transcriptions", new=dict())
+def test_transcode_progressive(transcription_id="overgrown.mp3"):
+    content = (fixtures / transcription_id).read_bytes()
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        with patch("common.db", new=common.Store(media_path)):
+            t = common.Transcription(
+                transcription_id=transcription_id,
+                path=media_path / transcription_id,
+                upload=common.UploadInfo(
+                    filename="file.name",
+                    content_type="audio/mp3",
+                    size_bytes=len(content),
+                ),
+            )
+            common.db.create(t)
+
+            # the upload arrives while ffmpeg is reading it
+            def upload():
+                with open(t.uploaded_file, "wb") as f:
+                    for i in range(0, len(content), 1024 * 1024):
+                        f.write(content[i : i + 1024 * 1024])
+                        f.flush()
+                        time.sleep(0.1)
+
+            writer = threading.Thread(target=upload)
+            writer.start()
+            updates = list(
+                transcode.transcode.local(
+                    transcription_id,
+                    media_path=media_path,
+                    force_reprocessing=True,
+                    progressive=True,
+                )
+            )
+            writer.join()
+
+            assert updates[-1].track.title == "Overgrown"
+            assert int(updates[-1].track.duration) == 222
+
+            probe = ffmpeg.probe(t.transcoded_file)
+            assert int(float(probe["format"]["duration"])) == 222
+
+
+@patch("transcode.app", new=transcode_stub)
+@patch("common.app", new=transcode_stub)
+@patch("common.transcriptions", new=dict())
+@patch("transcode.PROBE_BYTES", new=64 * 1024)
+def test_streamable():
+    with common.tmpdir_scope() as tmp:
+        media_path = Path(tmp)
+        with patch("common.db", new=common.Store(media_path)):
+            # an mp4 keeps its index at the end unless told otherwise
+            mp4 = media_path / "source.mp4"
+            ffmpeg.input(fixtures / "overgrown.mp3", t=30).output(
+                str(mp4), acodec="aac"
+            ).run(quiet=True)
+
+            def upload(transcription_id, content, n_bytes):
+                t = common.Transcription(
+                    transcription_id=transcription_id,
+                    path=media_path / transcription_id,
+                    upload=common.UploadInfo(
+                        filename="file.name",
+                        content_type="audio/mpeg",
+                        size_bytes=len(content),
+                    ),
+                )
+                common.db.create(t)
+                t.uploaded_file.write_bytes(content[:n_bytes])
+                return transcription_id
+
+            mp3 = (fixtures / "overgrown.mp3").read_bytes()
+            assert transcode.streamable.local(upload("a.mp3", mp3, 100_000))
+            assert transcode.streamable.local(upload("b.mp3", mp3, len(mp3)))
+
+            content = mp4.read_bytes()
+            assert not transcode.streamable.local(
+                upload("c.mp4", content, 100_000)
+            )
+
+
+def test_has_video():
+    audio = {"codec_type": "audio"}
+    cover = {"codec_type": "video", "disposition": {"attached_pic": 1}}
+    video = {"codec_type": "video", "disposition": {"attached_pic": 0}}
+    assert not transcode.has_video({"streams": [audio, cover]})
+    assert transcode.has_video({"streams": [audio, video]})
+
+
+def test_progress():
+    block = (
+        "frame=0\nbitrate=  64.0kbits/s\ntotal_size=1024\n"
+        "out_time_us={}\nout_time=00:00:01.000000\nspeed=20x\n"
+        "progress={}\n"
+    )
+    with transcode.create_sock() as (socket_filename, sock):
+
+        def ffmpeg():
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(socket_filename)
+                for seconds in [1, 1, 1.5, 2, 4]:
+                    us = int(seconds * 1_000_000)
+                    client.sendall(block.format(us, "continue").encode())
+                client.sendall(block.format(10_000_000, "end").encode())
+
+        writer = threading.Thread(target=ffmpeg)
+        writer.start()
+        updates = list(transcode.progress(sock, 10.0, interval=60))
+        writer.join()
+
+    # repeated percentages are not sent on
+    assert [u.percent_done for u in updates] == [10, 15, 20, 40, 100]
+    assert updates[0].speed == 20.0
+    assert updates[0].bitrate == 64_000
+    assert updates[0].eta_seconds == 9 / 20
+
+    # values ffmpeg doesn't know yet
+    progress = transcode.parse_progress({"out_time_us": "N/A"}, 10.0)
+    assert progress.percent_done == 0
+    assert progress.speed is None
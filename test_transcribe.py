@@ -1,9 +1,14 @@
 from dataclasses import dataclass, field
 from pathlib import Path
+from types import SimpleNamespace
 import json
 import shutil
 from unittest.mock import patch
+import wave
 
+import numpy as np
+
+import audio
 import common
 import transcribe
 
@@ -52,3 +57,152 @@ def test_transcribe(transcription_id="abc"):
 
             assert transcript["language"] == "en"
             assert transcript["text"].strip() == "One."
+
+
+def test_stitch():
+    first = {
+        "text": " One two.",
+        "language": "en",
+        "segments": [{"id": 0, "seek": 0, "start": 0.0, "end": 2.5}],
+    }
+    second = {
+        "text": " Three.",
+        "language": "en",
+        "segments": [
+            {"id": 0, "seek": 0, "start": 0.5, "end": 1.0},
+            {"id": 1, "seek": 0, "start": 1.0, "end": 2.0},
+        ],
+    }
+
+    transcript = transcribe.stitch([(30.0, second), (0.0, first)])
+    assert transcript["text"] == " One two. Three."
+    assert transcript["language"] == "en"
+    assert [s["id"] for s in transcript["segments"]] == [0, 1, 2]
+    assert [s["start"] for s in transcript["segments"]] == [0.0, 30.5, 31.0]
+    assert transcript["segments"][2]["seek"] == 3000
+
+
+class StubModel:
+    """
+    Stands in for whisper. Returns one segment per call, spanning the audio.
+    """
+
+    def transcribe(self, samples, language=None, **kwargs):
+        seconds = len(samples) / 16000
+        text = f" {seconds:.1f}s."
+        return {
+            "text": text,
+            "language": language or "de",
+            "segments": [
+                {"id": 0, "seek": 0, "start": 0.0, "end": seconds, "text": text}
+            ],
+        }
+
+
+@patch("transcribe.load_model", new=lambda model_name, device: StubModel())
+@patch("common.get_device", new=lambda: "cpu")
+def test_map_spans():
+    with common.tmpdir_scope() as tmp:
+        path = Path(tmp) / "abc.wav"
+        samples = np.zeros(16000 * 25, dtype=np.int16)
+        samples[::7] = 1000
+        samples[16000 * 9 : 16000 * 10] = 0
+        samples[16000 * 19 : 16000 * 20] = 0
+        with wave.open(str(path), "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(16000)
+            w.writeframes(samples.tobytes())
+
+        spans = audio.split_at_silence(
+            samples, 16000, chunk_seconds=10, search_seconds=2
+        )
+
+        updates = list(
+            transcribe.map_spans(
+                str(path),
+                spans,
+                16000,
+                None,
+                None,
+                lambda args: map(transcribe.transcribe_args, args),
+            )
+        )
+
+        *progress, transcript = updates
+        assert progress[-1] == 99
+        assert transcript["language"] == "de"
+        assert len(transcript["segments"]) == 3
+
+        # segments are contiguous after offsetting each span
+        ends = [s["end"] for s in transcript["segments"]]
+        starts = [s["start"] for s in transcript["segments"]]
+        assert starts[0] == 0.0
+        assert starts[1:] == ends[:-1]
+        assert abs(ends[-1] - 25.0) < 1e-6
+
+
+def test_map_spans_workers():
+    submitted = []
+
+    def starmap(args):
+        submitted.append(len(args))
+        return [{"language": "en", "text": "", "segments": []} for _ in args]
+
+    spans = [(i * 16000, (i + 1) * 16000) for i in range(5)]
+    updates = list(
+        transcribe.map_spans("a.wav", spans, 16000, "en", None, starmap, 2)
+    )
+
+    # never more spans in flight than workers
+    assert submitted == [2, 2, 1]
+    assert updates[:-1] == [20, 40, 60, 80, 99]
+
+
+def test_timestamp_segments():
+    # timestamps start at 100, and each token decodes to its own number
+    decode = lambda tokens: " ".join(map(str, tokens))
+    tokens = [100, 1, 2, 150, 150, 3, 200, 4]
+    segments = transcribe.timestamp_segments(tokens, 100, decode, 30.0)
+
+    got = [(s["start"], s["end"], s["text"]) for s in segments]
+    assert got == [(0.0, 1.0, "1 2"), (1.0, 2.0, "3"), (2.0, 30.0, "4")]
+    assert [s["id"] for s in segments] == [0, 1, 2]
+
+
+def test_window_advance():
+    # timestamps start at 100, and are 20ms apart
+    advance = lambda tokens: transcribe.window_advance(tokens, 100, 30.0)
+
+    # on to the end of the last complete segment
+    assert advance([100, 1, 150, 150, 2, 200, 200, 3]) == 2.0
+    # ending on a single timestamp, or without any, takes the whole window
+    assert advance([100, 1, 150, 150, 2, 200]) == 30.0
+    assert advance([1, 2]) == 30.0
+
+
+@dataclass
+class StubDecoder:
+    "Decodes every window to one segment of ten seconds"
+
+    calls: int = 0
+
+    def decode(self, mel, options):
+        self.calls += 1
+        # timestamps start at 100, and are 20ms apart
+        return SimpleNamespace(tokens=[100, 1, 600, 600])
+
+
+def test_decode_progress():
+    model = StubDecoder()
+    reported = []
+    with transcribe.DecodeProgress(model, 40.0, reported.append, 100):
+        window = object()
+        model.decode(window, None)
+        # a temperature fallback of the same window
+        model.decode(window, None)
+        model.decode(object(), None)
+
+    assert reported == [25, 50]
+    assert model.calls == 3
+    assert "decode" not in vars(model)
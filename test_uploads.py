@@ -0,0 +1,140 @@
+from pathlib import Path
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+import common
+import uploads
+
+
+async def body(data: bytes, piece_size: int = 1000):
+    for i in range(0, len(data), piece_size):
+        yield data[i : i + piece_size]
+
+
+def test_chunked_upload():
+    content = os.urandom(250_000)
+    with common.tmpdir_scope() as tmp:
+        chunked = uploads.ChunkedUpload(Path(tmp) / "abc", len(content), 65536)
+        chunked.start()
+        assert chunked.n_chunks == 4
+        assert chunked.missing() == [0, 1, 2, 3]
+
+        # out of order
+        for index in [3, 1, 0]:
+            start, end = chunked.span(index)
+            chunk = content[start : end + 1]
+            asyncio.run(chunked.write(index, body(chunk)))
+        assert chunked.missing() == [2]
+
+        with pytest.raises(uploads.UploadError):
+            chunked.finalize()
+
+        start, end = chunked.span(2)
+        asyncio.run(chunked.write(2, body(content[start : end + 1])))
+        checksum = f"sha256:{hashlib.sha256(content).hexdigest()}"
+        chunked.finalize(checksum)
+
+        assert chunked.finalized
+        assert chunked.path.read_bytes() == content
+
+
+def test_chunked_upload_errors():
+    with common.tmpdir_scope() as tmp:
+        chunked = uploads.ChunkedUpload(Path(tmp) / "abc", 100_000, 65536)
+        chunked.start()
+
+        assert chunked.index(65536, 99_999) == 1
+        with pytest.raises(uploads.UploadError):
+            chunked.index(1, 65536)
+        with pytest.raises(uploads.UploadError):
+            chunked.index(0, 100)
+
+        # short chunks are not marked as received
+        with pytest.raises(uploads.UploadError):
+            asyncio.run(chunked.write(0, body(b"short")))
+        assert chunked.missing() == [0, 1]
+
+        for index in [0, 1]:
+            start, end = chunked.span(index)
+            asyncio.run(chunked.write(index, body(bytes(end - start + 1))))
+
+        # oversized chunks are cut off before they reach the next chunk
+        with pytest.raises(uploads.UploadError):
+            asyncio.run(chunked.write(0, body(b"\xff" * 100_000)))
+        assert chunked.path.read_bytes()[65536:] == bytes(100_000 - 65536)
+
+        with pytest.raises(uploads.UploadError):
+            chunked.finalize("sha256:00")
+        with pytest.raises(uploads.UploadError):
+            chunked.finalize("nope:00")
+        assert not chunked.finalized
+
+
+def test_follow():
+    content = os.urandom(250_000)
+    with common.tmpdir_scope() as tmp:
+        t = common.Transcription(
+            transcription_id="abc",
+            path=Path(tmp) / "abc",
+            upload=common.UploadInfo(size_bytes=len(content), chunk_size=65536),
+        )
+        chunked = uploads.chunked_upload(t)
+        chunked.start()
+
+        # the first chunk arrives last, so nothing can be read until then
+        def upload():
+            for index in [1, 3, 2, 0]:
+                time.sleep(0.05)
+                start, end = chunked.span(index)
+                chunk = body(content[start : end + 1])
+                asyncio.run(chunked.write(index, chunk))
+
+        writer = threading.Thread(target=upload)
+        writer.start()
+        blocks = list(uploads.follow(t, poll_seconds=0.01))
+        writer.join()
+
+        assert b"".join(blocks) == content
+        assert uploads.upload_complete(t)
+
+
+def test_follow_stalled():
+    with common.tmpdir_scope() as tmp:
+        t = common.Transcription(
+            transcription_id="abc",
+            path=Path(tmp) / "abc",
+            upload=common.UploadInfo(size_bytes=100),
+        )
+        t.uploaded_file.write_bytes(bytes(10))
+
+        blocks = uploads.follow(t, poll_seconds=0.01, idle_timeout=0.05)
+        assert next(blocks) == bytes(10)
+        with pytest.raises(uploads.UploadError):
+            next(blocks)
+
+
+def test_media_hash():
+    content = os.urandom(5 * uploads.BLOCK_SIZE + 1000)
+    with common.tmpdir_scope() as tmp:
+        hashes = []
+        for chunk_size in [uploads.BLOCK_SIZE * 2, 100_000]:
+            path = Path(tmp) / f"{chunk_size}"
+            with open(path, "wb") as f:
+                f.truncate(len(content))
+
+            # unaligned chunks leave blocks to be read back at the end
+            fd = os.open(path, os.O_WRONLY)
+            digests = uploads.BlockDigests(path, len(content))
+            for start in range(0, len(content), chunk_size):
+                chunk = body(content[start : start + chunk_size])
+                asyncio.run(uploads.write_stream(chunk, fd, start, digests))
+            os.close(fd)
+
+            hashes.append(digests.media_hash())
+
+        assert hashes[0] == hashes[1]
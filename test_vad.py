@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import numpy as np
+
+import audio
+import common
+import vad
+from test_audio import silence, write_wav
+
+
+def test_to_track():
+    # speech at 10-12s and 30-31s, with 0.5s between them in the speech file
+    speech = vad.SpeechMap([(10.0, 12.0), (30.0, 31.0)], gap_seconds=0.5)
+
+    track = speech.to_track([0.0, 1.0, 2.5, 3.0])
+    assert np.allclose(track, [10, 11, 30, 30.5])
+
+    # times in the gap are the end of one region, or the start of the next
+    assert speech.to_track(2.2) == 30.0
+    assert speech.to_track(2.2, end=True) == 12.0
+    assert speech.to_track(9.0, end=True) == 31.0
+
+
+def test_to_track_spans_in_gap():
+    speech = vad.SpeechMap([(0.0, 2.0), (10.0, 12.0)], gap_seconds=0.5)
+    assert speech.to_track_spans([(2.1, 2.4)]) == [(2.0, 2.0)]
+    assert speech.to_track_spans([(1.0, 2.4), (2.1, 3.0)]) == [
+        (1.0, 2.0),
+        (10.0, 10.5),
+    ]
+
+
+def test_transcript():
+    speech = vad.SpeechMap([(10.0, 12.0), (30.0, 31.0)], gap_seconds=0.5)
+    transcript = {
+        "text": " One. Two.",
+        "segments": [
+            {"id": 0, "start": 0.0, "end": 2.0, "text": " One."},
+            {"id": 1, "start": 2.5, "end": 3.5, "text": " Two."},
+        ],
+    }
+
+    remapped = speech.transcript(transcript)
+    assert remapped["text"] == transcript["text"]
+    spans = [(s["start"], s["end"]) for s in remapped["segments"]]
+    assert spans == [(10.0, 12.0), (30.0, 31.0)]
+
+    turns = common.Diarization([common.Turn("A", 0.5, 3.0)])
+    assert speech.diarization(turns).turns[0] == common.Turn("A", 10.5, 30.5)
+
+
+def test_write_speech():
+    with common.tmpdir_scope() as tmp:
+        tmp = Path(tmp)
+
+        # a few seconds of speech in two minutes of silence
+        samples, sample_rate = audio.read_wav(Path("fixtures/silent.wav"))
+        quiet = silence(60, sample_rate)
+        samples = np.concatenate([quiet, samples, quiet]).astype(np.int16)
+        write_wav(tmp / "a.wav", samples, sample_rate)
+
+        speech = vad.write_speech(
+            tmp / "a.wav", tmp / "a.speech.wav", tmp / "a.speech.json"
+        )
+
+        speech_samples, _ = audio.read_wav(tmp / "a.speech.wav")
+        seconds = len(speech_samples) / sample_rate
+        assert 0 < seconds < 10
+        assert all(59 <= s and e <= 67 for s, e in speech.regions)
+        assert vad.SpeechMap.read(tmp / "a.speech.json") == speech
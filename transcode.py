@@ -1,22 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
 from dataclasses import dataclass, replace
+import json
 import logging
 import os
 import socket
+import subprocess
+import time
+import typing
+import uuid
 
 from modal import Image
 
 from common import app
 import common
+import uploads
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
+# sample rate of the transcoded wav
+SAMPLE_RATE = 16000
+
+# audio bitrate of the player proxy
+PROXY_AUDIO_BITRATE = 64_000
+
+# uploads below this bitrate are played as they are
+PROXY_MIN_BITRATE = 2 * PROXY_AUDIO_BITRATE
+
+# frame height of the player proxy for video uploads
+PROXY_VIDEO_HEIGHT = 360
+
+# bytes at the start of an upload that are probed before streaming it
+PROBE_BYTES = 4 * 1024 * 1024
+
+# seconds between progress updates, while the percentage doesn't change
+PROGRESS_INTERVAL = 5.0
+
+
 @dataclass
 class TranscodingProgress:
     percent_done: int
     track: common.Track = None
+    # times realtime
+    speed: float = None
+    # of the output, in bits per second
+    bitrate: float = None
+    # seconds until ffmpeg is done
+    eta_seconds: float = None
 
 
 class TranscodeError(Exception):
@@ -39,10 +71,19 @@ transcoder_image = (
 )
 def transcode(
     transcription_id: str,
-    sr: int = 16000,
+    sr: int = SAMPLE_RATE,
     force_reprocessing: bool = False,
     media_path=common.MEDIA_PATH,
+    chunk_seconds: int = None,
+    progressive: bool = False,
 ):
+    """
+    Transcode the upload to a mono wav. If chunk_seconds is given, the same
+    ffmpeg pass also writes fixed length chunks that can be transcribed while
+    transcoding is still running. If progressive is given, an upload that is
+    still arriving is piped into ffmpeg as it arrives.
+    """
+
     import ffmpeg
 
     t = common.db.select(transcription_id)
@@ -54,69 +95,282 @@ def transcode(
         yield TranscodingProgress(percent_done=100, track=t.track)
         return
 
+    # the upload may still be arriving. stream it into ffmpeg. callers check
+    # that it can be streamed first, since waiting for the rest of it here
+    # would hold this container for the whole upload
+    blocks = None
+    if progressive and not uploads.upload_complete(t):
+        probe = probe_upload(t)
+        if not probe:
+            raise TranscodeError(f"cannot stream upload : {transcription_id}")
+        logger.info(f"streaming upload into ffmpeg")
+        blocks = uploads.follow(t)
+
     # we haven't processed this yet. get the track metadata
-    probe = ffmpeg.probe(t.uploaded_file)
-    track = common.Track.from_probe(probe)
-
-    with create_sock() as (socket_filename, socket):
-        process = (
-            ffmpeg.input(t.uploaded_file)
-            .output(
-                filename=t.transcoded_file,
-                format="wav",
+    if blocks:
+        duration = streamed_duration(probe, t.upload.size_bytes)
+    else:
+        probe = ffmpeg.probe(t.uploaded_file)
+        track = common.Track.from_probe(probe)
+        duration = track.duration
+
+    # ffmpeg writes to temporary files, which then replace the old ones. the
+    # old ones may be hard links to the files of another upload, which
+    # writing them in place would overwrite too
+    staged = {}
+
+    def staging(path):
+        staged[path] = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        return staged[path]
+
+    stream = ffmpeg.input("pipe:" if blocks else t.uploaded_file)
+    outputs = [
+        stream.output(
+            filename=staging(t.transcoded_file),
+            format="wav",
+            ac=1,
+            acodec="pcm_s16le",
+            ar=sr,
+        )
+    ]
+
+    # a small rendition for the player, so that it doesn't stream the upload
+    if has_video(probe):
+        outputs.append(
+            stream.output(
+                filename=staging(t.video_proxy_file),
+                format="mp4",
+                vf=f"scale=-2:{PROXY_VIDEO_HEIGHT}",
+                vcodec="libx264",
+                preset="veryfast",
+                crf=30,
+                acodec="aac",
+                audio_bitrate=PROXY_AUDIO_BITRATE,
+                movflags="+faststart",
+            )
+        )
+    elif int(probe["format"].get("bit_rate", PROXY_MIN_BITRATE + 1)) > (
+        PROXY_MIN_BITRATE
+    ):
+        outputs.append(
+            stream.output(
+                filename=staging(t.audio_proxy_file),
+                format="ipod",
+                vn=None,
+                acodec="aac",
+                audio_bitrate=PROXY_AUDIO_BITRATE,
+                movflags="+faststart",
+            )
+        )
+
+    chunks = None
+    if chunk_seconds:
+        chunks = common.ChunkedAudio(t.transcoded_chunks_path)
+        chunks.start(duration, chunk_seconds)
+        outputs.append(
+            stream.output(
+                str(chunks.chunk_pattern),
+                format="segment",
+                segment_format="wav",
+                segment_time=chunk_seconds,
+                segment_list=chunks.index_file,
+                segment_list_type="csv",
+                vn=None,
                 ac=1,
                 acodec="pcm_s16le",
                 ar=sr,
             )
-            .overwrite_output()
-            .global_args("-progress", "unix://{}".format(socket_filename))
-            .run_async(
-                cmd=["ffmpeg", "-nostdin"],
-            )
         )
 
-        yield from map(
-            lambda x: TranscodingProgress(percent_done=x),
-            progress(socket, track.duration),
-        )
+    try:
+        with create_sock() as (socket_filename, socket), ThreadPoolExecutor(
+            max_workers=1
+        ) as executor:
+            process = (
+                ffmpeg.merge_outputs(*outputs)
+                .overwrite_output()
+                .global_args("-progress", f"unix://{socket_filename}")
+                .run_async(
+                    cmd=["ffmpeg", "-nostdin"],
+                    pipe_stdin=bool(blocks),
+                )
+            )
+
+            feeding = None
+            if blocks:
+                feeding = executor.submit(feed, process, blocks)
+            yield from progress(socket, duration)
 
-        return_code = process.wait()
-        if return_code != 0:
-            raise TranscodeError(f"ffmpeg failed : {return_code}")
+            return_code = process.wait()
+            error = None
+            if return_code != 0:
+                error = f"ffmpeg failed : {return_code}"
+            elif feeding and feeding.exception():
+                # ffmpeg saw the end of its input, but not of the upload
+                error = f"upload failed : {feeding.exception()}"
+
+            if error:
+                if chunks:
+                    chunks.finish(error=error)
+                raise TranscodeError(error)
+
+        for path, tmp in staged.items():
+            os.replace(tmp, path)
+    finally:
+        for tmp in staged.values():
+            tmp.unlink(missing_ok=True)
+
+    # the whole upload is on disk now, so its metadata is exact
+    if blocks:
+        track = common.Track.from_probe(ffmpeg.probe(t.uploaded_file))
 
     # completed
+    if chunks:
+        chunks.finish()
+
     yield TranscodingProgress(percent_done=100, track=track)
 
 
-def progress(sock, total_duration):
-    """Connect to ffmpeg progress unix socket and read lines of progress"""
+def has_video(probe: dict) -> bool:
+    "Whether a probed file has moving pictures, rather than just cover art"
+    return any(
+        s.get("codec_type") == "video"
+        and not s.get("disposition", {}).get("attached_pic")
+        for s in probe.get("streams", [])
+    )
+
+
+@app.function(
+    cpu=1.0,
+    container_idle_timeout=60,
+    image=transcoder_image,
+    network_file_systems=common.nfs,
+    timeout=600,
+)
+def streamable(transcription_id: str) -> bool:
+    """
+    Whether an upload can be transcoded while it is still arriving. Complete
+    uploads always can.
+    """
+
+    t = common.db.select(transcription_id)
+    if not t:
+        raise TranscodeError(f"invalid id : {transcription_id}")
+    return uploads.upload_complete(t) or probe_upload(t) is not None
+
+
+def probe_upload(t) -> typing.Optional[dict]:
+    """
+    Probe the start of an upload that is still arriving. Returns None if
+    ffmpeg can't read it front to back, e.g. an mp4 with its index at the
+    end, or if the length of the whole upload can't be estimated.
+    """
+
+    n_bytes = uploads.wait_for(t, PROBE_BYTES)
+    with open(t.uploaded_file, "rb") as f:
+        data = f.read(min(n_bytes, PROBE_BYTES))
+
+    args = ["-show_format", "-show_streams", "-of", "json", "pipe:"]
+    result = subprocess.run(["ffprobe", *args], input=data, capture_output=True)
+    if result.returncode != 0:
+        logger.info(f"cannot probe upload: {result.stderr.decode()[-200:]}")
+        return None
+
+    probe = json.loads(result.stdout)
+    if not streamed_duration(probe, t.upload.size_bytes):
+        return None
+
+    return probe
+
+
+def streamed_duration(probe: dict, size_bytes: int) -> typing.Optional[float]:
+    "Estimate the duration of a whole upload from a probe of its start"
+    bit_rate = probe.get("format", {}).get("bit_rate", "N/A")
+    if bit_rate != "N/A" and int(bit_rate) > 0:
+        return size_bytes * 8 / int(bit_rate)
+
+
+def feed(process, blocks: typing.Iterator[bytes]):
+    "Write blocks to the stdin of process, then close it"
+    try:
+        for block in blocks:
+            process.stdin.write(block)
+    except BrokenPipeError:
+        # ffmpeg has exited. its return code tells why
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def progress(sock, total_duration, interval: float = PROGRESS_INTERVAL):
+    """
+    Read progress from the ffmpeg progress socket. ffmpeg writes a block of
+    key=value lines per update, ending in a progress line. Updates are sent
+    on when the percentage changes, or after interval seconds.
+    """
+
     connection, client_address = sock.accept()
-    data = b""
-    progress = 0
+    percent_done, last_sent = None, 0.0
     try:
-        while True:
-
-            more_data = connection.recv(16)
-            if not more_data:
-                break
-            data += more_data
-            lines = data.split(b"\n")
-            for line in lines[:-1]:
-                line = line.decode()
-                parts = line.split("=")
-                key = parts[0] if len(parts) > 0 else None
-                value = parts[1] if len(parts) > 1 else None
-                if key == "out_time_ms":
-                    current = round(float(value) / 1000000.0, 2)
-                    progress = int(100 * current / total_duration)
-                    yield progress
-                elif key == "progress" and value == "end":
-                    yield progress
-
-            data = lines[-1]
+        with connection.makefile("rb") as lines:
+            block = {}
+            for line in lines:
+                key, _, value = line.decode().strip().partition("=")
+                block[key] = value
+                if key != "progress":
+                    continue
+
+                update = parse_progress(block, total_duration)
+                block = {}
+                now = time.monotonic()
+                if (
+                    update.percent_done != percent_done
+                    or now - last_sent >= interval
+                ):
+                    percent_done, last_sent = update.percent_done, now
+                    yield update
     finally:
         connection.close()
-        yield 100
+
+    if percent_done != 100:
+        yield TranscodingProgress(percent_done=100)
+
+
+def parse_progress(block: dict, total_duration: float) -> TranscodingProgress:
+    "Progress from one block of ffmpeg progress keys"
+
+    def number(key, suffix=""):
+        try:
+            return float(block.get(key, "").strip().removesuffix(suffix))
+        except ValueError:
+            return None
+
+    # out_time_ms is in microseconds as well, in older ffmpegs
+    current = number("out_time_us") or number("out_time_ms") or 0.0
+    current /= 1_000_000
+    speed = number("speed", "x")
+    bitrate = number("bitrate", "kbits/s")
+
+    percent_done = 100
+    if block.get("progress") != "end":
+        percent_done = 0
+        if total_duration:
+            percent_done = int(100 * current / total_duration)
+        percent_done = max(0, min(99, percent_done))
+
+    eta_seconds = None
+    if speed and total_duration:
+        eta_seconds = max(0.0, total_duration - current) / speed
+
+    return TranscodingProgress(
+        percent_done=percent_done,
+        speed=speed,
+        bitrate=bitrate * 1000 if bitrate is not None else None,
+        eta_seconds=eta_seconds,
+    )
 
 
 @contextlib.contextmanager
@@ -1,11 +1,18 @@
 from dataclasses import dataclass
+import functools
 import logging
-import sys
+import math
+import queue
+import threading
+import time
 import traceback
 
 from modal import Image
 
+import asr
 import common
+import models
+import vad
 from common import app
 
 logger = logging.getLogger(__name__)
@@ -16,12 +23,38 @@ logging.basicConfig(level=logging.INFO)
 class TranscriptionProgress:
     percent_done: int
     transcript: dict = None
+    # newly transcribed segments, when streaming
+    segments: list = None
+
+
+@dataclass
+class BatchProgress:
+    transcription_id: str
+    percent_done: int
+    transcript: dict = None
+    error: str = None
 
 
 class TranscriptionError(Exception):
     pass
 
 
+# length of the spans that long files are split into for map transcription
+MAP_CHUNK_SECONDS = 300
+
+# upper bound on the number of concurrent map workers
+MAP_MAX_WORKERS = 8
+
+# files shorter than this are transcribed in one go
+MAP_MIN_SECONDS = 1200
+
+# whisper windows decoded at once by batch transcription
+BATCH_WINDOWS = 16
+
+# seconds per whisper timestamp token
+TIMESTAMP_SECONDS = 0.02
+
+
 def load_whisper():
     import whisper
 
@@ -32,7 +65,9 @@ transcriber_image = (
     Image.debian_slim(python_version="3.10.8")
     .apt_install("ffmpeg")
     .pip_install(
-        "https://github.com/openai/whisper/archive/v20230314.tar.gz", "tqdm"
+        "https://github.com/openai/whisper/archive/v20230314.tar.gz",
+        "faster-whisper==1.0.3",
+        "tqdm",
     )
     .run_function(load_whisper)
 )
@@ -46,65 +81,606 @@ transcriber_image = (
     network_file_systems=common.nfs,
     timeout=1200,
 )
-def transcribe(transcription_id, language, prompt=None):
-    import torch.multiprocessing as mp
+def transcribe(
+    transcription_id,
+    language,
+    prompt=None,
+    streaming=False,
+    asr_options=None,
+    speech=False,
+):
+    """
+    Transcribe the transcoded file. When streaming, transcribe the chunks
+    written by a concurrently running transcoder as soon as they land.
+    asr_options picks the recognition backend, as in asr.AsrOptions. With
+    speech, only the speech file written by vad is transcribed.
+    """
+
+    yield from transcribe_file(
+        transcription_id, language, prompt, streaming, asr_options, speech
+    )
+
+
+@app.function(
+    cpu=16.0,
+    container_idle_timeout=180,
+    image=transcriber_image,
+    network_file_systems=common.nfs,
+    timeout=3600,
+)
+def transcribe_cpu(
+    transcription_id,
+    language,
+    prompt=None,
+    streaming=False,
+    asr_options=None,
+    speech=False,
+):
+    """
+    Transcribe on cpu only, e.g. with an int8 faster-whisper model, which
+    leaves the gpus to interactive work. Yields just like transcribe.
+    """
+
+    yield from transcribe_file(
+        transcription_id, language, prompt, streaming, asr_options, speech
+    )
+
+
+def transcribe_file(
+    transcription_id, language, prompt, streaming, options, speech=False
+):
+    t = common.db.select(transcription_id)
+    if not t:
+        raise TranscriptionError(f"invalid id : {transcription_id}")
+
+    options = asr.AsrOptions.from_dict(options)
+    device = common.get_device()
+    speech_map = None
+    if streaming:
+        target = stream_worker
+        audio = str(t.transcoded_chunks_path)
+    else:
+        target = worker
+        audio, speech_map = vad.speech_input(t, speech)
+        if speech_map and not speech_map.regions:
+            yield empty_transcript(language)
+            return
+
+    updates = whisper_runner.run(
+        target, str(audio), device, language, prompt, options
+    )
+    yield from in_track_time(updates, speech_map)
+
+
+def in_track_time(updates, speech_map: vad.SpeechMap = None):
+    "Map the timestamps of transcripts of the speech file to the track"
+    for update in updates:
+        if speech_map and isinstance(update, dict):
+            update = speech_map.transcript(update)
+        yield update
+
+
+def empty_transcript(language: str = None) -> dict:
+    "The transcript of a file without speech"
+    return {"text": "", "segments": [], "language": language}
+
+
+class WhisperRunner:
+    """
+    Runs whisper in this process, on a thread of its own, and yields what it
+    reports as it goes. The model is loaded once per container. Jobs run one
+    at a time, since they share the model.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def run(self, target, *args):
+        "Run target in a thread and yield what it puts, until it puts None"
+        with self.lock:
+            q = queue.Queue()
+            thread = threading.Thread(
+                target=target, args=(q, *args), daemon=True
+            )
+            thread.start()
+            try:
+                while (res := q.get()) is not None:
+                    yield res
+            finally:
+                # an abandoned job still holds the model until it is done
+                thread.join()
+                logger.info(f"model stats: {models.registry.stats()}")
+
+
+# the whisper runner of this container
+whisper_runner = WhisperRunner()
+
+
+class DecodeProgress:
+    """
+    Reports the progress of model.transcribe from a hook on model.decode,
+    which whisper calls for every 30s window, and again for each temperature
+    fallback of a window. A window moves the transcription on to its last
+    timestamp, unless it ends on a single timestamp, as in whisper itself.
+    """
+
+    def __init__(
+        self,
+        model,
+        duration: float,
+        callback,
+        timestamp_begin: int,
+        window_seconds: float = common.CHUNK_SECONDS,
+    ):
+        self.model = model
+        self.duration = duration
+        self.callback = callback
+        self.timestamp_begin = timestamp_begin
+        self.window_seconds = window_seconds
+        self.mel = None
+        self.done_seconds = 0.0
+        self.window_advance = 0.0
+        self.percent_done = 0
+
+    def __enter__(self):
+        self.decode = self.model.decode
+        self.model.decode = self.hook
+        return self
+
+    def __exit__(self, *exc):
+        # drop the instance attribute, which uncovers the method again
+        del self.model.decode
+
+    def hook(self, mel, options):
+        result = self.decode(mel, options)
+
+        # fallbacks decode the same window again
+        if mel is not self.mel:
+            self.done_seconds += self.window_advance
+            self.mel = mel
+        self.window_advance = window_advance(
+            result.tokens, self.timestamp_begin, self.window_seconds
+        )
+
+        seconds = self.done_seconds + self.window_advance
+        percent_done = min(99, int(100 * seconds / max(self.duration, 1e-6)))
+        if percent_done > self.percent_done:
+            self.percent_done = percent_done
+            self.callback(percent_done)
+
+        return result
+
+
+def window_advance(tokens, timestamp_begin, window_seconds: float) -> float:
+    "Seconds that whisper moves on by after decoding a window"
+    timestamps = [t >= timestamp_begin for t in tokens]
+    pairs = [i for i in range(1, len(tokens)) if all(timestamps[i - 1 : i + 1])]
+    if not pairs or timestamps[-2:] == [False, True]:
+        return window_seconds
+
+    # the end of the last complete segment
+    last = tokens[pairs[-1] - 1]
+    return (last - timestamp_begin) * TIMESTAMP_SECONDS
+
+
+@app.function(
+    cpu=4.0,
+    container_idle_timeout=180,
+    image=transcriber_image,
+    network_file_systems=common.nfs,
+    timeout=3600,
+)
+def transcribe_map(
+    transcription_id,
+    language,
+    prompt=None,
+    n_workers=MAP_MAX_WORKERS,
+    chunk_seconds=MAP_CHUNK_SECONDS,
+    local_mode=False,
+    speech=False,
+):
+    """
+    Map-reduce transcription. Splits the transcoded file at silences, fans
+    the spans out to whisper workers and stitches the results back together.
+    Yields progress and then the transcript, just like transcribe. With
+    speech, only the speech file written by vad is transcribed.
+    """
+
+    import audio
 
     t = common.db.select(transcription_id)
     if not t:
         raise TranscriptionError(f"invalid id : {transcription_id}")
 
+    audio_file, speech_map = vad.speech_input(t, speech)
+    if speech_map and not speech_map.regions:
+        yield empty_transcript(language)
+        return
+
+    samples, sample_rate = audio.read_wav(audio_file)
+    spans = audio.split_at_silence(samples, sample_rate, chunk_seconds)
+    logger.info(f"transcribing {len(spans)} spans on {n_workers} workers")
+
+    if not local_mode:
+        updates = map_spans(
+            str(audio_file),
+            spans,
+            sample_rate,
+            language,
+            prompt,
+            transcribe_span.starmap,
+            n_workers=n_workers,
+        )
+        yield from in_track_time(updates, speech_map)
+        return
+
+    import torch.multiprocessing as mp
+
+    with mp.get_context("spawn").Pool(n_workers) as pool:
+        updates = map_spans(
+            str(audio_file),
+            spans,
+            sample_rate,
+            language,
+            prompt,
+            functools.partial(pool.imap, transcribe_args),
+        )
+        yield from in_track_time(updates, speech_map)
+
+
+@app.function(
+    gpu=["A100-40GB", "A10G"],
+    cpu=8.0,
+    container_idle_timeout=180,
+    image=transcriber_image,
+    network_file_systems=common.nfs,
+    timeout=1200,
+)
+def transcribe_span(audio_file, start, end, language, prompt=None):
+    return transcribe_samples(audio_file, start, end, language, prompt)
+
+
+@app.function(
+    gpu=["A100-40GB", "A10G"],
+    cpu=8.0,
+    container_idle_timeout=180,
+    image=transcriber_image,
+    network_file_systems=common.nfs,
+    timeout=3600,
+)
+def transcribe_batch(transcription_ids, language=None, prompt=None):
+    """
+    Transcribe many short transcoded files on the resident model, decoding
+    windows of several files at once. Yields a BatchProgress per file and
+    batch, with the transcript of a file as soon as it is complete.
+    """
+
+    files = []
+    for transcription_id in transcription_ids:
+        t = common.db.select(transcription_id)
+        if not t or not t.transcoded_file.exists():
+            error = f"not transcoded : {transcription_id}"
+            yield BatchProgress(transcription_id, 100, error=error)
+        else:
+            files.append((transcription_id, str(t.transcoded_file)))
+
+    device = common.get_device()
+    for update in whisper_runner.run(
+        batch_worker, files, device, language, prompt
+    ):
+        if isinstance(update, Exception):
+            raise update
+        yield update
+
+
+def transcribe_args(args):
+    return transcribe_samples(*args)
+
+
+def transcribe_samples(
+    audio_file, start, end, language, prompt=None, model_name=common.MODEL_NAME
+):
+    "Transcribe samples [start, end) of a wav file with a cached model"
+    import audio
+
     device = common.get_device()
-    mp.set_start_method("spawn", force=True)
-    q = mp.Queue()
-    p = mp.Process(
-        target=worker,
-        args=(q, str(t.transcoded_file), device, language, prompt),
+    model = load_model(model_name, device)
+    samples, _ = audio.read_wav(audio_file)
+    logger.info(f"transcribe span {start}-{end} ({language})")
+    return model.transcribe(
+        audio.to_float(samples[start:end]),
+        language=language,
+        initial_prompt=prompt,
+        fp16=device.startswith("cuda"),
+        verbose=None,
     )
-    logger.info("spawning whisper process")
-    p.start()
-    while True:
-        res = q.get()
-        if res is None:
-            break
-        yield res
-    p.join()
-
-
-def worker(q, audio, device, language, prompt):
-    import tqdm
+
+
+def load_model(model_name, device):
+    "Load a whisper model once per process"
     import whisper
-    import whisper.transcribe
 
-    class Progress(tqdm.tqdm):
-        def __init__(self, *args, **kwargs):
-            super().__init__(*args, **kwargs)
-            self._current = self.n
+    return models.registry.get(
+        model_name,
+        device,
+        lambda: whisper.load_model(model_name, device=device),
+    )
+
+
+def map_workers(duration: float) -> int:
+    "Number of map workers to use for a file of the given duration"
+    if not duration or duration < MAP_MIN_SECONDS:
+        return 1
+    return min(MAP_MAX_WORKERS, math.ceil(duration / MAP_CHUNK_SECONDS))
+
+
+def map_spans(
+    audio_file, spans, sample_rate, language, prompt, starmap, n_workers=None
+):
+    """
+    Transcribe spans with the given starmap, e.g. a modal function's starmap
+    or a local pool. Results must come back in order. The language is
+    detected once on the first span, so all spans share a single language.
+    With n_workers, no more than that many spans are submitted at once, for
+    starmaps that would otherwise run all of them.
+    """
+
+    args = [(audio_file, start, end, language, prompt) for start, end in spans]
+    results = []
+    if not language:
+        (first,) = starmap(args[:1])
+        language = first.get("language")
+        results.append(first)
+        args = [(*a[:3], language, a[4]) for a in args[1:]]
+
+    window = n_workers or len(args) or 1
+    for i in range(0, len(args), window):
+        for result in starmap(args[i : i + window]):
+            results.append(result)
+            yield min(99, int(100 * len(results) / len(spans)))
+
+    offsets = [start / sample_rate for start, _ in spans]
+    yield stitch(list(zip(offsets, results)), language)
+
 
-        def update(self, n):
-            super().update(n)
-            self._current += n
-            percent_done = int(100 * self._current / self.total)
-            logger.info(f"progress: {percent_done}")
-            q.put(percent_done)
+def worker(q, audio_file, device, language, prompt, options=None):
+    import audio
 
     try:
+        options = options or asr.AsrOptions()
+        backend = asr.load_backend(options, device)
+        samples, sample_rate = audio.read_wav(audio_file)
+        duration = len(samples) / sample_rate
 
-        # patch whisper so we can generate progress
-        transcribe_module = sys.modules["whisper.transcribe"]
-        transcribe_module.tqdm.tqdm = Progress
-
-        # run recognition and send back the transcript. this will also send
-        # progress back to the parent process via the given pipe
-        use_gpu = device == "gpu"
-        logger.info(f"transcribe loading model")
-        model = whisper.load_model(common.MODEL_NAME, device=device)
-        logger.info(f"transcribe {language} (gpu:{use_gpu}). prompt: {prompt}")
-        transcript = model.transcribe(
-            audio, language=language, prompt=prompt, fp16=use_gpu, verbose=False
+        # run recognition and send back the transcript, with progress on the
+        # way from the backend
+        logger.info(f"transcribe {language} ({options}). prompt: {prompt}")
+        started = time.monotonic()
+        transcript = backend.transcribe(
+            audio_file, duration, language, prompt, q.put
         )
+        logger.info(f"transcribed in {time.monotonic() - started:.2f}s")
         q.put(transcript)
         q.put(None)
     except Exception as e:
         traceback.print_exc()
         q.put(e)
         q.put(None)
+
+
+def stream_worker(q, chunks_path, device, language, prompt, options=None):
+    try:
+        backend = asr.load_backend(options or asr.AsrOptions(), device)
+        chunks = common.ChunkedAudio(chunks_path)
+
+        results = []
+        for chunk in chunks.follow():
+            logger.info(f"transcribe chunk {chunk.path.name} ({language})")
+            result = backend.transcribe(
+                str(chunk.path), chunk.end - chunk.start, language, prompt
+            )
+
+            # fix the language after the first chunk. condition each chunk
+            # on the text of the previous one, like whisper does per window
+            language = language or result.get("language")
+            prompt = result["text"] or prompt
+            results.append((chunk.start, result))
+
+            duration = chunks.manifest()["duration"]
+            percent_done = min(99, int(100 * chunk.end / duration))
+            segments = offset_segments(result["segments"], chunk.start)
+            q.put(TranscriptionProgress(percent_done, segments=segments))
+
+        q.put(stitch(results, language))
+        q.put(None)
+    except Exception as e:
+        traceback.print_exc()
+        q.put(e)
+        q.put(None)
+
+
+def batch_worker(q, files, device, language, prompt):
+    """
+    Decode the whisper windows of all files in batches. Windows are decoded
+    independently, like streamed chunks, and stitched per file. Without a
+    language, each file takes the language detected in its first window.
+    """
+
+    import torch
+    import whisper
+
+    import audio
+
+    try:
+        use_gpu = device.startswith("cuda")
+        model = load_model(common.MODEL_NAME, device)
+        tokenizer = whisper.tokenizer.get_tokenizer(model.is_multilingual)
+        n_samples = whisper.audio.N_SAMPLES
+        window_seconds = whisper.audio.CHUNK_LENGTH
+        n_windows = {}
+        results = {}
+
+        def windows():
+            "(transcription_id, index, samples) for every window"
+            for transcription_id, path in files:
+                try:
+                    samples, _ = audio.read_wav(path)
+                except Exception as e:
+                    error = f"cannot read {path}: {e}"
+                    q.put(BatchProgress(transcription_id, 100, error=error))
+                    continue
+                n = max(1, math.ceil(len(samples) / n_samples))
+                n_windows[transcription_id] = n
+                results[transcription_id] = []
+                for i in range(n):
+                    window = samples[i * n_samples : (i + 1) * n_samples]
+                    yield transcription_id, i, audio.to_float(window)
+
+        def decode(batch):
+            mels = torch.stack(
+                [
+                    whisper.log_mel_spectrogram(whisper.pad_or_trim(x))
+                    for _, _, x in batch
+                ]
+            ).to(model.device)
+            options = whisper.DecodingOptions(
+                language=language, prompt=prompt, fp16=use_gpu
+            )
+            decoded = whisper.decode(model, mels, options)
+            for (transcription_id, i, _), result in zip(batch, decoded):
+                results[transcription_id].append(
+                    (
+                        i * window_seconds,
+                        window_result(result, tokenizer, window_seconds),
+                    )
+                )
+                done = len(results[transcription_id])
+                total = n_windows[transcription_id]
+                if done < total:
+                    percent_done = min(99, int(100 * done / total))
+                    q.put(BatchProgress(transcription_id, percent_done))
+                    continue
+
+                # the language of the first window is that of the file
+                windows_of = results.pop(transcription_id)
+                detected = windows_of[0][1]["language"]
+                transcript = stitch(windows_of, language or detected)
+                q.put(BatchProgress(transcription_id, 100, transcript))
+
+        started = time.monotonic()
+        batch = []
+        for window in windows():
+            batch.append(window)
+            if len(batch) == BATCH_WINDOWS:
+                decode(batch)
+                batch = []
+        if batch:
+            decode(batch)
+
+        logger.info(
+            f"transcribed {len(files)} files in "
+            f"{time.monotonic() - started:.2f}s"
+        )
+        q.put(None)
+    except Exception as e:
+        traceback.print_exc()
+        q.put(e)
+        q.put(None)
+
+
+def window_result(result, tokenizer, window_seconds: float) -> dict:
+    """
+    A whisper result for one decoded window. Silent windows have no text,
+    by whisper's own no speech rule.
+    """
+
+    text, segments = result.text, []
+    if result.no_speech_prob > 0.6 and result.avg_logprob < -1.0:
+        text = ""
+    else:
+        segments = timestamp_segments(
+            result.tokens,
+            tokenizer.timestamp_begin,
+            tokenizer.decode,
+            window_seconds,
+        )
+        for s in segments:
+            s["avg_logprob"] = result.avg_logprob
+            s["compression_ratio"] = result.compression_ratio
+            s["no_speech_prob"] = result.no_speech_prob
+            s["temperature"] = result.temperature
+
+    return {"text": text, "segments": segments, "language": result.language}
+
+
+def timestamp_segments(
+    tokens, timestamp_begin, decode, window_seconds: float
+) -> list:
+    """
+    Split decoded tokens into segments at timestamp tokens, as whisper
+    does. A segment runs from one timestamp to the next, and text after the
+    last timestamp runs to the end of the window.
+    """
+
+    segments = []
+    start, last, text = None, 0.0, []
+    for token in tokens:
+        if token < timestamp_begin:
+            text.append(token)
+            continue
+
+        seconds = (token - timestamp_begin) * TIMESTAMP_SECONDS
+        if text:
+            segments.append((last if start is None else start, seconds, text))
+            start, text = None, []
+        else:
+            start = seconds
+        last = seconds
+
+    if text:
+        start = last if start is None else start
+        segments.append((start, window_seconds, text))
+
+    return [
+        {
+            "id": i,
+            "seek": 0,
+            "start": start,
+            "end": end,
+            "text": decode(text),
+            "tokens": text,
+        }
+        for i, (start, end, text) in enumerate(segments)
+    ]
+
+
+def offset_segments(segments, offset):
+    "Shift whisper segments by offset seconds"
+    return [
+        s
+        | {
+            "start": s["start"] + offset,
+            "end": s["end"] + offset,
+            "seek": s.get("seek", 0) + round(offset * 100),
+        }
+        for s in segments
+    ]
+
+
+def stitch(results, language=None):
+    """
+    Combine whisper results of consecutive chunks into a single whisper
+    result. Results are (offset, result) tuples, with offsets in seconds.
+    """
+
+    texts = []
+    segments = []
+    for offset, result in sorted(results, key=lambda x: x[0]):
+        texts.append(result["text"])
+        for s in offset_segments(result["segments"], offset):
+            segments.append(s | {"id": len(segments)})
+
+    if not language and results:
+        language = results[0][1].get("language")
+
+    return {"text": "".join(texts), "segments": segments, "language": language}
@@ -0,0 +1,343 @@
+"""
+Chunked uploads. Chunks of parallel uploads may arrive in any order, from
+any number of requests at once, and are assembled in place.
+"""
+
+from pathlib import Path
+import hashlib
+import logging
+import math
+import os
+import time
+import typing
+
+import anyio
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# smallest chunk a parallel upload may use
+MIN_CHUNK_SIZE = 64 * 1024
+
+# bytes of a request body buffered before each write to disk
+WRITE_SIZE = 1024 * 1024
+
+# bytemap value of a chunk that is on disk
+RECEIVED = b"\x01"
+
+# uploads are hashed in blocks of this size, as the blocks arrive
+BLOCK_SIZE = MIN_CHUNK_SIZE
+
+# bytes per block digest
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+class UploadError(Exception):
+    pass
+
+
+async def write_stream(
+    stream: typing.AsyncIterator[bytes],
+    fd: int,
+    offset: int,
+    digests: "BlockDigests" = None,
+    limit: int = None,
+) -> int:
+    """
+    Write a request body to fd at offset as it arrives, without holding
+    more than WRITE_SIZE bytes of it in memory. Returns the bytes written.
+    Raises UploadError as soon as the body runs past limit bytes, before
+    anything past it is written.
+    """
+
+    written = 0
+    buffer = bytearray()
+    async for data in stream:
+        buffer += data
+        if limit is not None and written + len(buffer) > limit:
+            raise UploadError(f"body is larger than {limit} bytes")
+        if len(buffer) >= WRITE_SIZE:
+            # end on a block boundary, so that every block can be digested
+            n = len(buffer) - (offset + written + len(buffer)) % BLOCK_SIZE
+            await anyio.to_thread.run_sync(
+                write_at, fd, bytes(buffer[:n]), offset + written, digests
+            )
+            written += n
+            del buffer[:n]
+
+    if buffer:
+        await anyio.to_thread.run_sync(
+            write_at, fd, bytes(buffer), offset + written, digests
+        )
+        written += len(buffer)
+
+    return written
+
+
+def write_at(fd: int, data: bytes, offset: int, digests=None):
+    os.pwrite(fd, data, offset)
+    if digests:
+        digests.add(offset, data)
+
+
+class BlockDigests:
+    """
+    Sha256 digests of the fixed size blocks of an upload, each written as
+    soon as its block arrives. The media hash is the digest of all block
+    digests, so it is the same however the upload was chunked.
+    """
+
+    def __init__(self, path: Path, size_bytes: int):
+        self.path = Path(path)
+        self.size_bytes = size_bytes
+
+    @property
+    def digest_file(self):
+        return self.path.with_suffix(".digests")
+
+    @property
+    def n_blocks(self):
+        return math.ceil(self.size_bytes / BLOCK_SIZE)
+
+    def block(self, index: int) -> typing.Tuple[int, int]:
+        "Start and end of a block, end exclusive"
+        start = index * BLOCK_SIZE
+        return start, min(start + BLOCK_SIZE, self.size_bytes)
+
+    def add(self, offset: int, data: bytes):
+        "Digest the blocks that data covers completely"
+        first = -(-offset // BLOCK_SIZE)
+        digests = []
+        for index in range(first, self.n_blocks):
+            start, end = self.block(index)
+            if end > offset + len(data):
+                break
+            block = data[start - offset : end - offset]
+            digests.append(hashlib.sha256(block).digest())
+
+        if digests:
+            # writing past the end leaves zeros for blocks not seen yet
+            fd = os.open(self.digest_file, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, b"".join(digests), first * DIGEST_SIZE)
+            finally:
+                os.close(fd)
+
+    def media_hash(self) -> str:
+        """
+        Hash of the complete upload. Blocks that arrived split over several
+        writes have no digest yet, and are read back from the upload.
+        """
+
+        size = self.n_blocks * DIGEST_SIZE
+        digests = bytearray(size)
+        if self.digest_file.exists():
+            data = self.digest_file.read_bytes()[:size]
+            digests[: len(data)] = data
+
+        empty = bytes(DIGEST_SIZE)
+        with open(self.path, "rb") as f:
+            for index in range(self.n_blocks):
+                at = index * DIGEST_SIZE
+                if digests[at : at + DIGEST_SIZE] == empty:
+                    start, end = self.block(index)
+                    f.seek(start)
+                    block = f.read(end - start)
+                    digest = hashlib.sha256(block).digest()
+                    digests[at : at + DIGEST_SIZE] = digest
+
+        return hashlib.sha256(digests).hexdigest()
+
+
+class ChunkedUpload:
+    """
+    An upload split into fixed size chunks. The file is allocated up front,
+    and each chunk is written at its own offset. A bytemap next to the file
+    holds a byte per chunk, which is set once that chunk is on disk. No two
+    chunks write the same bytes of either file, so chunks need no locking.
+    """
+
+    def __init__(self, path: Path, size_bytes: int, chunk_size: int):
+        self.path = Path(path)
+        self.size_bytes = size_bytes
+        self.chunk_size = chunk_size
+
+    @property
+    def bytemap_file(self):
+        return self.path.with_suffix(".upload")
+
+    @property
+    def n_chunks(self):
+        return math.ceil(self.size_bytes / self.chunk_size)
+
+    @property
+    def finalized(self):
+        return self.path.exists() and not self.bytemap_file.exists()
+
+    def start(self):
+        with open(self.path, "wb") as f:
+            f.truncate(self.size_bytes)
+        with open(self.bytemap_file, "wb") as f:
+            f.write(bytes(self.n_chunks))
+
+    def span(self, index: int) -> typing.Tuple[int, int]:
+        "First and last byte of a chunk"
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.size_bytes) - 1
+
+    def index(self, start: int, end: int) -> int:
+        "The chunk that spans start to end, both inclusive"
+        index = start // self.chunk_size
+        if start % self.chunk_size or index >= self.n_chunks:
+            raise UploadError(f"not the start of a chunk: {start}")
+        if self.span(index) != (start, end):
+            raise UploadError(f"chunk {index} spans {self.span(index)}")
+        return index
+
+    async def write(self, index: int, stream: typing.AsyncIterator[bytes]):
+        """
+        Write a chunk from a request body, and mark it as received if it was
+        complete.
+        """
+
+        if not self.bytemap_file.exists():
+            raise UploadError(f"upload is not in progress")
+
+        start, end = self.span(index)
+        digests = BlockDigests(self.path, self.size_bytes)
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            # a chunk never spills over into the next one
+            written = await write_stream(
+                stream, fd, start, digests, limit=end - start + 1
+            )
+        finally:
+            os.close(fd)
+
+        if written != end - start + 1:
+            raise UploadError(
+                f"want chunk size {end - start + 1} but got {written}"
+            )
+
+        fd = os.open(self.bytemap_file, os.O_WRONLY)
+        try:
+            os.pwrite(fd, RECEIVED, index)
+        finally:
+            os.close(fd)
+
+    def missing(self) -> typing.List[int]:
+        "Chunks that have not been received yet"
+        if self.finalized:
+            return []
+        with open(self.bytemap_file, "rb") as f:
+            bytemap = f.read()
+        return [i for i, x in enumerate(bytemap) if x != RECEIVED[0]]
+
+    def received_bytes(self) -> int:
+        "Bytes at the start of the file that are on disk"
+        missing = self.missing()
+        if not missing:
+            return self.size_bytes
+        return self.span(missing[0])[0]
+
+    def finalize(self, checksum: str = None):
+        """
+        Verify that every chunk arrived, and optionally the checksum of the
+        whole file, given as algorithm:hexdigest, e.g. sha256:9f86d0.
+        """
+
+        if self.finalized:
+            return
+
+        missing = self.missing()
+        if missing:
+            raise UploadError(f"missing {len(missing)} chunks: {missing[:10]}")
+
+        size = self.path.stat().st_size
+        if size != self.size_bytes:
+            raise UploadError(f"want {self.size_bytes} bytes but got {size}")
+
+        if checksum:
+            algorithm, _, want = checksum.partition(":")
+            try:
+                h = hashlib.new(algorithm)
+            except ValueError:
+                raise UploadError(f"unsupported checksum: {algorithm}")
+            with open(self.path, "rb") as f:
+                while data := f.read(WRITE_SIZE):
+                    h.update(data)
+            if h.hexdigest() != want.lower():
+                raise UploadError(f"checksum mismatch: {h.hexdigest()}")
+
+        self.bytemap_file.unlink()
+        logger.info(f"finalized {self.path}")
+
+
+def chunked_upload(t) -> typing.Optional[ChunkedUpload]:
+    "The parallel upload of a transcription, if it was uploaded that way"
+    if t.upload and t.upload.chunk_size:
+        return ChunkedUpload(
+            t.uploaded_file, t.upload.size_bytes, t.upload.chunk_size
+        )
+
+
+def media_hash(t) -> str:
+    "Content hash of a complete upload"
+    digests = BlockDigests(t.uploaded_file, t.upload.size_bytes)
+    media_hash = digests.media_hash()
+    digests.digest_file.unlink(missing_ok=True)
+    return media_hash
+
+
+def received_bytes(t) -> int:
+    "Bytes at the start of an upload that are on disk"
+    chunked = chunked_upload(t)
+    if chunked:
+        return chunked.received_bytes()
+    return t.uploaded_file.stat().st_size if t.uploaded_file.exists() else 0
+
+
+def upload_complete(t) -> bool:
+    return received_bytes(t) >= t.upload.size_bytes
+
+
+def wait_for(
+    t, n_bytes: int, poll_seconds: float = 0.5, idle_timeout: float = 300
+) -> int:
+    """
+    Block until the first n_bytes of an upload are on disk. Returns the
+    number of bytes on disk. Raises UploadError if nothing arrives for
+    idle_timeout seconds.
+    """
+
+    n_bytes = min(n_bytes, t.upload.size_bytes)
+    last_received = -1
+    last_seen = time.monotonic()
+    while (received := received_bytes(t)) < n_bytes:
+        if received > last_received:
+            last_received, last_seen = received, time.monotonic()
+        elif time.monotonic() - last_seen > idle_timeout:
+            raise UploadError(f"upload stalled at {received} bytes")
+        time.sleep(poll_seconds)
+
+    return received
+
+
+def follow(t, poll_seconds: float = 0.5, idle_timeout: float = 300):
+    """
+    Yield an upload in blocks as it arrives, until all of it has been read.
+    A failed contiguous chunk may be truncated after it was read, but it is
+    then sent again with the same bytes.
+    """
+
+    offset = 0
+    while offset < t.upload.size_bytes:
+        available = wait_for(t, offset + 1, poll_seconds, idle_timeout)
+        with open(t.uploaded_file, "rb") as f:
+            f.seek(offset)
+            while offset < available:
+                data = f.read(min(WRITE_SIZE, available - offset))
+                if not data:
+                    break
+                offset += len(data)
+                yield data
@@ -0,0 +1,227 @@
+"""
+Voice activity detection. After transcoding, the speech regions of a file
+are found from frame energies, and cut out into a speech file with a short
+silence between regions. Transcription, alignment and diarization then read
+the speech file instead of the whole track, so stretches of silence cost
+nothing, and their timestamps are mapped back to the track with the speech
+map that is stored next to it.
+"""
+
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+import json
+import logging
+import os
+import typing
+import uuid
+
+from modal import Image
+
+import common
+from common import app
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class VadError(Exception):
+    pass
+
+
+# frames quieter than this, in db relative to full scale, are silent
+THRESHOLD_DB = -45.0
+
+# and so are frames less than this much louder than the noise floor
+MARGIN_DB = 10.0
+
+# pauses in speech shorter than this are kept
+MIN_SILENCE_SECONDS = 1.0
+
+# speech regions are padded by this much on either side
+PAD_SECONDS = 0.2
+
+# silence between regions in the speech file, so that words at the end of
+# one region don't run into the next
+GAP_SECONDS = 0.5
+
+vad_image = Image.debian_slim(python_version="3.10.8").pip_install("numpy")
+
+
+@dataclass
+class SpeechMap:
+    """
+    Where the regions of a speech file are in the transcoded track
+    """
+
+    # (start, end) seconds of each region in the track
+    regions: typing.List[typing.Tuple[float, float]] = field(
+        default_factory=list
+    )
+    # seconds of silence after each region in the speech file
+    gap_seconds: float = GAP_SECONDS
+
+    @classmethod
+    def read(cls, path: Path):
+        with open(path, "r") as f:
+            d = json.load(f)
+        return cls([tuple(x) for x in d["regions"]], d["gap_seconds"])
+
+    def write(self, path: Path):
+        common.write_atomic(path, json.dumps(asdict(self)))
+
+    @property
+    def speech_seconds(self) -> float:
+        return sum(end - start for start, end in self.regions)
+
+    def to_track(self, seconds, end: bool = False):
+        """
+        Track seconds of speech file seconds. Times in the silence between
+        two regions go to the end of the first region if they are ends, and
+        to the start of the next one otherwise.
+        """
+
+        import numpy as np
+
+        seconds = np.asarray(seconds, dtype=float)
+        if not self.regions:
+            return seconds
+
+        regions = np.asarray(self.regions, dtype=float)
+        lengths = regions[:, 1] - regions[:, 0]
+        starts = np.concatenate(
+            [[0.0], np.cumsum(lengths + self.gap_seconds)[:-1]]
+        )
+        i = np.searchsorted(starts, seconds, side="right") - 1
+        i = np.clip(i, 0, len(regions) - 1)
+        offset = np.clip(seconds - starts[i], 0, None)
+        track = regions[i, 0] + np.minimum(offset, lengths[i])
+        if end:
+            return track
+
+        gap = (offset > lengths[i]) & (i + 1 < len(regions))
+        following = regions[np.minimum(i + 1, len(regions) - 1), 0]
+        return np.where(gap, following, track)
+
+    def to_track_spans(self, spans: typing.List[tuple]):
+        "Track (start, end) seconds of speech file (start, end) seconds"
+        import numpy as np
+
+        if not spans:
+            return []
+        starts, ends = np.asarray(spans, dtype=float).reshape(-1, 2).T
+        ends = self.to_track(ends, end=True)
+
+        # spans that lie in a gap collapse onto the end of the region before
+        starts = np.minimum(self.to_track(starts), ends)
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    def transcript(self, transcript: dict) -> dict:
+        "A whisper transcript of the speech file, in track time"
+        segments = transcript.get("segments", [])
+        spans = self.to_track_spans([(s["start"], s["end"]) for s in segments])
+
+        remapped = []
+        for segment, (start, end) in zip(segments, spans):
+            segment = segment | {"start": start, "end": end}
+            if segment.get("words"):
+                words = self.to_track_spans(
+                    [(w["start"], w["end"]) for w in segment["words"]]
+                )
+                segment["words"] = [
+                    w | {"start": start, "end": end}
+                    for w, (start, end) in zip(segment["words"], words)
+                ]
+            remapped.append(segment)
+
+        return transcript | {"segments": remapped}
+
+    def alignment(self, alignment: common.Alignment) -> common.Alignment:
+        "An alignment of the speech file, in track time"
+        spans = self.to_track_spans([(w.start, w.end) for w in alignment.words])
+        return replace(
+            alignment,
+            words=[
+                replace(w, start=start, end=end)
+                for w, (start, end) in zip(alignment.words, spans)
+            ],
+        )
+
+    def diarization(self, diarization: common.Diarization):
+        "A diarization of the speech file, in track time"
+        spans = self.to_track_spans(
+            [(x.start, x.end) for x in diarization.turns]
+        )
+        return replace(
+            diarization,
+            turns=[
+                replace(x, start=start, end=end)
+                for x, (start, end) in zip(diarization.turns, spans)
+            ],
+        )
+
+
+@app.function(
+    cpu=2.0,
+    container_idle_timeout=180,
+    image=vad_image,
+    network_file_systems=common.nfs,
+    timeout=600,
+)
+def vad(transcription_id: str):
+    """
+    Find the speech in a transcoded file, and write the speech file and map.
+    """
+
+    t = common.db.select(transcription_id)
+    if not t:
+        raise VadError(f"invalid id : {transcription_id}")
+    if not t.transcoded_file.exists():
+        raise VadError(f"not transcoded : {transcription_id}")
+
+    speech = write_speech(t.transcoded_file, t.speech_file, t.speech_map_file)
+    seconds = speech.speech_seconds
+    logger.info(f"{len(speech.regions)} speech regions, {seconds:.1f}s")
+
+
+def write_speech(wav_file: Path, speech_file: Path, map_file: Path):
+    "Write the speech regions of wav_file to speech_file, and their map"
+    import numpy as np
+
+    import audio
+
+    samples, sample_rate = audio.read_wav(wav_file)
+    regions = audio.speech_regions(
+        samples,
+        sample_rate,
+        threshold_db=THRESHOLD_DB,
+        margin_db=MARGIN_DB,
+        min_silence_seconds=MIN_SILENCE_SECONDS,
+        pad_seconds=PAD_SECONDS,
+    )
+
+    gap = np.zeros(int(GAP_SECONDS * sample_rate), dtype=np.float32)
+    spans = (x for start, end in regions for x in (samples[start:end], gap))
+    tmp = speech_file.with_name(f".{speech_file.name}.{uuid.uuid4().hex}.tmp")
+    audio.write_wav(tmp, spans, sample_rate)
+    os.replace(tmp, speech_file)
+
+    speech = SpeechMap(
+        [(start / sample_rate, end / sample_rate) for start, end in regions]
+    )
+    speech.write(map_file)
+    return speech
+
+
+def speech_input(
+    t: common.Transcription, speech: bool
+) -> typing.Tuple[Path, typing.Optional[SpeechMap]]:
+    """
+    The audio file that a stage reads, and the map of its times to the
+    track, if it is the speech file.
+    """
+
+    if not speech:
+        return t.transcoded_file, None
+    if not t.speech_map_file.exists():
+        raise VadError(f"no speech file : {t.transcription_id}")
+    return t.speech_file, SpeechMap.read(t.speech_map_file)